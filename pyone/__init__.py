@@ -1 +1 @@
-from . import pyonefs, pyone_net
+from . import pyonefs, pyone_net, pyone_aio, pyone_mp, placement
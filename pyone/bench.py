@@ -0,0 +1,647 @@
+'''Benchmarks for PyOne.  Run with python -m pyone.bench, see --help.  The cluster benchmarks run several
+Managers in this process over loopback, and --json saves the results to compare them between releases.'''
+import socket, tempfile, time, json, os, sys, _thread, logging, ecdsa, random, tracemalloc, gc, subprocess, contextlib, resource, platform, argparse, threading
+from . import pyonefs, pyone_net, pyone_aio, pyone_mp, metaimage, compression
+
+class BenchManager(pyone_net.Manager):
+    '''Manager without any networking threads, so a Peer can be driven directly.  Set up by Manager.__init__,
+so it has everything a Peer uses.  The certificate is made under the filesystem's directory.'''
+    def __init__(self, fs, chunk_size=1<<20):
+        certfile, keyfile = make_certs(fs.loc)
+        pyone_net.Manager.__init__(self, fs, serve=False, certfile=certfile, keyfile=keyfile, cafile=certfile,
+                                   chunk_size=chunk_size, verify_workers=0, compress=False)
+    def start(self, serve, adr, port):
+        pass
+
+def bench_recv(size=1<<30, chunk=1<<20):
+    '''pushes a file of size bytes to a Peer over a socket pair, returns the receive throughput in bytes/s.'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        ident = ['bench.bin', '0']
+        epath = os.path.basename(fs.localPathOf(ident))
+
+        # the target file already exists so the peer drops the data, this measures parsing and not the disk
+        open(os.path.join(loc, epath), 'wb').close()
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        peer = pyone_net.Peer(b, BenchManager(fs))
+        peer.isSynced = True
+        def sender():
+            header = json.dumps([ident, '.bin', epath])
+            a.sendall(bytes([pyone_net.COMMAND_PUSH_FS_CHANGE])+len(header).to_bytes(2, 'little')+header.encode())
+            a.sendall(size.to_bytes(4, 'little'))
+            block = bytes(chunk)
+            left = size
+            while left>0:
+                n = min(left, chunk)
+                a.sendall(block[:n])
+                left-=n
+            a.close()
+        start = time.time()
+        _thread.start_new_thread(sender, ())
+        while True:
+            try:
+                peer.update()
+            except ConnectionError:
+                # the sender closed the socket, everything has been received
+                break
+        elapsed = time.time()-start
+        b.close()
+        if peer.state!=0:
+            raise Exception("Transfer did not complete")
+    return size/elapsed
+
+def bench_recv_json(size=16<<20):
+    '''sends a COMMAND_RETURN_FS_JSON of size bytes to a Peer, returns the receive throughput in bytes/s.
+The whole JSON has to be buffered before it is parsed, which is where a copying buffer is quadratic.'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        peer = pyone_net.Peer(b, BenchManager(fs))
+        peer.isSynced = True
+
+        # padding the JSON with whitespace keeps the comparison out of the measurement
+        fs_json = b'{' + b' '*size + b'}'
+        def sender():
+            a.sendall(bytes([pyone_net.COMMAND_RETURN_FS_JSON])+len(fs_json).to_bytes(4, 'little'))
+            a.sendall(fs_json)
+            a.close()
+        start = time.time()
+        _thread.start_new_thread(sender, ())
+        while True:
+            try:
+                peer.update()
+            except ConnectionError:
+                # the sender closed the socket, everything has been received
+                break
+        elapsed = time.time()-start
+        b.close()
+        if peer.state!=0:
+            raise Exception("Transfer did not complete")
+    return size/elapsed
+
+def bench_first_request(count=200000):
+    '''sends the filesystem JSON of count names to a Peer with an empty filesystem, returns (seconds until
+the first file was requested, seconds until the whole JSON was compared).'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        man = BenchManager(fs)
+        peer = pyone_net.Peer(b, man)
+        peer.isSynced = True
+        requested = []
+        man.scheduler.want = lambda ident, peer: requested.append(time.time()) if len(requested)==0 else None
+        fs_json = json.dumps({'docs/file{:08d}.txt'.format(i):{hex(i)[2:]:'.txt'} for i in range(count)}).encode()
+        def sender():
+            a.sendall(bytes([pyone_net.COMMAND_RETURN_FS_JSON])+len(fs_json).to_bytes(4, 'little'))
+            a.sendall(fs_json)
+            a.close()
+        start = time.time()
+        _thread.start_new_thread(sender, ())
+        while True:
+            try:
+                peer.update()
+            except ConnectionError:
+                # the sender closed the socket, everything has been received
+                break
+        elapsed = time.time()-start
+        b.close()
+        if peer.state!=0 or len(requested)==0:
+            raise Exception("Transfer did not complete")
+    return requested[0]-start, elapsed
+
+def bench_send(size=1<<30, use_sendfile=True, chunk_size=1<<20):
+    '''pushes a file of size bytes from a Peer over a socket pair, returns the send throughput in bytes/s.'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        f = fs.open('bench.bin', 'wb')
+        block = bytes(1<<20)
+        left = size
+        while left>0:
+            f.write(block[:min(left, len(block))])
+            left-=len(block)
+        ident = f.close()
+        a, b = socket.socketpair()
+        peer = pyone_net.Peer(a, BenchManager(fs, chunk_size))
+        if not use_sendfile:
+            peer.__can_sendfile__ = lambda f: False
+        done = _thread.allocate_lock()
+        done.acquire()
+        def receiver():
+            buf = bytearray(1<<20)
+            while b.recv_into(buf)>0:
+                pass
+            done.release()
+        _thread.start_new_thread(receiver, ())
+        start = time.time()
+        peer.pushFsChange(ident)
+        peer.flush()
+        a.shutdown(socket.SHUT_WR)
+        done.acquire()
+        elapsed = time.time()-start
+        a.close()
+        b.close()
+    return size/elapsed
+
+def bench_compression(size=64<<20, text=True, codec=None):
+    '''pushes a file of size bytes between two Peers over a socket pair with frames compressed by codec (None
+sends without frames).  The file is CSV text if text is True, random bytes otherwise.
+Returns (bytes/s, bytes on the wire per byte of the file, CPU seconds spent compressing).'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        f = fs.open('bench.csv', 'wb')
+        left = size
+        while left>0:
+            if text:
+                block = ''.join('{},{},sensor{},{:.3f}\n'.format(i, 1600000000+i, i%16, random.random()) for i in range(10000)).encode()
+            else:
+                block = os.urandom(1<<20)
+            f.write(block[:left])
+            left-=len(block)
+        ident = f.close()
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        sender = pyone_net.Peer(a, BenchManager(fs))
+        man = BenchManager(fs)
+        receiver = pyone_net.Peer(b, man)
+        receiver.isSynced = True
+        if codec!=None:
+            sender.startFraming(codec)
+        # the receiver has the file already, so it drops the data
+        def send():
+            sender.pushFsChange(ident)
+            sender.flush()
+            a.close()
+        start = time.time()
+        _thread.start_new_thread(send, ())
+        while True:
+            try:
+                receiver.update()
+            except ConnectionError:
+                # the sender closed the socket, everything has been received
+                break
+        elapsed = time.time()-start
+        b.close()
+        if receiver.state!=0:
+            raise Exception("Transfer did not complete")
+    stats = sender.man.compress_stats
+    if codec==None:
+        return size/elapsed, 1.0, 0.0
+    return size/elapsed, stats['sent']/size, stats['compress_cpu']
+
+def bench_interleave(size=256<<20, mux=True):
+    '''pushes a file of size bytes between two Peers over a socket pair, and sends a small message right after
+it.  The file goes out as a stream if mux is True, and whole like to peers without 'mux' otherwise.
+Returns (seconds until the small message arrived, seconds until the file did).'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc)
+        f = fs.open('bench.bin', 'wb')
+        left = size
+        while left>0:
+            f.write(bytes(min(left, 1<<20)))
+            left-=1<<20
+        ident = f.close()
+        a, b = socket.socketpair()
+        a.setblocking(0)
+        b.setblocking(0)
+        sender = pyone_net.Peer(a, BenchManager(fs))
+        sender.remote = {'node':'bench', 'caps':['mux'] if mux else []}
+        sender.isSynced = True
+        man = BenchManager(fs)
+        receiver = pyone_net.Peer(b, man)
+        receiver.isSynced = True
+        arrived = {}
+        # the receiver has the file already, so it drops the data
+        man.onAnnounce = lambda peer, ident, size: arrived.setdefault('message', time.time())
+        man.fileReceived = lambda ident, size: arrived.setdefault('file', time.time())
+        start = time.time()
+        sender.pushFsChange(ident)
+        sender.sendJson(pyone_net.COMMAND_ANNOUNCE, [[['other.txt', '1'], 1]])
+        while len(arrived)<2:
+            sender.update()
+            sender.pump()
+            receiver.update()
+            receiver.pump()
+        a.close()
+        b.close()
+    return arrived['message']-start, arrived['file']-start
+
+def bench_verify(count=512, batch_sizes=(1, 16, 64, 256), workers=None):
+    '''verifies count signed messages from a few keys, returns {name: messages/s}.
+'serial' parses the key and verifies one message at a time like testSignedMessage used to, 'cached'
+verifies on the calling thread with the key cache, and the numbers are batch sizes on the process pool.'''
+    keys = [pyone_net.KeyPair() for i in range(4)]
+    msgs = []
+    for i in range(count):
+        data = bytes([pyone_net.COMMAND_GET_FILE])+os.urandom(256)
+        signed = keys[i%len(keys)].sign(data)
+        msgs.append((signed[:64], signed[64:], data))
+    out = {}
+
+    start = time.time()
+    for vk, sig, data in msgs:
+        ecdsa.VerifyingKey.from_string(vk, curve=ecdsa.SECP256k1).verify(sig, data)
+    out['serial'] = count/(time.time()-start)
+
+    def run(verifier):
+        entries = [[vk, data, None] for vk, sig, data in msgs]
+        start = time.time()
+        for entry, msg in zip(entries, msgs):
+            verifier.submit(None, entry, msg[1], True)
+        verifier.flush()
+        while any(i[2]==None for i in entries):
+            verifier.collect()
+            time.sleep(.001)
+        elapsed = time.time()-start
+        if not all(i[2] for i in entries):
+            raise Exception("Signature check failed")
+        return count/elapsed
+
+    out['cached'] = run(pyone_net.SignatureVerifier(0, count))
+    for n in batch_sizes:
+        verifier = pyone_net.SignatureVerifier(workers, n)
+        # start the pool and fill the key caches of the workers first
+        verifier.submit(None, [msgs[0][0], msgs[0][2], None], msgs[0][1], True)
+        verifier.flush()
+        while len(verifier.done)==0:
+            time.sleep(.01)
+        verifier.collect()
+        out[n] = run(verifier)
+        verifier.close()
+    return out
+
+def bench_metadata_memory(count=1000000, compact=True):
+    '''loads a filesystem of count single-version entries, returns (bytes of RAM per entry, seconds to load).
+The change log is written by a first load, so the measured load is a normal restart.'''
+    with tempfile.TemporaryDirectory() as loc:
+        with open(os.path.join(loc, 'fsdat.json'), 'w') as f:
+            json.dump({'docs/dir{:04d}/file{:08d}.txt'.format(i%5000, i):{hex(random.randint(0, 0x10000000))[2:]:'.txt'} for i in range(count)}, f)
+        pyonefs.PyOneFS(loc).close()
+        gc.collect()
+        tracemalloc.start()
+        start = time.time()
+        fs = pyonefs.PyOneFS(loc, compact=compact)
+        elapsed = time.time()-start
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        fs.close()
+    return used/count, elapsed
+
+def bench_startup(count=1000000, lazy=True):
+    '''opens a filesystem of count single-version entries, returns (seconds to open, seconds for a get_entry
+and lsentries of a random name).  The metadata is written directly, as fsdat.img when lazy is True and
+as fsdat.json otherwise.'''
+    with tempfile.TemporaryDirectory() as loc:
+        names = ('docs/dir{:05d}/file{:08d}.txt'.format(i//1000, i) for i in range(count))
+        items = ((name, [[hex(random.randint(0, 0x10000000))[2:], '.txt']]) for name in names)
+        with open(os.path.join(loc, 'fschanges.log'), 'w') as changes:
+            if lazy:
+                log = metaimage.ChangeLogFile(os.path.join(loc, 'fschanges.log'))
+                def logged(items):
+                    # the image is written at the same time as the change log it matches
+                    for name, versions in items:
+                        changes.write(json.dumps([name, versions[0][0]])+'\n')
+                        log.append([name, versions[0][0]])
+                        yield name, versions
+                tree = pyonefs.HashTree()
+                metaimage.write(os.path.join(loc, 'fsdat.img'), logged(items), pyonefs.extOf, tree.hashOf, tree.depth, log)
+            else:
+                files = {}
+                for name, versions in items:
+                    changes.write(json.dumps([name, versions[0][0]])+'\n')
+                    files[name] = dict(versions)
+                with open(os.path.join(loc, 'fsdat.json'), 'w') as f:
+                    json.dump(files, f)
+                del files
+        gc.collect()
+        start = time.time()
+        fs = pyonefs.PyOneFS(loc, lazy=lazy)
+        opened = time.time()-start
+        name = 'docs/dir{:05d}/file{:08d}.txt'.format(count//2000, count//2)
+        start = time.time()
+        fs.get_entry(fs.lsentries(name)[0])
+        lookup = time.time()-start
+        fs.close()
+    return opened, lookup
+
+def make_certs(loc):
+    '''writes a self-signed certificate and its key to loc with openssl, returns (certfile, keyfile).  Every node
+of a Cluster uses it, and it is its own CA.'''
+    certfile = os.path.join(loc, 'bench.crt')
+    keyfile = os.path.join(loc, 'bench.key')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', keyfile, '-out', certfile,
+                    '-days', '1', '-subj', '/CN=pyone-bench'], check=True, capture_output=True)
+    return certfile, keyfile
+
+@contextlib.contextmanager
+def quiet():
+    # peers dropped while a cluster shuts down are logged as warnings, which go to stderr without a handler
+    logger = logging.getLogger('pyone')
+    level = logger.level
+    logger.setLevel(logging.ERROR)
+    try:
+        yield
+    finally:
+        logger.setLevel(level)
+
+class Cluster:
+    '''n Managers in this process, each with its own filesystem under loc and its own loopback address.
+Every node connects to the first one when connect is called.  fs_args go to PyOneFS and the other keyword
+arguments to the Managers.  If workers is more than 0 the first node serves its peers from that many worker
+processes (see pyone_mp.PreforkManager), it is created first so the workers don't inherit the other nodes.
+seed is called with the first filesystem before any Manager starts.'''
+    def __init__(self, n, loc, aio=False, fs_args={}, workers=0, seed=None, **manager_args):
+        self.certfile, self.keyfile = make_certs(loc)
+        self.port = random.randint(20000, 60000)
+        self.fss = [pyonefs.PyOneFS(os.path.join(loc, 'node%d'%i), **fs_args) for i in range(n)]
+        if seed!=None:
+            seed(self.fss[0])
+        self.managers = []
+        self.workers = workers
+        manager = pyone_aio.AsyncManager if aio else pyone_net.Manager
+        for i in range(n):
+            args = dict(manager_args)
+            if i==0 and workers>0:
+                make = pyone_mp.PreforkManager
+                args['workers'] = workers
+            else:
+                make = manager
+            self.managers.append(make(self.fss[i], adr=self.address(i), port=self.port, certfile=self.certfile,
+                                      keyfile=self.keyfile, cafile=self.certfile, **args))
+    def address(self, i):
+        return '127.0.0.{}'.format(i+1)
+    def connect(self):
+        for man in self.managers[1:]:
+            man.connectPeer(self.address(0))
+        # connected once every node has the hello of its peers
+        n = len(self.managers)-1
+        if self.workers>0:
+            # the peers of the first node are in its workers, so only the other side is checked
+            self.wait(lambda: all(len(m.peers)==1 and m.peers[0].remote!=None for m in self.managers[1:]))
+            return
+        self.wait(lambda: len(self.managers[0].peers)==n and all(p.remote!=None for m in self.managers for p in list(m.peers)))
+    def wait(self, done, timeout=300):
+        '''waits until done() is True, returns the seconds it took.'''
+        start = time.time()
+        while not done():
+            if time.time()-start>timeout:
+                raise Exception("Benchmark cluster timed out")
+            time.sleep(.002)
+        return time.time()-start
+    def has_all(self, i, count):
+        # entries are only created once their data is in
+        return len(self.fss[i].files)>=count
+    def close(self):
+        for man in self.managers:
+            man.close()
+        for fs in self.fss:
+            fs.close()
+
+def populate(fs, count, size):
+    '''adds count files of size bytes to fs directly, without telling the listeners.'''
+    data = os.urandom(size)
+    for i in range(count):
+        ident = ['docs/dir{:03d}/file{:07d}.bin'.format(i%100, i), hex(i+1)[2:]]
+        with open(fs.localPathOf(ident), 'wb') as f:
+            f.write(data)
+        fs.set_entry(ident, '.bin')
+    fs.flush()
+
+def bench_cluster_write(nodes=3, count=2000, size=4096, aio=False):
+    '''writes count files of size bytes on the first node of a cluster, while the others are connected.
+Returns (files/s written, seconds until every node had every file).'''
+    with tempfile.TemporaryDirectory() as loc, quiet():
+        cluster = Cluster(nodes, loc, aio, {'journal':True})
+        try:
+            cluster.connect()
+            data = os.urandom(size)
+            fs = cluster.fss[0]
+            start = time.time()
+            for i in range(count):
+                f = fs.open('new/file{:07d}.bin'.format(i), 'wb')
+                f.write(data)
+                f.close()
+            written = time.time()-start
+            cluster.wait(lambda: all(cluster.has_all(i, count) for i in range(1, nodes)))
+            replicated = time.time()-start
+        finally:
+            cluster.close()
+    return count/written, replicated
+
+def bench_flush(count=100000, journal=False, writes=200):
+    '''adds writes entries to a filesystem of count entries, flushing after each one like PyOneFile does.
+Returns the seconds per flush.'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc, journal=journal)
+        populate(fs, count, 0)
+        start = time.time()
+        for i in range(writes):
+            fs.wr_entry('flush/file{:05d}.txt'.format(i), '.txt')
+            fs.flush()
+        elapsed = time.time()-start
+        fs.close()
+    return elapsed/writes
+
+def bench_ingest(count=2000, journal=True, durability='batched', writers=16, size=100):
+    '''writes count files of size bytes from writers threads, each waiting until its file is durable before
+writing the next.  Returns the files/s.'''
+    with tempfile.TemporaryDirectory() as loc:
+        fs = pyonefs.PyOneFS(loc, journal=journal, durability=durability)
+        populate(fs, 1000, 0)
+        data = os.urandom(size)
+        def write(k):
+            for i in range(count//writers):
+                f = fs.open('ingest/{}/file{:05d}.bin'.format(k, i), 'wb')
+                f.write(data)
+                f.close()
+                f.commit.result()
+        start = time.time()
+        threads = [threading.Thread(target=write, args=(k,)) for k in range(writers)]
+        for i in threads:
+            i.start()
+        for i in threads:
+            i.join()
+        elapsed = time.time()-start
+        fs.close()
+    return count//writers*writers/elapsed
+
+def bench_cluster_sync(count=10000, size=100, nodes=2, aio=False, memory=False):
+    '''puts count files of size bytes on the first node of a cluster, then connects the others and waits
+until they have every file.  Returns the seconds that took, or the peak bytes allocated by the whole
+process while it ran if memory is True (measured with tracemalloc, which slows it down).'''
+    with tempfile.TemporaryDirectory() as loc, quiet():
+        cluster = Cluster(nodes, loc, aio, {'journal':True})
+        try:
+            populate(cluster.fss[0], count, size)
+            gc.collect()
+            if memory:
+                tracemalloc.start()
+            start = time.time()
+            cluster.connect()
+            cluster.wait(lambda: all(cluster.has_all(i, count) for i in range(1, nodes)))
+            elapsed = time.time()-start
+            if memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                return peak
+        finally:
+            cluster.close()
+    return elapsed
+
+def bench_fanout(peers=8, count=2000, size=16<<10, workers=0):
+    '''puts count files of size bytes on a seed node, then connects peers nodes to it at once and waits until
+every one of them has every file, with the seed serving from workers processes (0 serves from the Manager's
+own thread).  Returns the bytes/s the seed uploaded.'''
+    with tempfile.TemporaryDirectory() as loc, quiet():
+        # the workers are forked with the files, populate doesn't tell the listeners
+        cluster = Cluster(peers+1, loc, fs_args={'journal':True}, workers=workers, seed=lambda fs: populate(fs, count, size))
+        try:
+            start = time.time()
+            cluster.connect()
+            cluster.wait(lambda: all(cluster.has_all(i, count) for i in range(1, peers+1)))
+            elapsed = time.time()-start
+        finally:
+            cluster.close()
+    return peers*count*size/elapsed
+
+def run_cluster(nodes=3, quick=False, aio=False):
+    '''runs the cluster benchmarks and prints them, returns {name: value}.'''
+    results = {}
+    def report(name, value, line):
+        results[name] = value
+        print(line)
+    counts = [1000, 10000] if quick else [1000, 10000, 100000]
+    files_per_s, replicated = bench_cluster_write(nodes, 500 if quick else 2000, aio=aio)
+    report('cluster.write.files_per_s', files_per_s, "cluster write ({} nodes): {:.0f} files/s".format(nodes, files_per_s))
+    report('cluster.write.replicated_s', replicated, "cluster write ({} nodes): on every node after {:.2f} s".format(nodes, replicated))
+    for journal in [False, True]:
+        for count in counts:
+            t = bench_flush(count, journal)
+            report('flush.{}.{}.seconds'.format('journal' if journal else 'json', count), t,
+                   "flush ({}, {} entries): {:.2f} ms".format('journal' if journal else 'fsdat.json', count, t*1e3))
+    for journal in [False, True]:
+        for durability in pyonefs.DURABILITY:
+            for writers in [1, 16]:
+                t = bench_ingest(500 if quick else 2000, journal, durability, writers)
+                report('ingest.{}.{}.{}.files_per_s'.format('journal' if journal else 'json', durability, writers), t,
+                       "ingest ({}, {}, {} writers): {:.0f} files/s".format('journal' if journal else 'fsdat.json', durability, writers, t))
+    for count in counts:
+        t = bench_cluster_sync(count, nodes=nodes, aio=aio)
+        report('cluster.sync.{}.seconds'.format(count), t, "cluster sync ({} nodes, {} files): {:.2f} s".format(nodes, count, t))
+    total = (64 if quick else 256)<<20
+    for size in [4<<10, 64<<10, 1<<20, 16<<20, total]:
+        count = min(total//size, 2000)
+        t = bench_cluster_sync(count, size, aio=aio)
+        report('cluster.transfer.{}.bytes_per_s'.format(size), count*size/t,
+               "cluster transfer ({} files of {} KiB): {:.1f} MB/s".format(count, size>>10, count*size/t/1e6))
+    peers = 4 if quick else 8
+    for workers in sorted({0, os.cpu_count()}):
+        t = bench_fanout(peers, 500 if quick else 2000, workers=workers)
+        report('cluster.fanout.{}.bytes_per_s'.format(workers), t,
+               "cluster fanout ({} peers from one seed, {} workers): {:.1f} MB/s".format(peers, workers, t/1e6))
+    count = counts[1]
+    peak = bench_cluster_sync(count, nodes=nodes, aio=aio, memory=True)
+    report('cluster.sync.{}.peak_bytes'.format(count), peak, "cluster sync ({} nodes, {} files): {:.1f} MB peak".format(nodes, count, peak/1e6))
+    return results
+
+def run_micro(size=1<<30):
+    '''runs the benchmarks of single parts and prints them, returns {name: value}.'''
+    results = {}
+    def report(name, value, line):
+        results[name] = value
+        print(line)
+    t = bench_recv(size)
+    report('recv.bytes_per_s', t, "recv file: {:.1f} MB/s".format(t/1e6))
+    t = bench_send(size)
+    report('send.sendfile.bytes_per_s', t, "send file (sendfile): {:.1f} MB/s".format(t/1e6))
+    t = bench_send(size, False)
+    report('send.buffered.bytes_per_s', t, "send file (buffered): {:.1f} MB/s".format(t/1e6))
+    t = bench_recv_json()
+    report('recv_json.bytes_per_s', t, "recv json: {:.1f} MB/s".format(t/1e6))
+    first, compared = bench_first_request()
+    results['sync_json.first_request_s'] = first
+    results['sync_json.compared_s'] = compared
+    print("sync: first request after {:.1f} ms, JSON compared in {:.2f} s".format(first*1e3, compared))
+    for compact in [False, True]:
+        name = 'compact' if compact else 'dicts'
+        per_entry, loaded = bench_metadata_memory(compact=compact)
+        results['metadata.{}.bytes'.format(name)] = per_entry
+        results['metadata.{}.load_s'.format(name)] = loaded
+        print("metadata ({}): {:.0f} bytes/entry, loaded in {:.1f} s".format(name, per_entry, loaded))
+    for text in [True, False]:
+        for codec in [None]+[k for k, v in compression.CODEC_NAMES.items() if v in compression.available()]:
+            speed, ratio, cpu = bench_compression(text=text, codec=codec)
+            name = '{}.{}'.format('csv' if text else 'random', compression.CODEC_NAMES.get(codec, 'uncompressed'))
+            results['push.{}.bytes_per_s'.format(name)] = speed
+            results['push.{}.wire_bytes'.format(name)] = ratio
+            results['push.{}.cpu_s'.format(name)] = cpu
+            print("push {} ({}): {:.1f} MB/s, {:.2f} bytes sent per byte, {:.2f} s compressing".format(
+                'csv' if text else 'random', compression.CODEC_NAMES.get(codec, 'uncompressed'), speed/1e6, ratio, cpu))
+    for mux in [False, True]:
+        message, done = bench_interleave(mux=mux)
+        name = 'streams' if mux else 'whole'
+        results['push.{}.message_s'.format(name)] = message
+        results['push.{}.file_s'.format(name)] = done
+        print("push ({}): message behind a file arrived after {:.1f} ms, file after {:.2f} s".format(name, message*1e3, done))
+    for lazy in [False, True]:
+        opened, lookup = bench_startup(lazy=lazy)
+        name = 'lazy' if lazy else 'json'
+        results['startup.{}.open_s'.format(name)] = opened
+        results['startup.{}.lookup_s'.format(name)] = lookup
+        print("startup ({}): opened in {:.3f} s, first lookup in {:.2f} ms".format('lazy' if lazy else 'fsdat.json', opened, lookup*1e3))
+    for k, v in bench_verify().items():
+        results['verify.{}.messages_per_s'.format(k)] = v
+        print("verify ({}): {:.0f} messages/s".format(k if isinstance(k, str) else 'batch of '+str(k), v))
+    return results
+
+def compare(old, new, tolerance=.1):
+    '''compares two saved runs, returns [name, old value, new value] for every result that got worse by more
+than tolerance.  Results ending in _per_s are better when higher, all the others when lower.'''
+    out = []
+    for name, value in new['results'].items():
+        before = old['results'].get(name)
+        if before==None or before==0:
+            continue
+        change = (value-before)/before
+        if name.endswith('_per_s'):
+            change = -change
+        if change>tolerance:
+            out.append([name, before, value])
+    return out
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m pyone.bench', description=__doc__)
+    parser.add_argument('size', nargs='?', type=int, default=1<<30, help='bytes sent by the single transfer benchmarks')
+    parser.add_argument('--suite', choices=['micro', 'cluster', 'all'], default='all')
+    parser.add_argument('--nodes', type=int, default=3, help='nodes in the cluster benchmarks')
+    parser.add_argument('--aio', action='store_true', help='run the cluster on AsyncManager')
+    parser.add_argument('--quick', action='store_true', help='smaller cluster benchmarks')
+    parser.add_argument('--json', metavar='FILE', help='save the results to FILE')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='list the regressions between two saved runs and exit')
+    parser.add_argument('--tolerance', type=float, default=.1)
+    args = parser.parse_args(argv)
+    if args.compare!=None:
+        runs = []
+        for path in args.compare:
+            with open(path) as f:
+                runs.append(json.load(f))
+        worse = compare(runs[0], runs[1], args.tolerance)
+        for name, before, after in worse:
+            print("{}: {:.4g} -> {:.4g}".format(name, before, after))
+        return 1 if len(worse)>0 else 0
+    results = {}
+    if args.suite!='cluster':
+        results.update(run_micro(args.size))
+    if args.suite!='micro':
+        results.update(run_cluster(args.nodes, args.quick, args.aio))
+    if args.json!=None:
+        run = {'time':time.time(), 'python':platform.python_version(), 'platform':platform.platform(),
+               'args':vars(args), 'peak_rss':resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024, 'results':results}
+        with open(args.json, 'w') as f:
+            json.dump(run, f, indent=1)
+    return 0
+
+if __name__=='__main__':
+    sys.exit(main())
@@ -0,0 +1,129 @@
+import os, io, hashlib
+
+# table for the gear rolling hash.  Derived from sha256 so every node cuts chunks at the same places.
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'little') for i in range(256)]
+
+def sync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class ChunkStore:
+    '''Content-addressed storage for file data.  Files are split into content-defined chunks which are
+stored once under their sha256, so versions of a file that only differ slightly share most chunks.
+A file is described by its manifest, a list of [hash, size] for each chunk.
+If sync is True chunks are fsynced before they are renamed into place, and store_file only returns once
+they are durable.'''
+    def __init__(self, location, avg_bits=16, min_size=1<<14, max_size=1<<18, sync=False):
+        self.loc = location
+        self.sync = sync
+        self.mask = ((1<<avg_bits)-1)<<(64-avg_bits)
+        self.min_size = min_size
+        self.max_size = max_size
+        os.makedirs(location, exist_ok=True)
+    def pathOf(self, h):
+        return os.path.join(self.loc, h[:2], h)
+    def has(self, h):
+        return os.path.isfile(self.pathOf(h))
+    def get(self, h):
+        with open(self.pathOf(h), 'rb') as f:
+            return f.read()
+    def put(self, data):
+        '''stores a chunk if it isn't there yet, returns its hash.'''
+        h = hashlib.sha256(data).hexdigest()
+        path = self.pathOf(h)
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # rename into place so a chunk is never seen half-written
+            with open(path+'.tmp', 'wb') as f:
+                f.write(data)
+                if self.sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(path+'.tmp', path)
+        return h
+    def __boundary__(self, data):
+        # gear hash, the chunk ends where the top bits of the hash are all zero
+        end = min(len(data), self.max_size)
+        if end<=self.min_size:
+            return end
+        h = 0
+        mask = self.mask
+        for i in range(self.min_size, end):
+            h = ((h<<1)+GEAR[data[i]]) & 0xffffffffffffffff
+            if h & mask==0:
+                return i+1
+        return end
+    def split(self, f):
+        '''yields the content-defined chunks of a binary file.'''
+        pending = bytearray()
+        eof = False
+        while True:
+            if not eof and len(pending)<self.max_size:
+                data = f.read(1<<20)
+                if len(data)==0:
+                    eof = True
+                pending+=data
+                continue
+            if len(pending)==0:
+                return
+            n = self.__boundary__(pending)
+            yield bytes(pending[:n])
+            del pending[:n]
+    def store_file(self, path):
+        '''splits a file into chunks and stores them, returns the manifest of the file.'''
+        manifest = []
+        with open(path, 'rb') as f:
+            for chunk in self.split(f):
+                manifest.append([self.put(chunk), len(chunk)])
+        if self.sync:
+            # the renames are only durable once the directories holding them are synced
+            for d in set(os.path.dirname(self.pathOf(h)) for h, size in manifest)|{self.loc}:
+                sync_dir(d)
+        return manifest
+    def open(self, manifest):
+        '''returns a readable binary file that reassembles the chunks of a manifest.'''
+        return io.BufferedReader(ChunkReader(self, manifest))
+
+class ChunkReader(io.RawIOBase):
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.size = sum(i[1] for i in manifest)
+        self.pos = 0
+        self.chunk_idx = 0
+        self.chunk_start = 0
+        self.chunk = None
+    def readable(self):
+        return True
+    def seekable(self):
+        return True
+    def seek(self, offset, whence=0):
+        if whence==1:
+            offset+=self.pos
+        elif whence==2:
+            offset+=self.size
+        self.pos = max(0, offset)
+        self.chunk_idx = 0
+        self.chunk_start = 0
+        self.chunk = None
+        return self.pos
+    def tell(self):
+        return self.pos
+    def readinto(self, b):
+        if self.pos>=self.size:
+            return 0
+        # find the chunk holding the current position
+        while self.chunk_start+self.manifest[self.chunk_idx][1]<=self.pos:
+            self.chunk_start+=self.manifest[self.chunk_idx][1]
+            self.chunk_idx+=1
+            self.chunk = None
+        if self.chunk==None:
+            self.chunk = self.store.get(self.manifest[self.chunk_idx][0])
+        offset = self.pos-self.chunk_start
+        n = min(len(b), len(self.chunk)-offset)
+        b[:n] = self.chunk[offset:offset+n]
+        self.pos+=n
+        return n
@@ -0,0 +1,238 @@
+import array, json, collections.abc
+
+# version id of a row whose id isn't a plain hex number, the id is in odd_vecs instead
+ODD_VEC = 0xffffffffffffffff
+# data code of a row whose data isn't a string or None, the data is in odd_data instead
+ODD_DATA = 0xffffffff
+
+class CompactFiles(collections.abc.MutableMapping):
+    '''Memory-compact replacement for the dict of dicts in PyOneFS.files, used the same way:
+files[name][id] is the data of a version.  Every version is a row in three arrays: its id as an
+integer, a code for its data and the row of the next version of the same name.  A name only costs its
+string and a dict slot holding its first row, and every distinct data string is stored once.
+Ids that aren't the lowercase hex made by wr_entry and data that isn't a string are kept in dicts.'''
+    def __init__(self, files=None):
+        self.heads = {}
+        self.vecs = array.array('Q')
+        self.data = array.array('I')
+        # -1 ends the list of versions of a name
+        self.next = array.array('q')
+        # the name of every row, these are the same string objects as the keys of heads
+        self.names = []
+        self.values = [None]
+        self.codes = {}
+        self.odd_vecs = {}
+        self.odd_data = {}
+        if files!=None:
+            for name in list(files.keys()):
+                # pop as we go, so every dict is freed as soon as its rows are built
+                self[name] = files.pop(name)
+    def copy(self):
+        out = CompactFiles()
+        out.heads = dict(self.heads)
+        out.vecs = array.array('Q', self.vecs)
+        out.data = array.array('I', self.data)
+        out.next = array.array('q', self.next)
+        out.names = list(self.names)
+        out.values = list(self.values)
+        out.codes = dict(self.codes)
+        out.odd_vecs = dict(self.odd_vecs)
+        out.odd_data = dict(self.odd_data)
+        return out
+    def __encode_vec__(self, vec):
+        try:
+            n = int(vec, 16)
+            if n<ODD_VEC and hex(n)[2:]==vec:
+                return n
+        except (ValueError, TypeError):
+            pass
+        return ODD_VEC
+    def vecOf(self, row):
+        n = self.vecs[row]
+        if n==ODD_VEC:
+            return self.odd_vecs[row]
+        return hex(n)[2:]
+    def ident(self, row):
+        return [self.names[row], self.vecOf(row)]
+    def dataOf(self, row):
+        code = self.data[row]
+        if code==ODD_DATA:
+            return self.odd_data[row]
+        return self.values[code]
+    def __set_data__(self, row, data):
+        self.odd_data.pop(row, None)
+        if data==None:
+            self.data[row] = 0
+        elif type(data)==str:
+            code = self.codes.get(data)
+            if code==None:
+                code = len(self.values)
+                self.values.append(data)
+                self.codes[data] = code
+            self.data[row] = code
+        else:
+            self.odd_data[row] = data
+            self.data[row] = ODD_DATA
+    def rows(self, name):
+        row = self.heads.get(name, -1)
+        while row!=-1:
+            yield row
+            row = self.next[row]
+    def find(self, name, vec):
+        '''returns the row of a version, or -1.'''
+        n = self.__encode_vec__(vec)
+        for row in self.rows(name):
+            if self.vecs[row]==n and (n!=ODD_VEC or self.odd_vecs[row]==vec):
+                return row
+        return -1
+    def set(self, name, vec, data):
+        row = self.find(name, vec)
+        if row!=-1:
+            self.__set_data__(row, data)
+            return
+        self.__append_row__(name, vec, data)
+    def __append_row__(self, name, vec, data):
+        row = len(self.vecs)
+        n = self.__encode_vec__(vec)
+        if n==ODD_VEC:
+            self.odd_vecs[row] = vec
+        self.vecs.append(n)
+        self.data.append(0)
+        self.next.append(-1)
+        self.__set_data__(row, data)
+        # new versions go at the end so they are listed in the order they were added
+        last = -1
+        for last in self.rows(name):
+            pass
+        if last!=-1:
+            # share the string of the first row
+            name = self.names[last]
+        self.names.append(name)
+        # the row is complete before it is linked, readers don't lock
+        if last==-1:
+            self.heads[name] = row
+        else:
+            self.next[last] = row
+    def entries(self):
+        '''yields (name, id, data) for every version.'''
+        for name, row in self.heads.items():
+            while row!=-1:
+                yield name, self.vecOf(row), self.dataOf(row)
+                row = self.next[row]
+    def plain(self, name):
+        '''returns the versions of name as a dict.'''
+        return {self.vecOf(row):self.dataOf(row) for row in self.rows(name)}
+    def __getitem__(self, name):
+        if not name in self.heads:
+            raise KeyError(name)
+        return Versions(self, name)
+    def __setitem__(self, name, versions):
+        if name in self.heads:
+            del self.heads[name]
+        # a name without versions still exists
+        self.heads[name] = -1
+        for vec, data in versions.items():
+            # the ids of a dict are already unique
+            self.__append_row__(name, vec, data)
+    def __delitem__(self, name):
+        # the rows are left behind, names are never removed from a PyOneFS
+        del self.heads[name]
+    def __contains__(self, name):
+        return name in self.heads
+    def __iter__(self):
+        return iter(self.heads)
+    def __len__(self):
+        return len(self.heads)
+
+class Versions(collections.abc.MutableMapping):
+    '''The versions of one name in a CompactFiles, used like the inner dicts of PyOneFS.files.'''
+    def __init__(self, files, name):
+        self.files = files
+        self.name = name
+    def __getitem__(self, vec):
+        row = self.files.find(self.name, vec)
+        if row==-1:
+            raise KeyError(vec)
+        return self.files.dataOf(row)
+    def __setitem__(self, vec, data):
+        self.files.set(self.name, vec, data)
+    def __delitem__(self, vec):
+        files = self.files
+        prev = -1
+        for row in files.rows(self.name):
+            if files.vecOf(row)==vec:
+                if prev==-1:
+                    files.heads[self.name] = files.next[row]
+                else:
+                    files.next[prev] = files.next[row]
+                return
+            prev = row
+        raise KeyError(vec)
+    def __contains__(self, vec):
+        return self.files.find(self.name, vec)!=-1
+    def __iter__(self):
+        for row in self.files.rows(self.name):
+            yield self.files.vecOf(row)
+    def __len__(self):
+        return sum(1 for i in self.files.rows(self.name))
+
+class EntryList:
+    '''List of [name, id] of entries in a CompactFiles, stored as row numbers.  Used for the change log
+and the buckets of the hash tree of a compact PyOneFS.'''
+    def __init__(self, files):
+        self.files = files
+        self.rows = array.array('q')
+        # entries that aren't in files, by position
+        self.missing = {}
+    def append(self, entry):
+        row = self.files.find(entry[0], entry[1])
+        if row==-1:
+            self.missing[len(self.rows)] = [entry[0], entry[1]]
+        self.rows.append(row)
+    def __entry__(self, i):
+        row = self.rows[i]
+        if row==-1:
+            return self.missing[i]
+        return self.files.ident(row)
+    def __len__(self):
+        return len(self.rows)
+    def __iter__(self):
+        for i in range(len(self.rows)):
+            yield self.__entry__(i)
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.__entry__(j) for j in range(*i.indices(len(self.rows)))]
+        if i<0:
+            i+=len(self.rows)
+        return self.__entry__(i)
+
+def blocks(files, size=10000):
+    # JSON for size names at a time, without the braces
+    block = {}
+    for name in files:
+        block[name] = files.plain(name)
+        if len(block)>=size:
+            yield json.dumps(block)[1:-1]
+            block = {}
+    if len(block)>0:
+        yield json.dumps(block)[1:-1]
+
+def dump(files, f):
+    '''writes files (a dict of dicts or a CompactFiles) to f as JSON.'''
+    if type(files)==dict:
+        json.dump(files, f)
+        return
+    # a block of names at a time, so the whole filesystem never has to exist as dicts
+    f.write('{')
+    first = True
+    for i in blocks(files):
+        if not first:
+            f.write(', ')
+        first = False
+        f.write(i)
+    f.write('}')
+
+def dumps(files):
+    if type(files)==dict:
+        return json.dumps(files)
+    return '{'+', '.join(blocks(files))+'}'
@@ -0,0 +1,120 @@
+import zlib, struct, time
+
+# zstd and lz4 are optional, zlib is always there
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Once a peer switches to frames, everything it sends is cut into frames of
+# codec (1 byte), length after decompression (4 bytes), length on the wire (4 bytes), payload.
+# Raw frames are passed through as they arrive, so they can be as long as a whole file.
+FRAME = struct.Struct('<BII')
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+CODEC_NAMES = {CODEC_ZLIB:'zlib', CODEC_ZSTD:'zstd', CODEC_LZ4:'lz4'}
+
+# data is compressed FRAME_SIZE bytes at a time, and a compressed frame may not decompress to more than MAX_FRAME
+FRAME_SIZE = 1<<18
+MAX_FRAME = 1<<22
+
+# smaller pieces are not worth compressing
+MIN_SIZE = 256
+
+# a piece is only compressed if SAMPLE bytes of it shrink to less than MAX_RATIO of their size
+SAMPLE = 4096
+MAX_RATIO = .9
+
+def available():
+    '''returns the names of the codecs that can be used here, the preferred one first.'''
+    out = []
+    if zstandard!=None:
+        out.append('zstd')
+    if lz4!=None:
+        out.append('lz4')
+    out.append('zlib')
+    return out
+
+def choose(remote):
+    '''returns the codec to send with to a peer supporting the codec names in remote, or None.'''
+    for name in available():
+        if name in remote:
+            return [k for k, v in CODEC_NAMES.items() if v==name][0]
+    return None
+
+def compress(codec, data):
+    if codec==CODEC_ZLIB:
+        return zlib.compress(data, 1)
+    elif codec==CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif codec==CODEC_LZ4:
+        return lz4.frame.compress(data)
+    raise Exception("Unknown codec "+str(codec))
+
+def decompress(codec, data, size):
+    '''returns data decompressed, which has to be size bytes.  Never inflates to more than size bytes.'''
+    if codec==CODEC_ZLIB:
+        d = zlib.decompressobj()
+        out = d.decompress(data, size)
+        if not d.eof:
+            raise ConnectionError("Corrupt compressed frame from peer")
+    elif codec==CODEC_ZSTD and zstandard!=None:
+        # zstd allocates what the frame says it holds, so check that first
+        if zstandard.get_frame_parameters(data).content_size!=size:
+            raise ConnectionError("Corrupt compressed frame from peer")
+        out = zstandard.ZstdDecompressor().decompress(data)
+    elif codec==CODEC_LZ4 and lz4!=None:
+        d = lz4.frame.LZ4FrameDecompressor()
+        out = d.decompress(data, size)
+    else:
+        raise ConnectionError("Peer used a codec that wasn't negotiated")
+    if len(out)!=size:
+        raise ConnectionError("Corrupt compressed frame from peer")
+    return out
+
+def new_stats():
+    '''counters shared by the encoders and decoders of a Manager.'''
+    return {'frames':0, 'compressed':0, 'skipped':0, 'raw':0, 'sent':0, 'compress_cpu':0.0,
+            'received':0, 'inflated':0, 'decompress_cpu':0.0}
+
+class Encoder:
+    '''Cuts the data sent to a peer into frames.  Every frame is compressed on its own, so frames written by
+different threads can't get in each other's way.'''
+    def __init__(self, codec, stats):
+        self.codec = codec
+        self.stats = stats
+    def compressible(self, sample):
+        # a quick compression of a sample says whether the real one is worth it
+        return len(zlib.compress(sample, 1))<MAX_RATIO*len(sample)
+    def raw_header(self, n):
+        '''returns the header of a raw frame of n bytes, the bytes themselves go out as they are.'''
+        self.stats['frames']+=1
+        self.stats['skipped']+=1
+        self.stats['raw']+=n
+        self.stats['sent']+=n+FRAME.size
+        return FRAME.pack(CODEC_RAW, n, n)
+    def encode(self, data):
+        out = []
+        with memoryview(data) as view:
+            for i in range(0, len(view), FRAME_SIZE):
+                out.append(self.__frame__(view[i:i+FRAME_SIZE]))
+        return b''.join(out)
+    def __frame__(self, piece):
+        n = len(piece)
+        if n>=MIN_SIZE and (n<=2*SAMPLE or self.compressible(piece[:SAMPLE])):
+            start = time.thread_time()
+            packed = compress(self.codec, piece)
+            self.stats['compress_cpu']+=time.thread_time()-start
+            if len(packed)<n:
+                self.stats['frames']+=1
+                self.stats['compressed']+=1
+                self.stats['raw']+=n
+                self.stats['sent']+=len(packed)+FRAME.size
+                return FRAME.pack(self.codec, n, len(packed))+packed
+        return self.raw_header(n)+bytes(piece)
@@ -0,0 +1,365 @@
+import os, mmap, struct, json, array, heapq, itertools, collections.abc
+
+# A metadata image is a snapshot of PyOneFS.files that is memory-mapped and read lazily, so a node can
+# start without parsing fsdat.json.  Layout (little endian):
+#   header      magic, name count, section offsets and the state of the change log it matches
+#   records     for every name: u32 length, name, u32 version count, then for every version
+#               u32 length, id, u32 length, data as JSON.  Versions are in the order they were written.
+#   names       u64 offset of every record, sorted by name
+#   extensions  u32 length, JSON {extension: [start, count]}, then u32 name indices sorted by extension
+#   tree        u32 depth, the u64 nodes of every level of the hash tree, u64 start of every bucket,
+#               then u32 name index and u32 version index of the complete entries sorted by bucket
+#   checkpoints u64 offset in fschanges.log of every CHECKPOINT-th change
+MAGIC = b'PYONEIM1'
+HEADER = struct.Struct('<8sQQQQQQQQ')
+U32 = struct.Struct('<I')
+U64 = struct.Struct('<Q')
+
+# one offset into the change log is remembered for every CHECKPOINT changes
+CHECKPOINT = 1024
+
+def write(path, items, ext_of, entry_hash, depth, changes):
+    '''writes a metadata image.  items yields (name, [[id, data], ...]) sorted by name.  ext_of(name) and
+entry_hash(name, id) -> (hash, bucket) come from pyonefs.  changes is the ChangeLogFile the image matches.'''
+    tmppath = path+'.tmp'
+    offsets = array.array('Q')
+    exts = {}
+    levels = [array.array('Q', bytes(8<<i)) for i in range(depth+1)]
+    buckets = array.array('I')
+    entries = array.array('I')
+    with open(tmppath, 'wb') as f:
+        f.write(bytes(HEADER.size))
+        pos = HEADER.size
+        for name, versions in items:
+            idx = len(offsets)
+            offsets.append(pos)
+            ext = ext_of(name)
+            if ext in exts.keys():
+                exts[ext].append(idx)
+            else:
+                exts[ext] = array.array('I', [idx])
+            raw = name.encode('utf-8', 'surrogatepass')
+            rec = [U32.pack(len(raw)), raw, U32.pack(len(versions))]
+            for i in range(len(versions)):
+                vec, data = versions[i]
+                rawvec = vec.encode('utf-8', 'surrogatepass')
+                rawdata = json.dumps(data).encode()
+                rec+=[U32.pack(len(rawvec)), rawvec, U32.pack(len(rawdata)), rawdata]
+                if data!=None:
+                    h, bucket = entry_hash(name, vec)
+                    for level in range(depth+1):
+                        levels[level][bucket>>(depth-level)] ^= h
+                    buckets.append(bucket)
+                    entries.append(idx)
+                    entries.append(i)
+            rec = b''.join(rec)
+            f.write(rec)
+            pos+=len(rec)
+
+        names_off = pos
+        f.write(offsets.tobytes())
+        pos+=len(offsets)*8
+
+        exts_off = pos
+        ext_dir = {}
+        start = 0
+        for ext in sorted(exts.keys()):
+            ext_dir[ext] = [start, len(exts[ext])]
+            start+=len(exts[ext])
+        raw = json.dumps(ext_dir).encode()
+        f.write(U32.pack(len(raw))+raw)
+        pos+=4+len(raw)
+        for ext in sorted(exts.keys()):
+            f.write(exts[ext].tobytes())
+            pos+=len(exts[ext])*4
+
+        # the entries are sorted by bucket with a counting sort
+        tree_off = pos
+        starts = array.array('Q', bytes(8*((1<<depth)+1)))
+        for b in buckets:
+            starts[b+1]+=1
+        for i in range(1<<depth):
+            starts[i+1]+=starts[i]
+        fill = array.array('Q', starts)
+        pairs = array.array('I', bytes(len(entries)*4))
+        for k in range(len(buckets)):
+            p = fill[buckets[k]]
+            fill[buckets[k]] = p+1
+            pairs[2*p] = entries[2*k]
+            pairs[2*p+1] = entries[2*k+1]
+        f.write(U32.pack(depth))
+        for i in levels:
+            f.write(i.tobytes())
+        f.write(starts.tobytes())
+        f.write(pairs.tobytes())
+        pos+=4+sum(len(i)*8 for i in levels)+len(starts)*8+len(pairs)*4
+
+        checkpoints_off = pos
+        f.write(changes.checkpoints.tobytes())
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, len(offsets), names_off, exts_off, tree_off, changes.length, changes.end,
+                            checkpoints_off, len(changes.checkpoints)))
+    os.replace(tmppath, path)
+
+class MetaImage:
+    '''A memory-mapped metadata image.  Nothing is read until it is asked for, names are found with a
+binary search of the sorted name offsets.'''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        mm = self.mm
+        (magic, self.count, self.names_off, exts_off, tree_off, self.changes_seq, self.changes_off,
+         checkpoints_off, checkpoints) = HEADER.unpack_from(mm, 0)
+        if magic!=MAGIC:
+            raise Exception("Not a metadata image: "+path)
+        self.checkpoints = array.array('Q', mm[checkpoints_off:checkpoints_off+8*checkpoints])
+        n = U32.unpack_from(mm, exts_off)[0]
+        self.ext_dir = json.loads(mm[exts_off+4:exts_off+4+n])
+        self.ext_table = exts_off+4+n
+        self.depth = U32.unpack_from(mm, tree_off)[0]
+        self.levels_off = tree_off+4
+        self.starts_off = self.levels_off+8*((2<<self.depth)-1)
+        self.pairs_off = self.starts_off+8*((1<<self.depth)+1)
+    def __record__(self, i):
+        return U64.unpack_from(self.mm, self.names_off+8*i)[0]
+    def __raw_name__(self, i):
+        off = self.__record__(i)
+        n = U32.unpack_from(self.mm, off)[0]
+        return self.mm[off+4:off+4+n]
+    def name(self, i):
+        return self.__raw_name__(i).decode('utf-8', 'surrogatepass')
+    def versions(self, i):
+        '''returns [[id, data], ...] of the name at index i.'''
+        mm = self.mm
+        off = self.__record__(i)
+        off+=4+U32.unpack_from(mm, off)[0]
+        out = []
+        for k in range(U32.unpack_from(mm, off)[0]):
+            off+=4
+            n = U32.unpack_from(mm, off)[0]
+            vec = mm[off+4:off+4+n].decode('utf-8', 'surrogatepass')
+            off+=4+n
+            n = U32.unpack_from(mm, off)[0]
+            out.append([vec, json.loads(mm[off+4:off+4+n])])
+            off+=n
+        return out
+    def bisect(self, name):
+        '''returns the index of the first name that is not less than name.'''
+        key = name.encode('utf-8', 'surrogatepass')
+        lo = 0
+        hi = self.count
+        while lo<hi:
+            mid = (lo+hi)//2
+            if self.__raw_name__(mid)<key:
+                lo = mid+1
+            else:
+                hi = mid
+        return lo
+    def find(self, name):
+        '''returns the index of name, or -1.'''
+        i = self.bisect(name)
+        if i<self.count and self.name(i)==name:
+            return i
+        return -1
+    def irange(self, start, stop=None):
+        for i in range(self.bisect(start), self.count):
+            name = self.name(i)
+            if stop!=None and name>=stop:
+                return
+            yield name
+    def ext_names(self, ext):
+        if not ext in self.ext_dir.keys():
+            return
+        start, n = self.ext_dir[ext]
+        for k in range(start, start+n):
+            yield self.name(U32.unpack_from(self.mm, self.ext_table+4*k)[0])
+    def tree_levels(self):
+        out = []
+        off = self.levels_off
+        for level in range(self.depth+1):
+            out.append(array.array('Q', self.mm[off:off+(8<<level)]))
+            off+=8<<level
+        return out
+    def bucket(self, b):
+        start, end = struct.unpack_from('<QQ', self.mm, self.starts_off+8*b)
+        out = []
+        for k in range(start, end):
+            i, v = struct.unpack_from('<II', self.mm, self.pairs_off+8*k)
+            out.append([self.name(i), self.versions(i)[v][0]])
+        return out
+
+class LazyFiles(collections.abc.MutableMapping):
+    '''PyOneFS.files backed by a MetaImage, used the same way as the dict of dicts.  Names are looked up
+in the image when they are used, and everything written since the image was made is kept in the
+overlay dicts on top of it.'''
+    def __init__(self, image, overlay=None):
+        self.image = image
+        self.overlay = {} if overlay==None else overlay
+    def copy(self):
+        return LazyFiles(self.image, {k:dict(v) for k, v in self.overlay.items()})
+    def image_versions(self, name):
+        i = self.image.find(name)
+        if i==-1:
+            return []
+        return self.image.versions(i)
+    def plain(self, name):
+        '''returns the versions of name as a dict.'''
+        out = dict(self.image_versions(name))
+        out.update(self.overlay.get(name, {}))
+        return out
+    def new_names(self):
+        '''yields the names that are not in the image.'''
+        for name in list(self.overlay.keys()):
+            if self.image.find(name)==-1:
+                yield name
+    def sorted_names(self):
+        return heapq.merge(self.image.irange(''), sorted(self.new_names()))
+    def __getitem__(self, name):
+        if not name in self:
+            raise KeyError(name)
+        return LazyVersions(self, name)
+    def __setitem__(self, name, versions):
+        self.overlay[name] = dict(versions)
+    def __delitem__(self, name):
+        raise Exception("Names can't be removed from a metadata image")
+    def __contains__(self, name):
+        return name in self.overlay or self.image.find(name)!=-1
+    def __iter__(self):
+        for i in range(self.image.count):
+            yield self.image.name(i)
+        for name in self.new_names():
+            yield name
+    def __len__(self):
+        return self.image.count+sum(1 for i in self.new_names())
+
+class LazyVersions(collections.abc.MutableMapping):
+    '''The versions of one name in a LazyFiles, used like the inner dicts of PyOneFS.files.'''
+    def __init__(self, files, name):
+        self.files = files
+        self.name = name
+    def __getitem__(self, vec):
+        over = self.files.overlay.get(self.name)
+        if over!=None and vec in over.keys():
+            return over[vec]
+        for k, v in self.files.image_versions(self.name):
+            if k==vec:
+                return v
+        raise KeyError(vec)
+    def __setitem__(self, vec, data):
+        overlay = self.files.overlay
+        if self.name in overlay.keys():
+            overlay[self.name][vec] = data
+        else:
+            overlay[self.name] = {vec:data}
+    def __delitem__(self, vec):
+        raise Exception("Versions can't be removed from a metadata image")
+    def __contains__(self, vec):
+        try:
+            self[vec]
+            return True
+        except KeyError:
+            return False
+    def __iter__(self):
+        return iter(self.files.plain(self.name))
+    def __len__(self):
+        return len(self.files.plain(self.name))
+
+class LazyNames:
+    '''Sorted names of a LazyFiles: the names in the image merged with the names added since, which are
+kept in added (a SortedKeys).'''
+    def __init__(self, image, added):
+        self.image = image
+        self.added = added
+    def __len__(self):
+        return self.image.count+len(self.added)
+    def __contains__(self, name):
+        return name in self.added or self.image.find(name)!=-1
+    def add(self, name):
+        if self.image.find(name)==-1:
+            self.added.add(name)
+    def irange(self, start, stop=None):
+        return heapq.merge(self.image.irange(start, stop), self.added.irange(start, stop))
+    def prefixed(self, prefix):
+        for k in self.irange(prefix):
+            if not k.startswith(prefix):
+                return
+            yield k
+
+class ChangeLogFile:
+    '''The change log of a PyOneFS.  The entries stay in fschanges.log and are read back when peers ask for
+them, only the offset of every CHECKPOINT-th change is kept in memory.'''
+    def __init__(self, path, length=0, end=0, checkpoints=()):
+        self.path = path
+        self.length = length
+        self.end = end
+        self.checkpoints = array.array('Q', checkpoints)
+    def scan(self):
+        '''reads the changes after end, returns them.  A torn line at the end of the file is cut off.'''
+        out = []
+        if not os.path.isfile(self.path):
+            return out
+        with open(self.path, 'rb') as f:
+            f.seek(self.end)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                out.append(entry)
+                self.__count__(len(line))
+        if os.path.getsize(self.path)>self.end:
+            os.truncate(self.path, self.end)
+        return out
+    def count(self):
+        '''counts the changes after end without reading them.  A torn line at the end of the file is cut off.'''
+        if not os.path.isfile(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self.end)
+            lines = f.read().split(b'\n')
+        # the last piece is a torn line, or empty
+        del lines[-1]
+        # line i starts after i newlines and the lines before it
+        sums = list(itertools.accumulate(map(len, lines), initial=0))
+        for i in range((-self.length)%CHECKPOINT, len(lines), CHECKPOINT):
+            self.checkpoints.append(self.end+sums[i]+i)
+        self.length+=len(lines)
+        self.end+=sums[-1]+len(lines)
+        if os.path.getsize(self.path)>self.end:
+            os.truncate(self.path, self.end)
+    def __count__(self, n):
+        if self.length%CHECKPOINT==0:
+            self.checkpoints.append(self.end)
+        self.length+=1
+        self.end+=n
+    def append(self, entry):
+        # the line is written by PyOneFS, only its length is needed here
+        self.__count__(len(json.dumps(entry))+1)
+    def __len__(self):
+        return self.length
+    def __read__(self, start, stop):
+        out = []
+        if start>=stop:
+            return out
+        with open(self.path, 'rb') as f:
+            f.seek(self.checkpoints[start//CHECKPOINT])
+            i = start-start%CHECKPOINT
+            for line in f:
+                if i>=stop:
+                    break
+                if i>=start:
+                    out.append(json.loads(line))
+                i+=1
+        return out
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.__read__(*i.indices(self.length)[:2])
+        if i<0:
+            i+=self.length
+        return self.__read__(i, i+1)[0]
+    def __iter__(self):
+        return iter(self.__read__(0, self.length))
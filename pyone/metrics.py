@@ -0,0 +1,92 @@
+import time, json, logging, bisect, _thread
+
+# a latency is counted in the first bucket it is below, 10us doubling up to about 40 s
+BUCKETS = [1e-5*(1<<i) for i in range(22)]
+
+class Histogram:
+    '''Number of values per bucket, with their count, sum and maximum.'''
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0]*(len(buckets)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)]+=1
+        self.count+=1
+        self.total+=value
+        if value>self.max:
+            self.max = value
+    def quantile(self, q):
+        '''returns the upper bound of the bucket holding the q quantile, the maximum for the last bucket.'''
+        rank = q*self.count
+        seen = 0
+        for i in range(len(self.counts)):
+            seen+=self.counts[i]
+            if seen>=rank and seen>0:
+                return self.buckets[i] if i<len(self.buckets) else self.max
+        return 0.0
+    def snapshot(self):
+        return {'count':self.count, 'sum':self.total, 'mean':self.total/self.count if self.count>0 else 0.0,
+                'max':self.max, 'p50':self.quantile(.5), 'p99':self.quantile(.99),
+                'buckets':{str(self.buckets[i]) if i<len(self.buckets) else 'inf':self.counts[i] for i in range(len(self.counts)) if self.counts[i]>0}}
+
+class Metrics:
+    '''Counters and latency histograms of a node, shared by its filesystem and Manager.
+Every function in hooks is called with (kind, name, value) as values come in, kind being 'count' for
+counters and 'time' for latencies in seconds, so they can be passed on without polling snapshot().'''
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.hooks = []
+        self.lock = _thread.allocate_lock()
+        self.started = time.time()
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0)+n
+        for hook in self.hooks:
+            hook('count', name, n)
+    def observe(self, name, seconds):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h==None:
+                h = self.histograms[name] = Histogram()
+            h.add(seconds)
+        for hook in self.hooks:
+            hook('time', name, seconds)
+    def addHook(self, func):
+        self.hooks.append(func)
+    def removeHook(self, func):
+        self.hooks.remove(func)
+    def snapshot(self):
+        '''returns {'uptime', 'counters':{name: n}, 'latency':{name: histogram snapshot}}.'''
+        with self.lock:
+            return {'uptime':time.time()-self.started, 'counters':dict(self.counters),
+                    'latency':{k:v.snapshot() for k, v in self.histograms.items()}}
+
+# the attributes every LogRecord has, the others were passed in extra and are written out as fields
+RECORD_FIELDS = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__.keys())|{'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    '''Writes every record as one JSON object, with the fields passed in extra.'''
+    def format(self, record):
+        out = {'time':record.created, 'level':record.levelname, 'logger':record.name, 'msg':record.getMessage()}
+        for k, v in record.__dict__.items():
+            if not k in RECORD_FIELDS:
+                out[k] = v
+        if record.exc_info:
+            out['exc'] = self.formatException(record.exc_info)
+        return json.dumps(out, default=str)
+
+def enable_logging(level=logging.INFO, structured=False, stream=None):
+    '''sends what the pyone modules log at level or above to stream (stderr if None), as JSON lines if
+structured is True.  Returns the handler, which can be removed from logging.getLogger('pyone') again.'''
+    handler = logging.StreamHandler(stream)
+    if structured:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger = logging.getLogger('pyone')
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
@@ -0,0 +1,64 @@
+import hashlib, bisect, copy
+
+# points every node gets on the ring, more of them spread the entries more evenly over the nodes
+VNODES = 64
+
+def point(key):
+    '''returns where the string key is on the ring, a 64-bit int.'''
+    return int.from_bytes(hashlib.sha1(key.encode()).digest()[:8], 'big')
+
+class Ring:
+    '''Consistent hashing of entries onto nodes.  Every node is put on a ring of 64-bit points vnodes times,
+and an entry is kept by the first replicas distinct nodes found going round the ring from its own point, so
+adding or removing a node only moves the entries next to its points.
+Nodes are added and removed by one thread, owners can be asked from any: the points are replaced as a
+whole, never changed in place.'''
+    def __init__(self, nodes=(), replicas=3, vnodes=VNODES):
+        self.replicas = replicas
+        self.vnodes = vnodes
+        self.nodes = set()
+        # (sorted points, node at each point)
+        self.state = ([], [])
+        for i in nodes:
+            self.add(i)
+    def add(self, node):
+        '''puts node on the ring, returns False if it was there already.'''
+        if node in self.nodes:
+            return False
+        self.nodes = self.nodes|{node}
+        self.__rebuild__()
+        return True
+    def remove(self, node):
+        '''takes node off the ring, returns False if it wasn't there.'''
+        if not node in self.nodes:
+            return False
+        self.nodes = self.nodes-{node}
+        self.__rebuild__()
+        return True
+    def __rebuild__(self):
+        ring = sorted((point(node+'#'+str(i)), node) for node in self.nodes for i in range(self.vnodes))
+        self.state = ([p for p, node in ring], [node for p, node in ring])
+    def owners(self, ident):
+        '''returns the nodes that keep the entry ident, at most replicas of them.'''
+        points, at = self.state
+        if len(points)==0:
+            return []
+        count = min(self.replicas, len(set(at)))
+        i = bisect.bisect(points, point(ident[0]+':'+ident[1]))
+        out = []
+        while len(out)<count:
+            node = at[i%len(at)]
+            if not node in out:
+                out.append(node)
+            i+=1
+        return out
+    def copy(self):
+        '''returns a ring with the nodes this one has now, it doesn't change with this one.'''
+        # nodes and state are replaced on every change, so they can be shared
+        return copy.copy(self)
+    def owns(self, node, ident):
+        return node in self.owners(ident)
+    def __contains__(self, node):
+        return node in self.nodes
+    def __len__(self):
+        return len(self.nodes)
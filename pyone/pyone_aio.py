@@ -0,0 +1,167 @@
+import asyncio, ssl, _thread, logging
+from . import pyone_net
+log = logging.getLogger(__name__)
+
+class AsyncManager(pyone_net.Manager):
+    '''Manager that runs every peer on a single asyncio event loop instead of polling them.
+Peers are only touched when their socket has data, so idle peers cost nothing and messages are
+handled as soon as they arrive.  Uses the same wire protocol and FsChangeListener hooks as Manager.'''
+    def start(self, serve, adr, port):
+        self.loop = asyncio.new_event_loop()
+        self.loop_thread = None
+        self.rebalance_timer = None
+        started = _thread.allocate_lock()
+        started.acquire()
+        _thread.start_new_thread(self.__loop__, (started,))
+        started.acquire()
+        # the peers are only touched from the event loop, so finished signature checks are handed to it
+        self.verifier.on_done = lambda: self.loop.call_soon_threadsafe(self.collectVerified)
+        if self.push_interval>0:
+            self.loop.call_soon_threadsafe(self.__push_timer__)
+        if self.gossip_fanout>0:
+            self.loop.call_soon_threadsafe(self.loop.call_later, self.gossip_interval, self.__anti_entropy_timer__)
+        if serve:
+            coro = asyncio.start_server(self.__accept__, adr, port, ssl=self.context)
+            self.server = asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.__close__(), self.loop).result()
+        self.fs.listeners.remove(self)
+        self.verifier.close()
+        self.chunker.shutdown(cancel_futures=True)
+        self.balancer.shutdown(cancel_futures=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.stopped.acquire()
+    async def __close__(self):
+        self.running = False
+        self.reconnect = False
+        if self.server!=None:
+            self.server.close()
+        for i in list(self.peers):
+            i.close()
+            self.removePeer(i)
+        # the tasks of the peers and connections still going, the loop is stopped right after this
+        tasks = [i for i in asyncio.all_tasks(self.loop) if i is not asyncio.current_task()]
+        for i in tasks:
+            i.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    def __loop__(self, started):
+        asyncio.set_event_loop(self.loop)
+        self.loop_thread = _thread.get_ident()
+        started.release()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.stopped.release()
+    def __push_timer__(self):
+        if not self.running:
+            return
+        self.loop.call_later(self.push_interval, self.__push_timer__)
+        pushes = self.takePushes()
+        if len(pushes)>0 and self.gossip_fanout>0:
+            self.announceLocal(pushes)
+        for i in list(self.peers):
+            if len(pushes)>0 and self.pushesTo(i):
+                self.pushTo(i, pushes)
+    def __anti_entropy_timer__(self):
+        if not self.running:
+            return
+        self.loop.call_later(self.gossip_interval, self.__anti_entropy_timer__)
+        self.antiEntropy()
+    def call(self, func, *args):
+        '''runs func on the event loop thread, the peers may only be touched from there.'''
+        if _thread.get_ident()==self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+    def connectPeer(self, ip):
+        links = self.linksTo(ip)
+        for link in links[1:]:
+            self.loop.call_soon_threadsafe(self.__reconnect__, link)
+        asyncio.run_coroutine_threadsafe(self.__connect__(links[0]), self.loop).result()
+    def __reconnect__(self, link):
+        self.loop.create_task(self.__connect__(link, False))
+    def __retry_after__(self, link, delay):
+        self.call(self.loop.call_later, delay, self.__retry__, link)
+    def __rebalance_after__(self, delay):
+        self.call(self.__schedule_rebalance__, delay)
+    def __schedule_rebalance__(self, delay):
+        # a later change to the ring puts the rebalance off again
+        if self.rebalance_timer!=None:
+            self.rebalance_timer.cancel()
+        self.rebalance_timer = self.loop.call_later(delay, self.rebalance)
+    def __retry__(self, link):
+        if link.retry_at!=None:
+            link.retry_at = None
+            self.__reconnect__(link)
+    async def __connect__(self, link, raise_errors=True):
+        # asyncio can't resume TLS sessions, so every connection costs a full handshake here
+        try:
+            reader, writer = await asyncio.open_connection(link.ip, self.port, ssl=self.context)
+        except OSError:
+            self.reconnectLater(link)
+            if raise_errors:
+                raise
+            return
+        self.link_stats['connects']+=1
+        link.failures = 0
+        log.info("connected to %s (stream %d)", link.ip, link.stream, extra={'event':'connect', 'peer':link.ip, 'stream':link.stream, 'resumed':False})
+        self.loop.create_task(self.__run_peer__(reader, writer, link))
+    async def __accept__(self, reader, writer):
+        adr = writer.get_extra_info('peername')
+        log.info("incoming connection from %s", adr[0], extra={'event':'accept', 'peer':adr[0]})
+        await self.__run_peer__(reader, writer)
+    async def __run_peer__(self, reader, writer, link=None):
+        peer = AsyncPeer(reader, writer, self)
+        self.peers.append(peer)
+        if link!=None:
+            peer.setLink(link)
+            peer.sendHello()
+        try:
+            while True:
+                data = await reader.read(65536)
+
+                # data will be empty if the socket was closed by the remote
+                if data==b'':
+                    break
+                peer.feed(data)
+                self.verifier.flush()
+        except (ssl.SSLError, ConnectionError):
+            pass
+        finally:
+            self.removePeer(peer)
+            peer.close()
+
+class AsyncPeer(pyone_net.Peer):
+    def __init__(self, reader, writer, manager):
+        pyone_net.Peer.__init__(self, writer.get_extra_info('ssl_object'), manager)
+        self.reader = reader
+        self.writer = writer
+        self.draining = False
+    def close(self):
+        self.live = False
+        self.writer.close()
+        self.__close_files__()
+    def __kick__(self):
+        # may be called from the application thread (pushes), so the writes are done on the event loop
+        if not self.corked:
+            self.man.call(self.pump)
+    def __try_write__(self, data):
+        # the transport buffers whatever it is given, so it only gets more once it is below a chunk
+        if self.writer.is_closing():
+            # the connection was closed, what's left is dropped
+            return len(data)
+        if self.writer.transport.get_write_buffer_size()>=self.man.chunk_size:
+            if not self.draining:
+                self.draining = True
+                self.man.loop.create_task(self.__drain__())
+            return 0
+        self.writer.write(bytes(data))
+        return len(data)
+    async def __drain__(self):
+        try:
+            await self.writer.drain()
+        except ConnectionError:
+            return
+        finally:
+            self.draining = False
+        self.pump()
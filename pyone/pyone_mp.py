@@ -0,0 +1,246 @@
+import os, time, _thread, logging, multiprocessing, collections
+from . import pyonefs, pyone_net, metrics
+log = logging.getLogger(__name__)
+
+# a worker sends the owner its stats this often, in seconds
+STATS_INTERVAL = 1
+
+class Worker:
+    '''A worker process as the owner sees it: the pipe to it, what it has to push to its peers and the
+stats it sent last.'''
+    def __init__(self, index, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = _thread.allocate_lock()
+        self.pushes = []
+        self.sync = False
+        self.stats = None
+
+class PreforkManager(pyone_net.Manager):
+    '''Manager that serves the peers connecting to it from worker processes, so reading files, TLS and
+JSON for many peers run on every core instead of behind one networking thread.
+The workers are forked when the Manager starts and all accept from the same listening socket, the kernel
+spreads the connections over them.  Each one serves from a ReplicaFS: the metadata as it was when it was
+forked, kept up to date with the changes of the owner every refresh seconds.  File data is read and
+written by the workers directly, every change to the metadata is made by this process (the owner), which
+also keeps the connections opened with connectPeer.  Files written here are pushed to the peers of the
+workers too.
+Everything open in the process is inherited by the workers, so create it before connecting to anything.
+The other keyword arguments go to the Manager of the owner and of every worker.'''
+    def __init__(self, fs, workers=None, refresh=.1, **kwargs):
+        if fs.image!=None:
+            raise Exception("Worker processes can't share a lazily loaded filesystem")
+        if not 'fork' in multiprocessing.get_all_start_methods():
+            raise Exception("Worker processes need fork")
+        if kwargs.get('replicas', 0)>0:
+            raise Exception("Placement needs every peer on the same Manager")
+        self.worker_count = os.cpu_count() if workers==None else workers
+        self.refresh = refresh
+        self.options = dict(kwargs)
+        self.workers = []
+        pyone_net.Manager.__init__(self, fs, **kwargs)
+    def start(self, serve, adr, port):
+        if serve and self.worker_count>0:
+            sok = self.listen(adr, port)
+            # shut down by close(), which stops the workers accepting
+            self.server = sok
+            context = multiprocessing.get_context('fork')
+            for i in range(self.worker_count):
+                self.__fork__(context, i, sok)
+        elif serve:
+            self.acceptFrom(self.listen(adr, port))
+        _thread.start_new_thread(self.__peerupdate__, ())
+    def __fork__(self, context, index, sok):
+        conn, child = context.Pipe()
+        process = context.Process(target=self.__worker__, args=(index, sok, child, conn), daemon=True)
+        fs = self.fs
+        # the worker gets the metadata as it is between two changes, with nothing left in the buffers of the
+        # files it inherits
+        with fs.commit_lock, fs.lock:
+            fs.changes.flush()
+            if fs.journal!=None:
+                fs.journal.flush()
+            process.start()
+        child.close()
+        w = Worker(index, process, conn)
+        self.workers.append(w)
+        _thread.start_new_thread(self.__serve_worker__, (w,))
+    def close(self):
+        pyone_net.Manager.close(self)
+        for w in self.workers:
+            w.process.terminate()
+            w.process.join()
+    def sync(self):
+        pyone_net.Manager.sync(self)
+        for w in self.workers:
+            w.sync = True
+    def push_fs_change_to_peers(self, ident):
+        for w in self.workers:
+            with w.lock:
+                w.pushes.append(ident)
+        pyone_net.Manager.push_fs_change_to_peers(self, ident)
+    def stats(self):
+        '''returns the stats of the owner, with the last ones every worker sent as 'workers'.'''
+        out = pyone_net.Manager.stats(self)
+        out['workers'] = [w.stats for w in self.workers]
+        return out
+    def __serve_worker__(self, w):
+        # runs the calls of one worker, each answer has the changes it hasn't seen yet
+        try:
+            while True:
+                try:
+                    op, args, seq = w.conn.recv()
+                except (EOFError, OSError):
+                    break
+                try:
+                    result = self.__run__(w, op, args)
+                    ok = True
+                except Exception as e:
+                    result = e
+                    ok = False
+                w.conn.send((ok, result, self.fs.changes_since(seq)))
+        except OSError:
+            pass
+        finally:
+            w.conn.close()
+            if self.running:
+                log.warning("worker %d stopped", w.index, extra={'event':'worker_lost', 'worker':w.index})
+    def __run__(self, w, op, args):
+        if op=='refresh':
+            if args[0]!=None:
+                w.stats = args[0]
+            with w.lock:
+                pushes = w.pushes
+                w.pushes = []
+                sync = w.sync
+                w.sync = False
+            return pushes, dict(self.fs.remote_seqs), sync
+        elif op=='flush':
+            # the worker goes on once the changes it made are durable
+            self.fs.flush().result()
+        elif op=='claim':
+            return self.receiving.claim(tuple(args[0]))
+        elif op=='claimed':
+            return tuple(args[0]) in self.receiving
+        elif op=='discard':
+            self.receiving.discard(tuple(args[0]))
+        elif op=='receiving':
+            return len(self.receiving)
+        elif op in ['set_entry', 'wr_entry', 'try_create_entry', 'set_remote_seq', 'wrote_data']:
+            return getattr(self.fs, op)(*args)
+        else:
+            raise Exception("Unknown call from worker: "+str(op))
+    def __worker__(self, index, sok, conn, owner):
+        # runs in the forked process.  The owner's ends of the pipes are closed here, so the pipe breaks once
+        # the owner is gone.
+        owner.close()
+        for w in self.workers:
+            w.conn.close()
+        fs = ReplicaFS(self.fs, conn)
+        options = dict(self.options)
+        options['serve'] = False
+        options['reconnect'] = False
+        man = pyone_net.Manager(fs, **options)
+        man.receiving = OwnerClaims(fs)
+        man.acceptFrom(sok)
+        sent = 0
+        try:
+            while True:
+                time.sleep(self.refresh)
+                stats = None
+                if time.time()-sent>=STATS_INTERVAL:
+                    sent = time.time()
+                    stats = man.stats()
+                    stats['worker'] = index
+                    stats['pid'] = os.getpid()
+                pushes, seqs, sync = fs.call('refresh', stats)
+                fs.remote_seqs = seqs
+                for ident in pushes:
+                    man.push_fs_change_to_peers(ident)
+                if sync:
+                    man.sync()
+        except ConnectionError:
+            # the owner is gone
+            pass
+        finally:
+            # the listening socket is shared with the other workers, shutting it down would stop them too
+            man.server = None
+            sok.close()
+            man.close()
+
+class ReplicaFS(pyonefs.PyOneFS):
+    '''The filesystem of a worker process.  It starts as the copy of the owner's PyOneFS that the worker was
+forked with, and every call to the owner brings back the changes made since, which are applied in the order
+of the owner's change log so sequence numbers mean the same here.  Metadata changes are sent to the owner,
+nothing is written to the metadata files from here.'''
+    def __init__(self, fs, conn):
+        self.__dict__.update(fs.__dict__)
+        # the locks may have been held by other threads of the owner, which don't exist here
+        self.lock = _thread.allocate_lock()
+        self.commit_lock = _thread.allocate_lock()
+        self.metrics = metrics.Metrics()
+        self.listeners = []
+        for fd in self.unsynced.values():
+            if fd!=None:
+                os.close(fd)
+        self.unsynced = {}
+        self.committer = None
+        self.changes = open(os.devnull, 'w')
+        # the owner's change log file isn't written in step with this one, so the worker keeps it in memory
+        self.changelog = list(fs.changelog)
+        if self.journal!=None:
+            self.journal = open(os.devnull, 'w')
+        # nothing is committed from here, so journal records are dropped rather than kept for a commit
+        self.journal_lines = collections.deque(maxlen=0)
+        self.conn = conn
+        self.conn_lock = _thread.allocate_lock()
+    def call(self, op, *args):
+        '''runs op on the owner and returns its result, once the changes the owner has are applied here.'''
+        with self.conn_lock:
+            try:
+                self.conn.send((op, args, self.seq))
+                ok, result, changes = self.conn.recv()
+            except (EOFError, OSError):
+                raise ConnectionError("Owner process is gone")
+            with self.lock:
+                for name, vec, data in changes:
+                    self.__set_entry__(name, vec, data)
+        if not ok:
+            raise result
+        return result
+    def set_entry(self, ident, data):
+        self.call('set_entry', ident, data)
+    def wr_entry(self, name, data):
+        ident = self.call('wr_entry', name, data)
+        if data!=None:
+            for i in self.listeners:
+                i.onEntryCreate(self, ident, data)
+        return ident
+    def try_create_entry(self, ident, data):
+        return self.call('try_create_entry', ident, data)
+    def set_remote_seq(self, node, seq):
+        self.call('set_remote_seq', node, seq)
+        self.remote_seqs[node] = seq
+    def wrote_data(self, path, f=None):
+        self.call('wrote_data', path)
+    def flush(self):
+        self.call('flush')
+        return pyonefs.done_future()
+    def close(self):
+        self.changes.close()
+        if self.journal!=None:
+            self.journal.close()
+
+class OwnerClaims:
+    '''The Claims of the owner, for the Manager of a worker, so no two processes receive the same entry.'''
+    def __init__(self, fs):
+        self.fs = fs
+    def claim(self, key):
+        return self.fs.call('claim', key)
+    def discard(self, key):
+        self.fs.call('discard', key)
+    def __contains__(self, key):
+        return self.fs.call('claimed', key)
+    def __len__(self):
+        return self.fs.call('receiving')
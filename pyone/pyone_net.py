@@ -1,20 +1,123 @@
-import socket, _thread, ecdsa, json, math, ssl, os, time
-from . import pyonefs
+import socket, _thread, ecdsa, json, ssl, os, io, select, time, collections, functools, hashlib, codecs, re, random
+import concurrent.futures, logging
+from . import pyonefs, compactfiles, compression, placement
+log = logging.getLogger(__name__)
 COMMAND_SIGNED_FLAG = 128
 
 COMMAND_PUSH_FS_CHANGE = 0
 COMMAND_GET_FS_JSON = 1
 COMMAND_RETURN_FS_JSON = 2
 COMMAND_GET_FILE = 3
+COMMAND_GET_CHANGES = 4
+COMMAND_RETURN_CHANGES = 5
+COMMAND_GET_TREE = 6
+COMMAND_RETURN_TREE = 7
+COMMAND_GET_BUCKETS = 8
+COMMAND_RETURN_BUCKETS = 9
+COMMAND_PUSH_MANIFEST = 10
+COMMAND_GET_CHUNKS = 11
+COMMAND_PUSH_CHUNK = 12
+COMMAND_FRAMED = 13
+COMMAND_ANNOUNCE = 14
+COMMAND_DATA_OPEN = 15
+COMMAND_DATA = 16
+COMMAND_WINDOW = 17
+COMMAND_DATA_END = 18
+COMMAND_OFFER = 19
+COMMAND_STORED = 20
+COMMAND_MISSING = 21
 
 cmd_strs = {
     -1:'IDLE',
     0:'COMMAND_PUSH_FS_CHANGE',
     1:'COMMAND_GET_FS_JSON',
     2:'COMMAND_RETURN_FS_JSON',
-    3:'COMMAND_GET_FILE'
+    3:'COMMAND_GET_FILE',
+    4:'COMMAND_GET_CHANGES',
+    5:'COMMAND_RETURN_CHANGES',
+    6:'COMMAND_GET_TREE',
+    7:'COMMAND_RETURN_TREE',
+    8:'COMMAND_GET_BUCKETS',
+    9:'COMMAND_RETURN_BUCKETS',
+    10:'COMMAND_PUSH_MANIFEST',
+    11:'COMMAND_GET_CHUNKS',
+    12:'COMMAND_PUSH_CHUNK',
+    13:'COMMAND_FRAMED',
+    14:'COMMAND_ANNOUNCE',
+    15:'COMMAND_DATA_OPEN',
+    16:'COMMAND_DATA',
+    17:'COMMAND_WINDOW',
+    18:'COMMAND_DATA_END',
+    19:'COMMAND_OFFER',
+    20:'COMMAND_STORED',
+    21:'COMMAND_MISSING'
 }
 
+# these commands carry a 4-byte length followed by that much JSON
+JSON_COMMANDS = [COMMAND_GET_TREE, COMMAND_RETURN_TREE, COMMAND_GET_BUCKETS, COMMAND_RETURN_BUCKETS,
+                 COMMAND_PUSH_MANIFEST, COMMAND_GET_CHUNKS, COMMAND_ANNOUNCE, COMMAND_DATA_OPEN, COMMAND_OFFER,
+                 COMMAND_STORED, COMMAND_MISSING]
+
+
+# The hello is sent as a COMMAND_RETURN_FS_JSON holding a single name without any versions.  Peers that
+# don't know about it compare it to their filesystem and ignore it, then ask for our full JSON like they
+# always did.  The name carries our node id, change sequence number and capabilities.
+HELLO_PREFIX = '\x00pyone:'
+CAPABILITIES = ['delta', 'tree', 'gossip', 'mux', 'resume', 'placement', 'signed_streams']
+
+# COMMAND_FRAMED is sent on its own once the hello of the peer listed a codec we have.  Everything sent after
+# it is cut into frames that are compressed when that pays off, see compression.  Peers that don't list any
+# codecs never see it.
+
+# Files pushed to peers listing 'mux' go out as streams, so they can be interleaved with each other and with
+# the other messages.  COMMAND_DATA_OPEN carries [stream id, ident, data, epath, size] as JSON, then the file
+# follows in COMMAND_DATA pieces of stream id (4 bytes), length (4 bytes) and data.  The sender may be at most
+# MUX_WINDOW bytes of a stream ahead of the receiver, which hands out more with COMMAND_WINDOW, stream id
+# (4 bytes) and byte count (4 bytes), as it writes what arrived.
+MUX_WINDOW = 1<<20
+# Peers listing 'resume' also follow the last piece of a stream with COMMAND_DATA_END, stream id (4 bytes) and
+# the sha256 of the whole file (32 bytes), and the file is only kept if it matches.  They accept
+# COMMAND_GET_FILE for [name, id, offset], and then send the file from offset on, with the offset added to
+# COMMAND_DATA_OPEN.  Files are received into a .part file, so the part that arrived before a connection
+# dropped is only requested again from the end of the .part.
+
+# Nodes with a key pair stream files to peers listing 'signed_streams' too.  Their COMMAND_DATA_OPEN carries
+# [stream id, ident, data, epath, size, offset, sha256 of the whole file as hex] and is signed, the pieces aren't:
+# the file is only kept if it matches the signed sha256.  Other peers get the file in one signed message.
+
+# commands taken unsigned from peers even when signatures are required, the switch to frames carries nothing
+# and the pieces of a stream are covered by the signed sha256 of its COMMAND_DATA_OPEN
+UNSIGNED_COMMANDS = [COMMAND_FRAMED, COMMAND_DATA, COMMAND_DATA_END]
+
+# size of the COMMAND_DATA pieces, a message queued behind a file waits for one piece at most
+MUX_PIECE = 1<<16
+# number of files streamed to a peer at once, the rest wait their turn
+MUX_STREAMS = 8
+
+# a node that is further behind than this compares hash trees instead of asking for every change
+TREE_SYNC_THRESHOLD = 10000
+
+# number of tree levels skipped on every round trip when comparing hash trees
+TREE_STRIDE = 4
+
+# Nodes whose hellos list the same 'replicas' keep the data of every entry on that many of them, see Manager.
+# COMMAND_OFFER carries [[name, id, data]] as JSON, entries the sender has the data of.  The receiver records
+# them, fetches the data of the ones it keeps, and answers COMMAND_STORED with the [name, id] of those it has
+# the data of so the sender can drop its copy.  Peers listing 'placement' answer COMMAND_GET_FILE for data
+# they don't have with COMMAND_MISSING [[name, id]], and the file is requested from another peer.
+
+# seconds to wait after the ring changed before moving data, so nodes joining together move it once
+REBALANCE_DELAY = 1
+
+# most entries offered in one COMMAND_OFFER
+OFFER_BATCH = 1000
+
+# number of announced entries remembered to stop announcements from going around in circles
+GOSSIP_SEEN = 100000
+
+# seconds a peer gets to connect and finish the TLS handshake
+HANDSHAKE_TIMEOUT = 10
+
 DEFAULT_PORT = 1152
 
 class KeyPair:
@@ -28,213 +131,1966 @@ class KeyPair:
     def sign(self, data):
         return self.sk.get_verifying_key().to_string() + self.sk.sign(data)
 
-def testSignedMessage(msg):
+def parseKey(pubkey):
+    '''parses a public key we have no tables for, see verifyingKey.'''
+    return ecdsa.VerifyingKey.from_string(pubkey, curve=ecdsa.SECP256k1)
+
+@functools.lru_cache(maxsize=1024)
+def verifyingKey(pubkey):
+    '''parses a trusted public key.  Cached, since the same few keys sign nearly every message.  Only for keys
+from trusted_keys: the tables take a while to build, and any peer can send any number of other keys.'''
+    curve = ecdsa.SECP256k1
+    point = parseKey(pubkey).pubkey.point
+    # tables for this key make every later verify faster, they need a point that knows the curve order
+    point = ecdsa.ellipticcurve.PointJacobi(curve.curve, point.x(), point.y(), 1, curve.order, generator=True)
+    vk = ecdsa.VerifyingKey.from_public_point(point, curve=curve)
+    vk.precompute()
+    return vk
+
+def testSignedMessage(msg, trusted=False):
     'returns (verified:bool, public key:bytes)'
     if len(msg)<132:
         return False, None
     data = msg[132:132+int.from_bytes(msg[128:132], 'little')]
-    vk = ecdsa.VerifyingKey.from_string(msg[:64], curve=ecdsa.SECP256k1)
+    vk = (verifyingKey if trusted else parseKey)(bytes(msg[:64]))
     return vk.verify(msg[64:128], data), msg[:64]
 
+def verifyBatch(batch):
+    '''checks a list of (public key, signature, sha1 digest of the data, whether the key is trusted), returns a
+list of bools.  Runs in the verifier processes, so it only gets the digests and not the messages.'''
+    out = []
+    for pubkey, sig, digest, trusted in batch:
+        try:
+            vk = (verifyingKey if trusted else parseKey)(pubkey)
+            out.append(vk.verify_digest(sig, digest))
+        except Exception:
+            # bad signatures, malformed keys and malformed signatures all raise
+            out.append(False)
+    return out
+
+class SignatureVerifier:
+    '''Checks the signatures of signed messages in batches on a process pool, so the ECDSA math stays off
+the networking thread and runs on every core.  Messages are queued with submit and sent to the pool
+every batch_size messages or on flush.  Finished batches are picked up with collect, from the thread
+that owns the peers.  on_done is called from the pool's thread when a batch finishes.
+workers=0 verifies on the calling thread instead.'''
+    def __init__(self, workers=None, batch_size=64, on_done=None):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.on_done = on_done
+        self.pool = None
+        self.batch = []
+        self.done = collections.deque()
+        self.stats = {'verified':0, 'failed':0, 'batches':0}
+    def submit(self, peer, entry, sig, trusted=False):
+        '''queues the check of entry, a [public key, data, result] list.  The result is filled in by collect.
+Only the keys of trusted entries are cached, see verifyingKey.'''
+        self.batch.append((peer, entry, (entry[0], sig, hashlib.sha1(entry[1]).digest(), trusted)))
+        if len(self.batch)>=self.batch_size:
+            self.flush()
+    def flush(self):
+        if len(self.batch)==0:
+            return
+        batch = self.batch
+        self.batch = []
+        self.stats['batches']+=1
+        if self.workers==0:
+            self.__done__(batch, verifyBatch([i[2] for i in batch]))
+            return
+        if self.pool==None:
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        fut = self.pool.submit(verifyBatch, [i[2] for i in batch])
+        fut.add_done_callback(lambda fut: self.__pool_done__(batch, fut))
+    def __pool_done__(self, batch, fut):
+        try:
+            results = fut.result()
+        except Exception:
+            # the pool broke, don't fail the messages because of it
+            results = verifyBatch([i[2] for i in batch])
+        self.__done__(batch, results)
+    def __done__(self, batch, results):
+        self.done.append((batch, results))
+        if self.on_done!=None:
+            self.on_done()
+    def collect(self):
+        '''fills in the results of the finished batches, returns the peers that got results.'''
+        peers = []
+        while len(self.done)>0:
+            batch, results = self.done.popleft()
+            for (peer, entry, check), ok in zip(batch, results):
+                entry[2] = ok
+                self.stats['verified' if ok else 'failed']+=1
+                if not peer in peers:
+                    peers.append(peer)
+        return peers
+    def close(self):
+        if self.pool!=None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
 verifier_cert = 'verify.pem'
 
+class SyncScheduler:
+    '''Fetches the entries found missing while syncing.  Every peer that has an entry gets it queued, and
+each peer keeps at most window requests outstanding, so entries are spread over all the peers that have
+them.  When a peer disconnects, its outstanding requests go to another peer that has them.'''
+    def __init__(self, window=16):
+        self.window = window
+        self.wanted = {}
+        self.inflight = {}
+        self.queues = {}
+        self.peer_inflight = {}
+        self.stats = {'requested':0, 'received':0, 'retried':0, 'failed':0, 'bytes':0}
+        self.started = None
+    def want(self, ident, peer):
+        '''queues a request for ident to peer, unless it is already being fetched from another peer.'''
+        key = tuple(ident)
+        if key in self.wanted.keys():
+            self.wanted[key].add(peer)
+        else:
+            self.wanted[key] = set([peer])
+        if not peer in self.queues.keys():
+            self.queues[peer] = collections.deque()
+            self.peer_inflight[peer] = set()
+        self.queues[peer].append(key)
+        if self.started==None:
+            self.started = time.time()
+        self.dispatch(peer)
+    def dispatch(self, peer):
+        queue = self.queues.get(peer)
+        while queue and len(self.peer_inflight[peer])<self.window:
+            key = queue.popleft()
+            # skip entries that arrived, are being fetched from another peer or turned out not to be on this one
+            if not key in self.wanted.keys() or key in self.inflight.keys() or not peer in self.wanted[key]:
+                continue
+            self.inflight[key] = peer
+            self.peer_inflight[peer].add(key)
+            self.stats['requested']+=1
+            peer.requestFileFromIdent(list(key))
+    def failed(self, ident):
+        '''gives up on an entry that arrived corrupt, it is found again on the next sync.'''
+        key = tuple(ident)
+        if self.wanted.pop(key, None)==None:
+            return
+        self.stats['failed']+=1
+        peer = self.inflight.pop(key, None)
+        if peer!=None:
+            self.peer_inflight[peer].discard(key)
+            self.dispatch(peer)
+    def missing(self, ident, peer):
+        '''called when peer doesn't have ident after all, it is requested from the other peers that have it.'''
+        key = tuple(ident)
+        if not key in self.wanted.keys():
+            return
+        self.wanted[key].discard(peer)
+        if self.inflight.get(key)==peer:
+            del self.inflight[key]
+            self.peer_inflight[peer].discard(key)
+        if len(self.wanted[key])==0:
+            del self.wanted[key]
+            self.stats['failed']+=1
+            if len(self.wanted)==0:
+                self.started = None
+        elif not key in self.inflight.keys():
+            self.stats['retried']+=1
+            for i in self.wanted[key]:
+                self.queues[i].appendleft(key)
+        for i in list(self.queues.keys()):
+            self.dispatch(i)
+    def received(self, ident, size):
+        key = tuple(ident)
+        if self.wanted.pop(key, None)==None:
+            return
+        self.stats['received']+=1
+        self.stats['bytes']+=size
+        peer = self.inflight.pop(key, None)
+        if peer!=None:
+            self.peer_inflight[peer].discard(key)
+            self.dispatch(peer)
+        if len(self.wanted)==0:
+            self.started = None
+    def peerLost(self, peer):
+        '''hands the requests of a disconnected peer to the other peers that have the entries.'''
+        queue = self.queues.pop(peer, [])
+        lost = self.peer_inflight.pop(peer, set())
+        retry = []
+        for key in list(queue)+list(lost):
+            if not key in self.wanted.keys():
+                continue
+            self.wanted[key].discard(peer)
+            if key in lost and key in self.inflight.keys():
+                # the key can be queued as well as in flight
+                del self.inflight[key]
+                retry.append(key)
+            if len(self.wanted[key])==0:
+                # nobody else has it, it will be found again on the next sync
+                del self.wanted[key]
+                self.stats['failed']+=1
+        for key in retry:
+            if key in self.wanted.keys():
+                self.stats['retried']+=1
+                for i in self.wanted[key]:
+                    self.queues[i].appendleft(key)
+        for i in list(self.queues.keys()):
+            self.dispatch(i)
+    def progress(self):
+        '''returns counters for the fetches so far, with the throughput of the current sync in bytes/s.'''
+        out = dict(self.stats)
+        out['pending'] = len(self.wanted)
+        out['inflight'] = len(self.inflight)
+        out['throughput'] = 0
+        if self.started!=None and time.time()>self.started:
+            out['throughput'] = self.stats['bytes']/(time.time()-self.started)
+        return out
+
+class Link:
+    '''An outbound connection that the Manager keeps up.  Holds the TLS session to resume and the backoff
+before the next attempt to reconnect.'''
+    def __init__(self, ip, stream=0):
+        self.ip = ip
+        self.stream = stream
+        self.session = None
+        self.peer = None
+        # node id of the peer, once it sent its hello
+        self.node = None
+        self.failures = 0
+        self.retry_at = None
+    def backoff(self, base, limit):
+        '''returns how long to wait before the next attempt, doubling with every failure.'''
+        delay = min(limit, base*(2**self.failures))
+        self.failures+=1
+        # jitter, so nodes that lost each other don't all come back at the same moment
+        return delay*random.uniform(.5, 1)
+
+class Transfer:
+    '''A file being sent to a peer.  Stream transfers go out in COMMAND_DATA pieces of stream sid, raw ones (to
+peers without 'mux') go out whole right after header, and nothing else can be sent until they are done.'''
+    def __init__(self, f, size, sid=None, header=b'', ident=None, digest=None):
+        self.f = f
+        self.size = size
+        self.left = size
+        self.sid = sid
+        self.header = header
+        self.window = MUX_WINDOW
+        self.ident = ident
+        # the sha256 of the file is worked out while it is sent if it isn't known yet
+        self.digest = digest
+        self.sha = hashlib.sha256() if digest==None else None
+        # set when a raw transfer to a peer reading frames goes out as one raw frame
+        self.unframed = False
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data)==0:
+            raise ConnectionError("File changed size while sending")
+        self.left-=len(data)
+        if self.sha!=None:
+            self.sha.update(data)
+        return data
+
+class Claims(set):
+    '''The entries being received.  claim checks and adds one in a single step, so two peers (or two worker
+processes) never receive the same entry at once.'''
+    def __init__(self):
+        set.__init__(self)
+        self.lock = _thread.allocate_lock()
+    def claim(self, key):
+        '''returns True if key wasn't claimed, and claims it.'''
+        with self.lock:
+            if key in self:
+                return False
+            self.add(key)
+            return True
+
+class IncomingFile:
+    '''A file being received from a peer.  The data goes to the .part file of the entry (see PyOneFS.open_part),
+which is put in place once the whole file is there and its sha256 matches.  Nothing is written if the entry
+has its data already, or if another peer is sending it at the same time.'''
+    def __init__(self, man, ident, data, size, offset=0, digest=None):
+        self.man = man
+        self.fs = man.fs
+        self.receiving = man.receiving
+        self.ident = ident
+        self.data = data
+        self.size = size
+        self.left = size-offset
+        # bytes written since the peer was last told to send more
+        self.unacked = 0
+        self.failed = False
+        self.f = None
+        self.sha = hashlib.sha256()
+        # the sha256 the sender signed, if it did
+        self.digest = digest
+        key = tuple(ident)
+        if self.fs.has_data(ident) or not self.receiving.claim(key):
+            return
+        if offset>0:
+            have = self.fs.part_size(ident)
+            if have==None or have<offset:
+                # the .part changed since we asked to resume, the entry is requested again on the next sync
+                self.receiving.discard(key)
+                self.failed = True
+                return
+            self.f = self.fs.open_part(ident, True)
+            # the hash covers the part that arrived before
+            for block in iter(lambda: self.f.read(min(1<<20, offset-self.f.tell())), b''):
+                self.sha.update(block)
+            self.f.truncate()
+        else:
+            self.f = self.fs.open_part(ident)
+    def write(self, data):
+        if self.f!=None:
+            self.f.write(data)
+            self.sha.update(data)
+        self.left-=len(data)
+    def finish(self, digest=None):
+        '''returns True if the data of the entry is in place.  If the file doesn't match digest it is dropped
+and failed is set.'''
+        if self.f==None:
+            return not self.failed and self.fs.has_data(self.ident)
+        if self.digest!=None:
+            # the signed sha256 is the one that counts
+            digest = self.digest
+        self.close()
+        if digest!=None and self.sha.hexdigest()!=digest:
+            self.fs.drop_part(self.ident)
+            self.failed = True
+            return False
+        self.fs.finish_part(self.ident)
+        if digest!=None:
+            self.fs.write_digest(self.ident, digest, self.size)
+        if self.fs.chunkstore!=None:
+            self.man.storeChunks(self.ident)
+        return True
+    def close(self):
+        # what arrived stays in the .part
+        if self.f!=None:
+            self.f.close()
+            self.receiving.discard(tuple(self.ident))
+
 class Manager(pyonefs.FsChangeListener):
-    def __init__(self, fs, serve = True, port = DEFAULT_PORT, adr = '0.0.0.0', certfile = 'certs/cert_01.crt', keyfile = 'certs/key_01.key'):
+    def __init__(self, fs, serve = True, port = DEFAULT_PORT, adr = '0.0.0.0', certfile = 'certs/cert_01.crt', keyfile = 'certs/key_01.key', chunk_size = 1<<20, sync_window = 16, push_interval = .05, keypair = None, trusted_keys = None, require_signed = False, verify_workers = None, verify_batch = 64, json_limit = 1<<22, compress = True, reconnect = True, reconnect_delay = 1, reconnect_max = 300, streams = 1, gossip_fanout = 0, gossip_interval = 5, cafile = None, replicas = 0):
+        '''chunk_size is the most data written to a peer at once when sendfile can't be used.
+sync_window is the number of files requested from each peer at once while syncing.
+New files are pushed to the peers in one batch every push_interval seconds, 0 pushes every file right away.
+If keypair is given every message sent is signed with it.  Signed messages from peers are only accepted
+from trusted_keys (a list of public keys, None accepts any key), and require_signed drops peers that send
+unsigned messages.  Signatures are checked verify_batch at a time on verify_workers processes.
+json_limit is the most memory the filesystem JSON of a peer may take while it is parsed, per name.
+If compress is True, data sent to peers that support it is compressed with the best codec both have.
+Peers connected with connectPeer are reconnected when the connection drops if reconnect is True, after
+reconnect_delay seconds doubling up to reconnect_max, resuming the TLS session.  streams connections are
+opened to each of them, the extra ones only carry files requested while syncing.
+If gossip_fanout is more than 0, new files are announced to that many random peers instead of being pushed
+to every peer.  Peers fetch announced files they don't have from a peer that announced them, then announce
+them further, so changes spread over the whole mesh and every node only uploads to a few others.
+Announcements don't go back to the peers a file came from, so they can miss nodes: every gossip_interval
+seconds such a node also asks gossip_fanout random peers for the changes it hasn't seen, see antiEntropy.
+Peers must have certificates signed by the CA in cafile, verifier_cert if it is None.
+If replicas is more than 0, the data of every entry is only kept by replicas nodes, picked by a placement.Ring
+of this node and the peers connected to it with the same replicas.  The other nodes only keep the entry, and
+fetch its data from the nodes keeping it when it is opened.  When nodes join or leave, the data is moved to
+the nodes that keep it now, see rebalance.  Every node builds the ring from its own peers, so they all have
+to be connected to each other.'''
         self.peers = []
         context = ssl.SSLContext(ssl.PROTOCOL_TLS)
         context.verify_mode = ssl.CERT_REQUIRED
         context.load_cert_chain(certfile=certfile, keyfile=keyfile)
-        context.load_verify_locations(cafile=verifier_cert)
+        context.load_verify_locations(cafile=verifier_cert if cafile==None else cafile)
         self.context = context
         self.fs = fs
         fs.addFsChangeListener(self)
-
+        # counters and latencies of the commands, transfers and syncs, with those of the filesystem
+        self.metrics = fs.metrics
+        # entries and files written locally that are waiting for the other half, keyed by ident
+        self.fs_changes = {}
+        self.new_files = {}
+        self.outbox = {}
+        self.outbox_lock = _thread.allocate_lock()
+        self.push_interval = push_interval
+        self.last_push = 0
+        self.port = port
+        self.chunk_size = chunk_size
+        self.scheduler = SyncScheduler(sync_window)
+        self.keypair = keypair
+        self.trusted_keys = None if trusted_keys==None else set(trusted_keys)
+        self.require_signed = require_signed
+        self.verifier = SignatureVerifier(verify_workers, verify_batch)
+        self.json_limit = json_limit
+        self.compress = compress
+        self.compress_stats = compression.new_stats()
+        self.reconnect = reconnect
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max = reconnect_max
+        self.streams = streams
+        # outbound connections by (ip, stream)
+        self.links = {}
+        self.link_stats = {'connects':0, 'resumed':0, 'failures':0, 'duplicates':0}
+        self.gossip_fanout = gossip_fanout
+        self.gossip_interval = gossip_interval
+        self.anti_entropy_at = time.time()+gossip_interval
+        self.gossip_seen = collections.OrderedDict()
+        # the peers that announced each entry being fetched, it is announced to other peers once it is here
+        self.gossip_sources = {}
+        # entries being received, so two peers sending the same one don't write the same .part
+        self.receiving = Claims()
+        self.replicas = replicas
+        # the nodes keeping the data of each entry, None when every node keeps everything
+        self.ring = placement.Ring([fs.node_id], replicas) if replicas>0 else None
+        # entries offered to the nodes keeping them, with the nodes that have them so far; dropped here once
+        # all of them do
+        self.handoffs = {}
+        # entries offered to us that are being fetched, with the peers to tell once they are here
+        self.offers = {}
+        # locks of the threads waiting in fetch, by entry
+        self.fetching = {}
+        self.fetch_lock = _thread.allocate_lock()
+        self.rebalance_at = None
+        # the ring the data was last moved for, and the entries asked for then that haven't arrived, see rebalance
+        self.balanced = None if self.ring==None else self.ring.copy()
+        self.unfetched = set()
+        # bumped by every rebalance, a scan still running for an older one stops
+        self.rebalancing = 0
+        # rebalance looks through the filesystem on a thread of its own
+        self.balancer = concurrent.futures.ThreadPoolExecutor(1)
+        # functions for the networking thread to run, see call
+        self.calls = collections.deque()
+        # received files are moved to the chunk store one at a time, see storeChunks
+        self.chunker = concurrent.futures.ThreadPoolExecutor(1)
+        self.running = True
+        self.server = None
+        # held until the networking thread is done, close() waits for it
+        self.stopped = _thread.allocate_lock()
+        self.stopped.acquire()
+        self.start(serve, adr, port)
+    def start(self, serve, adr, port):
+        '''starts the networking threads.  Subclasses override this to provide another networking engine.'''
         if serve:
-            sok = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sok.bind((adr, port))
-            sok.listen(5)
-            _thread.start_new_thread(self.__server__, (sok,))
+            self.acceptFrom(self.listen(adr, port))
         _thread.start_new_thread(self.__peerupdate__, ())
-        self.fs_changes = []
-        self.new_files = []
-        self.port = port
-    def addPeer(self, socket):
+    def listen(self, adr, port):
+        '''returns a socket listening for peers on adr:port.'''
+        sok = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sok.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sok.bind((adr, port))
+        sok.listen(5)
+        return sok
+    def acceptFrom(self, sok):
+        '''adds the peers connecting to the listening socket sok, on a thread of their own.'''
+        self.server = sok
+        _thread.start_new_thread(self.__server__, (sok,))
+    def close(self):
+        '''disconnects from every peer and stops the networking threads.  The filesystem stays open.'''
+        self.running = False
+        self.reconnect = False
+        if self.server!=None:
+            # a shutdown wakes the thread waiting in accept
+            try:
+                self.server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server.close()
+        self.stopped.acquire()
+        for i in list(self.peers):
+            i.close()
+            self.removePeer(i)
+        self.fs.listeners.remove(self)
+        self.verifier.close()
+        # a file being moved to the chunk store is finished, the ones waiting stay where they are
+        self.chunker.shutdown(cancel_futures=True)
+        self.balancer.shutdown(cancel_futures=True)
+    def addPeer(self, socket, link=None):
         socket.setblocking(0)
         peer = Peer(socket, self)
+        if link!=None:
+            peer.setLink(link)
         self.peers.append(peer)
+        return peer
     def connectPeer(self, ip):
-        sok = self.context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_side = False)
+        '''connects to a peer and keeps it connected.  Raises if the first attempt fails, it is retried anyway.'''
+        links = self.linksTo(ip)
+        for link in links[1:]:
+            try:
+                self.__open_link__(link)
+            except OSError:
+                pass
+        self.__open_link__(links[0])
+    def linksTo(self, ip):
+        out = []
+        for i in range(self.streams):
+            if not (ip, i) in self.links.keys():
+                self.links[(ip, i)] = Link(ip, i)
+            out.append(self.links[(ip, i)])
+        return out
+    def __open_link__(self, link):
+        # resuming the TLS session of the last connection saves most of the handshake
+        sok = self.context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_side = False, session = link.session)
+        sok.settimeout(HANDSHAKE_TIMEOUT)
         try:
-            sok.connect((ip, self.port))
-        except BlockingIOError:
-            pass
-        sok.setblocking(0)
+            sok.connect((link.ip, self.port))
+        except OSError:
+            sok.close()
+            self.reconnectLater(link)
+            raise
+        self.link_stats['connects']+=1
+        if sok.session_reused:
+            self.link_stats['resumed']+=1
+        link.failures = 0
+        log.info("connected to %s (stream %d)", link.ip, link.stream, extra={'event':'connect', 'peer':link.ip, 'stream':link.stream, 'resumed':sok.session_reused})
         #print("SSL established. Peer: {}".format(sok.getpeercert()))
-        self.addPeer(sok)
+        # the hello lets the peer drop a duplicate connection, and gets both sides syncing what they missed
+        self.addPeer(sok, link).sendHello()
+    def reconnectLater(self, link):
+        '''schedules the next attempt to reconnect link.'''
+        if not self.reconnect:
+            return
+        self.link_stats['failures']+=1
+        delay = link.backoff(self.reconnect_delay, self.reconnect_max)
+        link.retry_at = time.time()+delay
+        self.__retry_after__(link, delay)
+    def __retry_after__(self, link, delay):
+        # the networking thread starts the attempt once retry_at has passed
+        pass
+    def __retry_links__(self):
+        for link in list(self.links.values()):
+            if link.retry_at!=None and time.time()>=link.retry_at:
+                link.retry_at = None
+                _thread.start_new_thread(self.__reconnect__, (link,))
+    def __reconnect__(self, link):
+        try:
+            self.__open_link__(link)
+        except OSError:
+            # the next attempt is already scheduled
+            pass
+    def streamsOf(self, peer):
+        '''returns the connections to the node of peer, peer itself first.'''
+        if peer.remote==None:
+            return [peer]
+        return [peer]+[i for i in self.peers if i!=peer and i.live and i.remote!=None and i.remote['node']==peer.remote['node']]
+    def dedupPeer(self, peer):
+        '''called once the hello of peer says which node it is.  If we already have a connection to that node
+(it connected to us while we connected to it) one of them is closed.  Both nodes keep the connection
+opened by the node with the lowest id, so they close the same one.'''
+        for other in list(self.peers):
+            if other==peer or not other.live or other.remote==None or other.remote['node']!=peer.remote['node'] or other.stream!=peer.stream:
+                continue
+            if other.outbound==peer.outbound:
+                if not peer.outbound:
+                    # the other node sorts out its own connections
+                    continue
+                # we reconnected before noticing the old connection was gone
+                drop = other
+            else:
+                ours = self.fs.node_id
+                theirs = peer.remote['node']
+                opener = ours if peer.outbound else theirs
+                other_opener = ours if other.outbound else theirs
+                drop = peer if opener>other_opener else other
+            self.link_stats['duplicates']+=1
+            drop.duplicate = True
+            drop.close()
+            self.removePeer(drop)
+            if drop==peer:
+                raise ConnectionError("Already connected to this node")
     def sync(self):
         for i in self.peers:
             i.sync()
+        if self.ring!=None:
+            # data that didn't arrive before is fetched again
+            self.call(self.rebalance)
+    def call(self, func, *args):
+        '''runs func on the networking thread, the peers may only be touched from there.'''
+        self.calls.append((func, args))
+    def storeChunks(self, ident):
+        '''moves the data of a received entry to the chunk store on a thread of its own, splitting a file into
+chunks is too slow for the networking thread.  The entry can be read meanwhile.'''
+        self.chunker.submit(self.__store_chunks__, ident)
+    def __store_chunks__(self, ident):
+        try:
+            self.fs.store_chunks(ident)
+        except Exception:
+            # the data stays where it is, it can still be read
+            log.exception("moving %s to the chunk store failed", ident, extra={'event':'chunks_failed', 'ident':ident})
     def __server__(self, sok):
-        while True:
-            con, adr = sok.accept()
-            print("Incoming connection from", adr)
-            self.addPeer(self.context.wrap_socket(con, server_side = True))
+        while self.running:
+            try:
+                con, adr = sok.accept()
+            except OSError:
+                if not self.running or sok.fileno()==-1:
+                    # closed by close()
+                    break
+                # the connection was gone before it could be accepted
+                continue
+            log.info("incoming connection from %s", adr[0], extra={'event':'accept', 'peer':adr[0]})
+            # the handshake waits for the peer, it mustn't hold up the next connection
+            _thread.start_new_thread(self.__handshake__, (con, adr))
+    def __handshake__(self, con, adr):
+        con.settimeout(HANDSHAKE_TIMEOUT)
+        try:
+            sok = self.context.wrap_socket(con, server_side = True)
+        except OSError as e:
+            # covers ssl.SSLError, timeouts and peers that hung up
+            log.warning("handshake with %s failed: %s", adr[0], e, extra={'event':'handshake_failed', 'peer':adr[0]})
+            con.close()
+            return
+        if not self.running:
+            sok.close()
+            return
+        self.addPeer(sok)
     def __peerupdate__(self):
-        while True:
+        try:
+            self.__update_peers__()
+        finally:
+            self.stopped.release()
+    def __update_peers__(self):
+        while self.running:
             to_rm = []
-            for i in self.peers:
+            pushes = self.takePushes()
+            if len(pushes)>0 and self.gossip_fanout>0:
+                self.announceLocal(pushes)
+            for i in list(self.peers):
                 try:
+                    if len(pushes)>0 and self.pushesTo(i):
+                        self.pushTo(i, pushes)
                     i.update()
-                except ssl.SSLError:
+                    # a peer that doesn't keep up only keeps its own queue waiting
+                    i.pump()
+                except OSError:
+                    # covers ssl.SSLError and the peer disconnecting
                     to_rm.append(i)
             for i in to_rm:
-                self.peers.remove(i)
-            time.sleep(.01)
+                i.close()
+                self.removePeer(i)
+            # everything signed that came in during this pass is checked as one batch
+            self.verifier.flush()
+            self.collectVerified()
+            self.__retry_links__()
+            while len(self.calls)>0:
+                func, args = self.calls.popleft()
+                func(*args)
+            if self.rebalance_at!=None and time.time()>=self.rebalance_at:
+                self.rebalance()
+            if self.gossip_fanout>0 and time.time()>=self.anti_entropy_at:
+                self.antiEntropy()
+            self.__wait__(.01)
+    def __wait__(self, timeout):
+        # sleeps until a peer sent something or a full socket takes more again, at most timeout seconds
+        peers = [i for i in list(self.peers) if i.live]
+        try:
+            select.select([i.sok for i in peers], [i.sok for i in peers if i.outbuf!=None], [], timeout)
+        except (OSError, ValueError):
+            # a socket was closed meanwhile
+            time.sleep(timeout)
+    def collectVerified(self):
+        '''runs the signed messages whose signatures have been checked.'''
+        for i in self.verifier.collect():
+            try:
+                i.runVerified()
+            except OSError:
+                i.close()
+                self.removePeer(i)
+    def removePeer(self, peer):
+        if not peer in self.peers:
+            return
+        self.peers.remove(peer)
+        self.scheduler.peerLost(peer)
+        node = None if peer.remote==None else peer.remote['node']
+        log.info("lost peer %s (stream %d)", node, peer.stream, extra={'event':'disconnect', 'node':node, 'stream':peer.stream, 'sent':peer.sent, 'received':peer.received})
+        if peer.link!=None and peer.link.peer==peer:
+            peer.link.peer = None
+        if self.ring!=None and node!=None and not any(i.remote!=None and i.remote['node']==node for i in self.peers):
+            if self.ring.remove(node):
+                self.ringChanged()
+        if peer.duplicate:
+            return
+        # reconnect the links to the node unless there's another connection to it
+        if node!=None and any(i.remote!=None and i.remote['node']==node and i.stream==peer.stream for i in self.peers):
+            return
+        for link in self.links.values():
+            if link.peer==None and link.retry_at==None and (link==peer.link or (node!=None and link.node==node and link.stream==peer.stream)):
+                self.reconnectLater(link)
+    def fileReceived(self, ident, size):
+        self.scheduler.received(ident, size)
+        self.unfetched.discard(tuple(ident))
+        for i in list(self.peers):
+            i.entryArrived(ident)
+        sources = self.gossip_sources.pop(tuple(ident), None)
+        if sources!=None:
+            # pass it on, the peers that announced it have it already
+            self.gossip([[ident, size]], sources)
+        for i in self.offers.pop(tuple(ident), ()):
+            # the peer that offered it can drop its copy
+            try:
+                i.sendJson(COMMAND_STORED, [list(ident)])
+            except OSError:
+                i.close()
+                self.removePeer(i)
+        self.__wake_fetchers__(ident)
+    def keeps(self, ident):
+        '''returns True if the data of ident is kept on this node.'''
+        return self.ring==None or self.ring.owns(self.fs.node_id, ident)
+    def ringPeers(self):
+        '''returns the first connection to every other node on the ring, by node id.'''
+        return {i.remote['node']:i for i in self.peers if i.live and i.stream==0 and i.remote!=None and i.remote['node'] in self.ring}
+    def peerJoined(self, peer):
+        '''called once the hello of peer says which node it is.'''
+        if self.ring!=None and peer.remote.get('replicas')==self.replicas and self.ring.add(peer.remote['node']):
+            self.ringChanged()
+    def ringChanged(self):
+        log.info("%d nodes on the ring", len(self.ring), extra={'event':'ring', 'nodes':len(self.ring)})
+        # nodes joining or leaving together are rebalanced once
+        self.rebalance_at = time.time()+REBALANCE_DELAY
+        self.__rebalance_after__(REBALANCE_DELAY)
+    def __rebalance_after__(self, delay):
+        # the networking thread rebalances once rebalance_at has passed
+        pass
+    def rebalance(self):
+        '''moves data to the nodes keeping it on the ring as it is now.  The entries this node keeps and doesn't
+have are fetched from the other nodes keeping them, the ones it has and doesn't keep are offered to the
+nodes that do and dropped here once they have them.  Runs on the networking thread, REBALANCE_DELAY
+seconds after nodes joined or left, and on sync.
+Only the entries whose owners changed since the last rebalance are looked at, with the ones fetched or
+offered before that aren't done yet.  That is done on the balancer thread, and the data is moved on the
+networking thread OFFER_BATCH entries at a time.'''
+        self.rebalance_at = None
+        if self.ring==None:
+            return
+        self.rebalancing+=1
+        retry = self.unfetched|set(self.handoffs.keys())
+        self.balancer.submit(self.__scan__, self.rebalancing, self.balanced, self.ring.copy(), retry)
+    def __scan__(self, gen, old, ring, retry):
+        # runs on the balancer thread, the filesystem is only read here
+        try:
+            fs = self.fs
+            if old.state==ring.state:
+                # only the entries not done yet
+                entries = []
+                for name, vec in retry:
+                    try:
+                        entries.append((name, vec, fs.files[name][vec]))
+                    except KeyError:
+                        pass
+            else:
+                entries = fs.entries()
+            settled, wants, offers = [], [], []
+            fetching = offering = 0
+            for name, vec, data in entries:
+                if data==None:
+                    continue
+                if not self.running or gen!=self.rebalancing:
+                    # closed, or the ring changed again and the next rebalance covers this one
+                    return
+                ident = [name, vec]
+                owners = ring.owners(ident)
+                if not (name, vec) in retry and set(owners)==set(old.owners(ident)):
+                    continue
+                # the only stat of the entry
+                has = fs.has_data(ident)
+                if fs.node_id in owners or not has:
+                    # nothing to hand off
+                    settled.append(ident)
+                if fs.node_id in owners and not has:
+                    wants.append((ident, owners))
+                elif not fs.node_id in owners and has:
+                    offers.append(([name, vec, data], owners))
+                if len(settled)+len(offers)>=OFFER_BATCH:
+                    self.call(self.__move__, gen, settled, wants, offers)
+                    fetching+=len(wants)
+                    offering+=len(offers)
+                    settled, wants, offers = [], [], []
+            self.call(self.__move__, gen, settled, wants, offers)
+            self.call(self.__rebalanced__, gen, ring, fetching+len(wants), offering+len(offers))
+        except Exception:
+            log.exception("rebalancing failed")
+    def __move__(self, gen, settled, wants, offers):
+        # moves the data of one batch of a rebalance, on the networking thread
+        if gen!=self.rebalancing:
+            return
+        for ident in settled:
+            self.handoffs.pop(tuple(ident), None)
+        peers = self.ringPeers()
+        to_want = {}
+        to_offer = {}
+        for ident, owners in wants:
+            self.unfetched.add(tuple(ident))
+            for i in owners:
+                if i in peers.keys():
+                    to_want.setdefault(i, []).append(ident)
+        for entry, owners in offers:
+            self.handoffs.setdefault((entry[0], entry[1]), set())
+            for i in owners:
+                if i in peers.keys():
+                    to_offer.setdefault(i, []).append(entry)
+        for node in set(to_want.keys())|set(to_offer.keys()):
+            peer = peers[node]
+            try:
+                for ident in to_want.get(node, []):
+                    peer.__want__(ident)
+                entries = to_offer.get(node, [])
+                for i in range(0, len(entries), OFFER_BATCH):
+                    peer.sendJson(COMMAND_OFFER, entries[i:i+OFFER_BATCH])
+            except OSError:
+                peer.close()
+                self.removePeer(peer)
+    def __rebalanced__(self, gen, ring, fetching, offering):
+        if gen!=self.rebalancing:
+            return
+        self.balanced = ring
+        self.metrics.count('rebalances')
+        log.info("rebalancing: fetching %d entries, offering %d", fetching, offering,
+                 extra={'event':'rebalance', 'nodes':len(ring), 'handoffs':len(self.handoffs)})
+    def pushTo(self, peer, idents):
+        '''sends new entries to peer.  Nodes on the ring are only offered them, and fetch the ones they keep.'''
+        if self.ring==None or peer.remote==None or not peer.remote['node'] in self.ring:
+            peer.pushFsChanges(idents)
+            return
+        files = self.fs.files
+        peer.sendJson(COMMAND_OFFER, [[name, vec, files[name][vec]] for name, vec in idents])
+        for ident in idents:
+            if not self.keeps(ident):
+                self.handoffs.setdefault(tuple(ident), set())
+    def onOffer(self, peer, entries):
+        '''called when peer offers entries it has the data of.  They are all created here, the data of the ones
+this node keeps is fetched, and peer is told which ones are here already.'''
+        fs = self.fs
+        stored = []
+        created = False
+        for name, vec, data in entries:
+            ident = [name, vec]
+            if fs.has_data(ident):
+                stored.append(ident)
+                continue
+            if self.keeps(ident):
+                self.offers.setdefault((name, vec), set()).add(peer)
+                peer.__want__(ident)
+            created = fs.try_create_entry(ident, data) or created
+        if created:
+            fs.flush()
+        if len(stored)>0:
+            peer.sendJson(COMMAND_STORED, stored)
+    def onStored(self, peer, idents):
+        '''called when peer has the data of entries offered to it.  Ours is dropped once every node keeping an
+entry has it.'''
+        if self.ring==None or peer.remote==None:
+            return
+        for ident in idents:
+            key = tuple(ident)
+            confirmed = self.handoffs.get(key)
+            if confirmed==None:
+                continue
+            confirmed.add(peer.remote['node'])
+            owners = self.ring.owners(ident)
+            if not self.fs.node_id in owners and all(i in confirmed for i in owners):
+                del self.handoffs[key]
+                self.fs.drop_data(ident)
+                self.metrics.count('handoffs')
+    def onMissing(self, peer, idents):
+        '''called when peer doesn't have the data of entries requested from it.'''
+        for ident in idents:
+            for i in self.streamsOf(peer):
+                self.scheduler.missing(ident, i)
+            if not tuple(ident) in self.scheduler.wanted.keys():
+                # nobody else has it
+                self.__wake_fetchers__(ident)
+    def placeEntry(self, peer, ident, data):
+        '''called for an entry of peer found missing while syncing with a ring.  The entry is created, and if this
+node keeps it its data is fetched from peer or the other nodes keeping it.  Returns True if the entry was
+created, the caller flushes.'''
+        if data==None:
+            return False
+        if self.keeps(ident):
+            peer.__want__(ident)
+            owners = self.ring.owners(ident)
+            for node, i in self.ringPeers().items():
+                if node in owners and i!=peer:
+                    i.__want__(ident)
+        return self.fs.try_create_entry(ident, data)
+    def fetch(self, ident, timeout=10):
+        '''gets the data of an entry this node doesn't keep from the nodes that do, see replicas.  Returns True
+once it is here, False if it didn't come within timeout seconds.  Waits for the networking thread, so don't
+call it from there.'''
+        key = tuple(ident)
+        done = _thread.allocate_lock()
+        done.acquire()
+        with self.fetch_lock:
+            self.fetching.setdefault(key, []).append(done)
+        if not self.fs.has_data(ident):
+            self.call(self.__fetch__, list(ident))
+            done.acquire(timeout=timeout)
+        with self.fetch_lock:
+            waiting = self.fetching.get(key, [])
+            if done in waiting:
+                waiting.remove(done)
+                if len(waiting)==0:
+                    del self.fetching[key]
+        return self.fs.has_data(ident)
+    def __fetch__(self, ident):
+        owners = None if self.ring==None else self.ring.owners(ident)
+        for i in list(self.peers):
+            if i.live and i.stream==0 and i.remote!=None and (owners==None or i.remote['node'] in owners):
+                try:
+                    i.__want__(ident)
+                except OSError:
+                    i.close()
+                    self.removePeer(i)
+        if not tuple(ident) in self.scheduler.wanted.keys():
+            # no peer to ask
+            self.__wake_fetchers__(ident)
+    def __wake_fetchers__(self, ident):
+        with self.fetch_lock:
+            for i in self.fetching.pop(tuple(ident), []):
+                i.release()
+    def pushesTo(self, peer):
+        '''returns True if new files are pushed to peer, False if it only gets announcements or nothing.'''
+        return peer.stream==0 and not (self.gossip_fanout>0 and peer.gossips())
+    def __seen__(self, key):
+        # returns True if the entry was announced before, and remembers it
+        if key in self.gossip_seen.keys():
+            return True
+        self.gossip_seen[key] = True
+        if len(self.gossip_seen)>GOSSIP_SEEN:
+            old = self.gossip_seen.popitem(last=False)[0]
+            self.gossip_sources.pop(old, None)
+        return False
+    def announceLocal(self, idents):
+        '''announces entries written on this node.'''
+        entries = []
+        for ident in idents:
+            self.__seen__(tuple(ident))
+            f, size = self.fs.open_data(ident)
+            f.close()
+            entries.append([ident, size])
+        self.gossip(entries)
+    def gossip(self, entries, exclude=()):
+        '''announces [ident, size] entries to gossip_fanout random peers that aren't in exclude.'''
+        peers = [i for i in self.peers if i.live and i.stream==0 and i.gossips() and not i in exclude]
+        for i in random.sample(peers, min(self.gossip_fanout, len(peers))):
+            try:
+                i.sendJson(COMMAND_ANNOUNCE, entries)
+            except OSError:
+                i.close()
+                self.removePeer(i)
+    def antiEntropy(self):
+        '''runs a delta sync with gossip_fanout random peers that gossip, for the entries the announcements
+didn't bring.  A peer that got an entry from its only neighbour has nobody to announce it to, so without
+this the nodes behind it would never get it.'''
+        self.anti_entropy_at = time.time()+self.gossip_interval
+        peers = [i for i in self.peers if i.live and i.stream==0 and i.gossips()]
+        for i in random.sample(peers, min(self.gossip_fanout, len(peers))):
+            try:
+                i.sync()
+            except OSError:
+                i.close()
+                self.removePeer(i)
+    def onAnnounce(self, peer, ident, size):
+        key = tuple(ident)
+        first = not self.__seen__(key)
+        files = self.fs.files
+        if ident[0] in files.keys() and files[ident[0]].get(ident[1])!=None and self.fs.has_data(ident):
+            if first:
+                # we got it some other way, but our peers may not have
+                self.gossip([[ident, size]], [peer])
+            return
+        if first or key in self.gossip_sources.keys():
+            # fetched from whichever of the peers that announced it is free first
+            self.gossip_sources.setdefault(key, set()).add(peer)
+            peer.__want__(ident)
+    def syncProgress(self):
+        return self.scheduler.progress()
+    def stats(self):
+        '''returns everything there is to know about how the node is doing, as one dict: the counters and
+latencies of metrics, the queues of every peer, sync progress, connections, signatures and compression.'''
+        out = self.metrics.snapshot()
+        out['queues'] = {'outbox':len(self.outbox), 'unpaired':len(self.fs_changes)+len(self.new_files),
+                         'receiving':len(self.receiving)}
+        if self.fs.journal!=None:
+            out['queues']['journal'] = self.fs.journal_len
+        out['peers'] = self.peerStats()
+        out['sync'] = self.syncProgress()
+        out['links'] = dict(self.link_stats)
+        out['signatures'] = dict(self.verifier.stats)
+        out['compression'] = self.compressionStats()
+        if self.ring!=None:
+            out['placement'] = {'replicas':self.replicas, 'nodes':len(self.ring), 'handoffs':len(self.handoffs)}
+        return out
+    def peerStats(self):
+        '''returns the send queue of every peer: messages and files waiting and their bytes, and the bytes/s
+written to it over the last second.'''
+        return [i.sendStats() for i in list(self.peers)]
+    def compressionStats(self):
+        '''returns counters for the framed traffic of every peer, with the bytes compression saved both ways
+and the CPU seconds it took.'''
+        out = dict(self.compress_stats)
+        out['saved'] = out['raw']-out['sent']
+        out['received_saved'] = out['inflated']-out['received']
+        return out
     def onFlush(self, fs):
         pass
     def onEntryCreate(self, fs, ident, data):
-        self.fs_changes.append([ident, data])
-        for i in self.new_files:
-            if i[0]==ident:
-                self.push_fs_change_to_peers(ident)
-                return
+        key = tuple(ident)
+        if key in self.new_files.keys():
+            del self.new_files[key]
+            self.push_fs_change_to_peers(ident)
+        else:
+            self.fs_changes[key] = data
     def onFileWritten(self, fs, ident, location):
-        self.new_files.append([ident, location])
-        for i in self.fs_changes:
-            if i[0]==ident:
-                self.push_fs_change_to_peers(ident)
-                return
+        key = tuple(ident)
+        if key in self.fs_changes.keys():
+            del self.fs_changes[key]
+            self.push_fs_change_to_peers(ident)
+        else:
+            self.new_files[key] = location
+    def onDataWanted(self, fs, ident):
+        if self.ring!=None:
+            self.fetch(ident)
     def push_fs_change_to_peers(self,ident):
-        print("Pushing", ident)
-        filechange_idx = -1
-        fschange_idx = -1
-        for i in range(len(self.fs_changes)):
-            if self.fs_changes[i][0]==ident:
-                fschange_idx = i
-                break
-        for i in range(len(self.new_files)):
-            if self.new_files[i][0]==ident:
-                filechange_idx = i
-        self.new_files.pop(filechange_idx)
-        self.fs_changes.pop(fschange_idx)
-        for i in self.peers:
-            i.pushFsChange(ident)
+        log.debug("pushing %s", ident)
+        self.metrics.count('pushes')
+        if self.push_interval==0:
+            for i in list(self.peers):
+                if self.pushesTo(i):
+                    self.pushTo(i, [ident])
+            if self.gossip_fanout>0:
+                self.announceLocal([ident])
+        else:
+            # sent by the networking thread with the rest of the batch
+            with self.outbox_lock:
+                self.outbox[tuple(ident)] = ident
+    def takePushes(self):
+        '''returns the batch of idents to push to the peers, if it is time to push them.'''
+        if len(self.outbox)==0 or time.time()-self.last_push<self.push_interval:
+            return []
+        self.last_push = time.time()
+        with self.outbox_lock:
+            pushes = list(self.outbox.values())
+            self.outbox.clear()
+        return pushes
+class RecvBuffer:
+    '''Receive buffer with a read cursor.  Data is received straight into the buffer and fields are
+consumed by moving the cursor, so parsing never copies the rest of the buffer.  The unread bytes are
+only moved back to the front when there is no room left at the end.'''
+    def __init__(self, size=65536):
+        self.buf = bytearray(size)
+        self.start = 0
+        self.end = 0
+    def __len__(self):
+        return self.end-self.start
+    def reserve(self, n):
+        '''makes room for at least n more bytes, returns a memoryview of the free space.'''
+        used = self.end-self.start
+        if used==0:
+            self.start = self.end = 0
+        if len(self.buf)-self.end<n:
+            if used+n>len(self.buf):
+                new = bytearray(max(len(self.buf)*2, used+n))
+                new[:used] = self.buf[self.start:self.end]
+                self.buf = new
+            else:
+                self.buf[:used] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = used
+        return memoryview(self.buf)[self.end:]
+    def recv_into(self, sok, n=65536):
+        with self.reserve(n) as free:
+            got = sok.recv_into(free, n)
+        self.end+=got
+        return got
+    def extend(self, data):
+        n = len(data)
+        with self.reserve(n) as free:
+            free[:n] = data
+        self.end+=n
+    def view(self, n):
+        '''returns a memoryview of the next n bytes without consuming them.  Release it before receiving more data.'''
+        return memoryview(self.buf)[self.start:self.start+n]
+    def consume(self, n):
+        self.start+=n
+    def read(self, n):
+        data = bytes(self.buf[self.start:self.start+n])
+        self.start+=n
+        return data
+    def peek(self):
+        return self.buf[self.start]
+    def read_int(self, n):
+        val = int.from_bytes(self.buf[self.start:self.start+n], 'little')
+        self.start+=n
+        return val
+
+class FsJsonStream:
+    '''Parses the filesystem JSON of a COMMAND_RETURN_FS_JSON while it arrives.  on_entry(name, versions)
+is called as soon as all the versions of a name are in, so only the name being received is held in memory.
+A single name taking more than limit bytes is treated as an attack and drops the peer.'''
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    def __init__(self, on_entry, limit=1<<22):
+        self.on_entry = on_entry
+        self.limit = limit
+        # a UTF-8 character may be split over two reads
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.text = ''
+        self.pos = 0
+        # 0: before the opening brace, 1: before the first name, 2: after a name, 3: after a comma, 4: done
+        self.state = 0
+    def feed(self, data, final=False):
+        self.text = self.text[self.pos:]+self.utf8.decode(data, final)
+        self.pos = 0
+        self.__parse__()
+        if len(self.text)-self.pos>self.limit:
+            raise ConnectionError("Filesystem JSON from peer exceeds the memory limit")
+    def finish(self):
+        '''called once the whole JSON was fed, raises ConnectionError if it wasn't valid.'''
+        self.feed(b'', True)
+        if self.state!=4 or len(self.text)>self.pos:
+            raise ConnectionError("Malformed filesystem JSON from peer")
+    def __skip__(self):
+        self.pos = self.whitespace.match(self.text, self.pos).end()
+        return self.pos<len(self.text)
+    def __parse__(self):
+        text = self.text
+        while self.__skip__():
+            c = text[self.pos]
+            if self.state==0:
+                if c!='{':
+                    raise ConnectionError("Malformed filesystem JSON from peer")
+                self.pos+=1
+                self.state = 1
+            elif c=='}' and (self.state==1 or self.state==2):
+                self.pos+=1
+                self.state = 4
+            elif c==',' and self.state==2:
+                self.pos+=1
+                self.state = 3
+            elif c=='"' and (self.state==1 or self.state==3):
+                try:
+                    name, end = self.decoder.raw_decode(text, self.pos)
+                    end = self.whitespace.match(text, end).end()
+                    if end<len(text) and text[end]!=':':
+                        raise ConnectionError("Malformed filesystem JSON from peer")
+                    end = self.whitespace.match(text, end+1).end()
+                    versions, end = self.decoder.raw_decode(text, end)
+                except ValueError:
+                    # the rest of this name hasn't arrived yet
+                    break
+                if type(versions)!=dict:
+                    raise ConnectionError("Malformed filesystem JSON from peer")
+                self.pos = end
+                self.state = 2
+                self.on_entry(name, versions)
+            else:
+                raise ConnectionError("Malformed filesystem JSON from peer")
+
 class Peer:
     def __init__(self, socket, manager):
         self.sok = socket
         self.man = manager
         self.live = True
-        self.inbuffer = b''
+        self.inbuffer = RecvBuffer()
         self.current_command = -1
         self.state = 0
         self.state_val = None
+        # seconds spent parsing and handling the current command so far, None between commands
+        self.cmd_time = None
         self.isSynced = False
-    def __send_file__(self, filepath):
-        with open(filepath, 'rb') as f:
-            # get file size
-            f.seek(0,2)
-            f_size = f.tell()
-            
-            # go back to the beginning
-            f.seek(0)
-
-            # send file data in 2048 byte chunks to avoid wasting memory
-            self.sok.sendall(f_size.to_bytes(4, 'little'))
-            for i in range(math.ceil(f_size/2048)):
-                self.sok.sendall(f.read(2048))
+        self.remote = None
+        self.legacy = False
+        self.pending_seq = None
+        self.sync_started = None
+        self.waiting = set()
+        self.tree_requests = 0
+        self.manifests = []
+        self.chunks_requested = set()
+        # what waits to be sent, written by pump as fast as the connection takes it.  outq holds messages (and
+        # raw Transfers and the switch to frames) in order, pushes the idents to push once a file can be opened
+        # and transfers the files being streamed, by stream id
+        self.outq = collections.deque()
+        self.pushes = collections.deque()
+        self.transfers = collections.OrderedDict()
+        self.raw = None
+        self.outbuf = None
+        self.next_sid = 0
+        self.pump_lock = _thread.allocate_lock()
+        self.corked = False
+        # files arriving as streams, by stream id
+        self.incoming = {}
+        self.sent = 0
+        self.received = 0
+        self.rate = 0.0
+        self.rate_at = time.time()
+        self.rate_sent = 0
+        # signed messages waiting for their signature check, as [public key, data, result]
+        self.verifying = collections.deque()
+        self.signer = None
+        # set once we send frames, and once the peer does (the bytes received go to rawbuffer first then)
+        self.encoder = None
+        self.rawbuffer = None
+        self.raw_left = 0
+        # the Link this connection was opened for, None if the peer connected to us
+        self.link = None
+        self.outbound = False
+        # 0 for the connection that syncs, extra bulk streams to the same node only carry files
+        self.stream = 0
+        self.duplicate = False
+        self.hello_sent = False
+    def setLink(self, link):
+        self.link = link
+        self.outbound = True
+        self.stream = link.stream
+        link.peer = self
+    def close(self):
+        self.live = False
+        if self.link!=None and isinstance(self.sok, ssl.SSLSocket):
+            # TLS 1.3 tickets arrive after the handshake, so the session is taken when the connection ends
+            self.link.session = self.sok.session or self.link.session
+        self.sok.close()
+        self.__close_files__()
+    def __close_files__(self):
+        # waits for a pump running on another thread, it may be reading one of the files
+        with self.pump_lock:
+            for t in list(self.transfers.values())+[i for i in list(self.outq) if isinstance(i, Transfer)]+[self.raw]:
+                if t!=None:
+                    t.f.close()
+            for i in self.incoming.values():
+                i.close()
+            if isinstance(self.state_val, list) and len(self.state_val)>0 and isinstance(self.state_val[0], IncomingFile):
+                self.state_val[0].close()
+    def send(self, data):
+        self.outq.append(bytes(data))
+        self.__kick__()
+    def __kick__(self):
+        # batching; while corked small messages pile up and go out in one write
+        if not self.corked:
+            self.pump()
+    def pump(self):
+        '''writes what is queued for the peer until the connection doesn't take more without blocking.  Called
+whenever something is queued, and by the networking thread to pick up what was queued while another
+thread was writing.'''
+        if not self.pump_lock.acquire(False):
+            return
+        try:
+            while self.live:
+                if self.outbuf==None:
+                    if self.raw!=None and (self.encoder==None or self.raw.unframed) and self.__can_sendfile__(self.raw.f):
+                        if not self.__sendfile__(self.raw):
+                            break
+                        continue
+                    data = self.__next_out__()
+                    if data==None:
+                        break
+                    self.outbuf = memoryview(data)
+                n = self.__try_write__(self.outbuf)
+                self.__count_sent__(n)
+                if n<len(self.outbuf):
+                    self.outbuf = self.outbuf[n:]
+                    break
+                self.outbuf = None
+        finally:
+            self.pump_lock.release()
+    def __try_write__(self, data):
+        # returns the number of bytes the socket took, it never waits for it
+        try:
+            return self.sok.send(data)
+        except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            return 0
+    def __count_sent__(self, n):
+        self.sent+=n
+        self.man.metrics.count('bytes_out', n)
+        now = time.time()
+        if now-self.rate_at>=1:
+            self.rate = (self.sent-self.rate_sent)/(now-self.rate_at)
+            self.rate_at = now
+            self.rate_sent = self.sent
+    def __next_out__(self):
+        # returns the next bytes to write, or None: messages go first, then the next piece of a file
+        if self.raw!=None:
+            return self.__raw_piece__()
+        if len(self.outq)>0 and isinstance(self.outq[0], bytes):
+            data = self.outq.popleft()
+            if len(data)<self.man.chunk_size:
+                data = bytearray(data)
+                while len(self.outq)>0 and isinstance(self.outq[0], bytes) and len(data)<self.man.chunk_size:
+                    data+=self.outq.popleft()
+            return self.__frame__(data)
+        if len(self.outq)>0:
+            item = self.outq.popleft()
+            if isinstance(item, compression.Encoder):
+                # everything after COMMAND_FRAMED is framed
+                self.encoder = item
+                return self.__next_out__()
+            # a raw transfer has the connection to itself until it is done
+            if item.left>0:
+                self.raw = item
+                if self.encoder!=None:
+                    return self.__frame__(item.header)+self.__raw_frame__(item)
+            else:
+                item.f.close()
+            return self.__frame__(item.header)
+        # files are only opened once they are next, so a long queue doesn't keep every file open
+        while len(self.pushes)>0 and len(self.outq)==0 and len(self.transfers)<MUX_STREAMS:
+            self.__start_push__(*self.pushes.popleft())
+        if len(self.outq)>0:
+            return self.__next_out__()
+        # the streams take turns, each as far as its window lets it
+        for t in list(self.transfers.values()):
+            if t.window<=0:
+                continue
+            n = min(t.left, t.window, MUX_PIECE)
+            data = t.read(n)
+            t.window-=len(data)
+            self.transfers.move_to_end(t.sid)
+            if t.left==0:
+                t.f.close()
+                del self.transfers[t.sid]
+                self.__end_stream__(t)
+            return self.__frame__(bytes([COMMAND_DATA])+t.sid.to_bytes(4, 'little')+len(data).to_bytes(4, 'little')+data)
+        return None
+    def __end_stream__(self, t):
+        # the sha256 goes out right behind the last piece
+        if not self.resumes():
+            return
+        if t.digest==None:
+            t.digest = t.sha.hexdigest()
+            self.man.fs.write_digest(t.ident, t.digest, t.size)
+        self.outq.append(bytes([COMMAND_DATA_END])+t.sid.to_bytes(4, 'little')+bytes.fromhex(t.digest))
+    def resumes(self):
+        return self.remote!=None and 'resume' in self.remote['caps']
+    def __raw_frame__(self, t):
+        # a file not worth compressing goes out as one raw frame, so it can still be sent with sendfile
+        pos = t.f.tell()
+        sample = t.f.read(compression.SAMPLE)
+        t.f.seek(pos)
+        if self.encoder.compressible(sample):
+            return b''
+        t.unframed = True
+        return self.encoder.raw_header(t.left)
+    def __raw_piece__(self):
+        t = self.raw
+        data = t.read(min(t.left, self.man.chunk_size))
+        if t.left==0:
+            t.f.close()
+            self.raw = None
+        if t.unframed:
+            return data
+        return self.__frame__(data)
+    def __sendfile__(self, t):
+        # returns False once the socket is full
+        try:
+            n = os.sendfile(self.sok.fileno(), t.f.fileno(), None, t.left)
+        except (BlockingIOError, ssl.SSLWantWriteError):
+            return False
+        if n==0:
+            raise ConnectionError("File changed size while sending")
+        t.left-=n
+        self.__count_sent__(n)
+        if t.left==0:
+            t.f.close()
+            self.raw = None
+        return True
+    def __frame__(self, data):
+        if self.encoder==None:
+            return data
+        return self.encoder.encode(data)
+    def sending(self):
+        '''returns True while anything waits to be sent to the peer.'''
+        return self.outbuf!=None or self.raw!=None or len(self.outq)>0 or len(self.pushes)>0 or len(self.transfers)>0
+    def flush(self, timeout=None):
+        '''blocks until everything queued has been written, for code driving a Peer without a networking thread.
+Returns False if that took more than timeout seconds.'''
+        end = None if timeout==None else time.time()+timeout
+        while self.sending():
+            self.pump()
+            if end!=None and time.time()>end:
+                return False
+            if self.outbuf!=None:
+                select.select([], [self.sok], [], .1)
+            elif self.sending():
+                # waiting for the peer to open a window
+                time.sleep(.001)
+        return True
+    def sendStats(self):
+        '''returns what waits to be sent to the peer, what was sent and received and the bytes/s sent over the
+last second.'''
+        now = time.time()
+        rate = self.rate if now-self.rate_at<2 else (self.sent-self.rate_sent)/(now-self.rate_at)
+        messages = [i for i in list(self.outq) if isinstance(i, bytes)]
+        files = [i for i in list(self.outq) if isinstance(i, Transfer)]+list(self.transfers.values())+[i for i in [self.raw] if i!=None]
+        return {'node':None if self.remote==None else self.remote['node'], 'stream':self.stream,
+                'messages':len(messages), 'message_bytes':sum(len(i) for i in messages)+(0 if self.outbuf==None else len(self.outbuf)),
+                'files':len(files), 'file_bytes':sum(i.left for i in files), 'pushes':len(self.pushes),
+                'sent':self.sent, 'received':self.received, 'rate':rate}
+    def sendMessage(self, msg):
+        '''sends one complete message, signed if the manager has a key pair.'''
+        if self.man.keypair==None:
+            self.send(msg)
+            return
+        # the public key and signature come first, then the length and the message itself
+        signed = self.man.keypair.sign(msg)
+        self.send(bytes([msg[0] | COMMAND_SIGNED_FLAG])+signed+len(msg).to_bytes(4, 'little')+msg)
+    def __send_file__(self, filepath, header):
+        # sends header, the size of the file and the file
+        f = open(filepath, 'rb')
+        f_size = os.fstat(f.fileno()).st_size
+        self.outq.append(Transfer(f, f_size, header=header+f_size.to_bytes(4, 'little')))
+        self.__kick__()
+    def __can_sendfile__(self, f):
+        # sendfile needs a real file, and only works on TLS sockets if the kernel does the encryption (kTLS)
+        if not isinstance(getattr(f, 'raw', None), io.FileIO):
+            return False
+        if isinstance(self.sok, ssl.SSLSocket):
+            sslobj = getattr(self.sok, '_sslobj', None)
+            return hasattr(sslobj, 'uses_ktls_for_send') and sslobj.uses_ktls_for_send()
+        return isinstance(self.sok, socket.socket)
     def sync(self):
         # this command initiates the synchronization process.
-        self.sok.sendall(bytes([COMMAND_GET_FS_JSON]))
-        # the peer will send back their filesystem JSON, which we can compare to our own filesystem.
-        # This comparison allows us to know what entries need to be created and files downloaded.
-        # The first step is asking for the remote filesystem JSON.
         self.isSynced = True
-    def pushFsChange(self, ident):
+        if self.stream>0 and self.remote!=None:
+            # bulk streams only carry files, the first connection to the node syncs
+            return
+        if self.remote!=None and 'delta' in self.remote['caps']:
+            self.sync_started = time.perf_counter()
+            since = self.man.fs.remote_seqs.get(self.remote['node'], 0)
+            if self.remote['seq']-since>TREE_SYNC_THRESHOLD and 'tree' in self.remote['caps'] and self.remote.get('depth')==self.man.fs.tree_depth:
+                # too far behind, comparing hash trees costs less than every change
+                self.pending_seq = [self.remote['node'], self.remote['seq']]
+                self.requestTree(0, [0])
+            else:
+                # the peer numbers its changes, so only ask for the ones we haven't seen
+                self.requestChanges()
+        elif self.remote!=None or self.legacy:
+            self.sendMessage(bytes([COMMAND_GET_FS_JSON]))
+            # the peer will send back their filesystem JSON, which we can compare to our own filesystem.
+            # This comparison allows us to know what entries need to be created and files downloaded.
+            # The first step is asking for the remote filesystem JSON.
+        elif not self.hello_sent:
+            # find out what the peer supports first.  Old peers answer with COMMAND_GET_FS_JSON instead.
+            self.sendHello()
+    def sendHello(self):
+        self.hello_sent = True
+        caps = CAPABILITIES
+        if self.man.fs.chunkstore!=None:
+            caps = caps+['chunks']
+        info = {'node':self.man.fs.node_id, 'seq':self.man.fs.seq, 'depth':self.man.fs.tree_depth, 'caps':caps, 'stream':self.stream}
+        if self.man.compress:
+            info['codecs'] = compression.available()
+        if self.man.ring!=None:
+            info['replicas'] = self.man.replicas
+        hello = json.dumps({HELLO_PREFIX+json.dumps(info):{}}).encode()
+        self.sendMessage(bytes([COMMAND_RETURN_FS_JSON])+len(hello).to_bytes(4, 'little')+hello)
+    def onHello(self, info):
+        self.remote = info
+        if self.link!=None:
+            self.link.node = info['node']
+        else:
+            # the node that opened the connection says which stream it is
+            self.stream = info.get('stream', 0)
+        self.man.dedupPeer(self)
+        self.man.peerJoined(self)
+        codec = compression.choose(info.get('codecs', [])) if self.man.compress else None
+        if codec!=None and self.encoder==None:
+            self.startFraming(codec)
+        if self.isSynced:
+            self.sync()
+    def startFraming(self, codec):
+        '''sends COMMAND_FRAMED, everything queued after it goes out in frames compressed with codec.'''
+        # both at once, nothing queued by another thread may come between them
+        self.outq.extend([bytes([COMMAND_FRAMED]), compression.Encoder(codec, self.man.compress_stats)])
+        self.__kick__()
+    def requestChanges(self):
+        since = self.man.fs.remote_seqs.get(self.remote['node'], 0)
+        self.sendMessage(bytes([COMMAND_GET_CHANGES])+since.to_bytes(8, 'little'))
+    def sendChanges(self, since):
+        if since>self.man.fs.seq:
+            # the peer knows a change log we don't have anymore, send everything
+            since = 0
+        changes = self.man.fs.changes_since(since)
+        delta = json.dumps({'node':self.man.fs.node_id, 'seq':since+len(changes), 'changes':changes}).encode()
+        self.sendMessage(bytes([COMMAND_RETURN_CHANGES])+len(delta).to_bytes(4, 'little')+delta)
+    def sendJson(self, cmd, obj):
+        data = json.dumps(obj).encode()
+        self.sendMessage(bytes([cmd])+len(data).to_bytes(4, 'little')+data)
+    def requestTree(self, level, indices):
+        self.tree_requests+=1
+        self.sendJson(COMMAND_GET_TREE, [level, indices])
+    def requestBuckets(self, buckets):
+        self.tree_requests+=1
+        self.sendJson(COMMAND_GET_BUCKETS, buckets)
+    def onTree(self, level, indices, hashes):
+        # only descend into the parts of the tree that differ
+        tree = self.man.fs.tree
+        diff = [indices[i] for i in range(len(indices)) if tree.levels[level][indices[i]]!=hashes[i]]
+        if len(diff)==0:
+            pass
+        elif level==tree.depth:
+            self.requestBuckets(diff)
+        else:
+            nxt = min(level+TREE_STRIDE, tree.depth)
+            span = 1<<(nxt-level)
+            self.requestTree(nxt, [j for i in diff for j in range(i*span, (i+1)*span)])
+    def onRemoteEntries(self, entries):
+        files = self.man.fs.files
+        created = False
+        for name, vec, data in entries:
+            if not (name in files.keys() and vec in files[name].keys()):
+                ident = [name, vec]
+                if self.man.ring!=None:
+                    created = self.man.placeEntry(self, ident, data) or created
+                    continue
+                self.__want__(ident)
+                self.waiting.add((name, vec))
+                log.debug("[sync] requesting %s", ident)
+        if created:
+            self.man.fs.flush()
+    def gossips(self):
+        return self.remote!=None and 'gossip' in self.remote['caps']
+    def __want__(self, ident):
+        # the file can come over any of the streams to the node
+        for i in self.man.streamsOf(self):
+            self.man.scheduler.want(ident, i)
+    def onRemoteName(self, name, versions):
+        '''compares one name of the filesystem JSON of the peer to our filesystem.'''
+        if name.startswith(HELLO_PREFIX):
+            self.onHello(json.loads(name[len(HELLO_PREFIX):]))
+            return
+        log.debug("[sync] checking %s", name)
+        files = self.man.fs.files
+        if self.man.ring!=None:
+            created = False
+            for val, data in versions.items():
+                if not (name in files.keys() and val in files[name].keys()):
+                    created = self.man.placeEntry(self, [name, val], data) or created
+            if created:
+                self.man.fs.flush()
+        elif name in files.keys():
+            # the key is there; are there new file versions though?
+            ours = files[name]
+            for val in versions.keys():
+                if not val in ours.keys():
+                    # a new entry
+                    ident = [name, val]
+                    self.__want__(ident)
+                    log.debug("[sync] requesting %s", ident)
+        else:
+            # a new key entirely!
+            for val in versions.keys():
+                ident = [name, val]
+                self.__want__(ident)
+                log.debug("[sync] requesting %s", ident)
+    def __handle_json__(self, cmd, obj):
+        if cmd==COMMAND_GET_TREE:
+            level, indices = obj
+            self.sendJson(COMMAND_RETURN_TREE, [level, indices, self.man.fs.tree.nodes(level, indices)])
+        elif cmd==COMMAND_RETURN_TREE:
+            self.tree_requests-=1
+            self.onTree(*obj)
+        elif cmd==COMMAND_GET_BUCKETS:
+            self.sendJson(COMMAND_RETURN_BUCKETS, self.man.fs.tree_entries(obj))
+        elif cmd==COMMAND_RETURN_BUCKETS:
+            self.tree_requests-=1
+            self.onRemoteEntries(obj)
+        elif cmd==COMMAND_PUSH_MANIFEST:
+            self.onManifest(*obj)
+        elif cmd==COMMAND_GET_CHUNKS:
+            for h in obj:
+                self.sendChunk(h)
+        elif cmd==COMMAND_ANNOUNCE:
+            for ident, size in obj:
+                self.man.onAnnounce(self, ident, size)
+        elif cmd==COMMAND_DATA_OPEN:
+            self.onDataOpen(*obj)
+        elif cmd==COMMAND_OFFER:
+            self.man.onOffer(self, obj)
+        elif cmd==COMMAND_STORED:
+            self.man.onStored(self, obj)
+        elif cmd==COMMAND_MISSING:
+            self.man.onMissing(self, obj)
+        self.__check_synced__()
+    def sendChunk(self, h):
+        data = self.man.fs.chunkstore.get(h)
+        self.sendMessage(bytes([COMMAND_PUSH_CHUNK])+len(data).to_bytes(4, 'little')+data)
+    def onManifest(self, ident, data, epath, manifest):
+        fs = self.man.fs
+        if fs.has_data(ident) or fs.chunkstore==None:
+            self.__file_received__(ident, data, 0)
+            return
+        # only ask for the chunks we don't have and haven't asked for yet
+        missing = set(h for h, size in manifest if not fs.chunkstore.has(h))
+        request = list(missing-self.chunks_requested)
+        self.chunks_requested.update(request)
+        self.manifests.append([ident, data, manifest, missing])
+        if len(request)>0:
+            self.sendJson(COMMAND_GET_CHUNKS, request)
+        self.__finish_manifests__()
+    def onChunk(self, h):
+        self.chunks_requested.discard(h)
+        for i in self.manifests:
+            i[3].discard(h)
+        self.__finish_manifests__()
+    def __finish_manifests__(self):
+        # finish every file that isn't missing any chunks anymore
+        done = [i for i in self.manifests if len(i[3])==0]
+        for ident, data, manifest, missing in done:
+            self.manifests.remove([ident, data, manifest, missing])
+            self.man.fs.write_manifest(ident, manifest)
+            self.__file_received__(ident, data, sum(i[1] for i in manifest))
+    def onDataOpen(self, sid, ident, data, epath, size, offset=0, digest=None):
+        # the file goes where we keep it, whatever epath the peer uses
+        if sid in self.incoming.keys() or offset<0 or offset>size:
+            raise ConnectionError("Malformed COMMAND_DATA_OPEN from peer")
+        if self.signer==None:
+            # only a signed sha256 vouches for the pieces
+            digest = None
+        self.incoming[sid] = IncomingFile(self.man, ident, data, size, offset, digest)
+        if self.incoming[sid].left<=0 and not self.resumes():
+            self.__stream_done__(sid)
+    def onData(self, sid, data):
+        incoming = self.incoming.get(sid)
+        if incoming==None or len(data)>incoming.left:
+            raise ConnectionError("Unexpected data from peer")
+        if self.man.require_signed and incoming.digest==None:
+            raise ConnectionError("Unsigned data from peer")
+        incoming.write(data)
+        incoming.unacked+=len(data)
+        if incoming.left==0:
+            if not self.resumes():
+                self.__stream_done__(sid)
+        elif incoming.unacked>=MUX_WINDOW//2:
+            # what was sent is written, the peer may send more
+            self.sendMessage(bytes([COMMAND_WINDOW])+sid.to_bytes(4, 'little')+incoming.unacked.to_bytes(4, 'little'))
+            incoming.unacked = 0
+    def onDataEnd(self, sid, digest):
+        incoming = self.incoming.get(sid)
+        if incoming==None or incoming.left!=0:
+            raise ConnectionError("Unexpected end of stream from peer")
+        self.__stream_done__(sid, digest.hex())
+    def __stream_done__(self, sid, digest=None):
+        incoming = self.incoming.pop(sid)
+        self.__received__(incoming, digest)
+    def __received__(self, incoming, digest=None):
+        if incoming.finish(digest):
+            self.__file_received__(incoming.ident, incoming.data, incoming.size)
+        elif incoming.failed:
+            log.warning("[sync] dropped %s, it did not arrive intact", incoming.ident, extra={'event':'corrupt', 'ident':incoming.ident})
+            self.man.metrics.count('corrupt')
+            self.man.scheduler.failed(incoming.ident)
+    def onWindow(self, sid, n):
+        t = self.transfers.get(sid)
+        if t!=None:
+            t.window+=n
+            self.__kick__()
+    def __file_received__(self, ident, data, size):
+        self.man.fs.try_create_entry(ident, data)
+        self.man.fileReceived(ident, size)
+        self.man.fs.flush()
+    def entryArrived(self, ident):
+        '''called when an entry arrived from any peer.'''
+        self.waiting.discard(tuple(ident))
+        self.__check_synced__()
+    def __check_synced__(self):
+        # the remote sequence number is only saved once every entry it covers has arrived
+        if self.pending_seq!=None and len(self.waiting)==0 and self.tree_requests==0:
+            self.man.fs.set_remote_seq(*self.pending_seq)
+            self.pending_seq = None
+            if self.sync_started!=None:
+                took = time.perf_counter()-self.sync_started
+                self.sync_started = None
+                self.man.metrics.observe('sync', took)
+                log.info("synced with %s in %.3f s", self.remote['node'], took, extra={'event':'synced', 'node':self.remote['node'], 'seconds':took})
+    def pushFsChange(self, ident, offset=0):
+        '''queues ident to be pushed to the peer, from offset on if the peer has the start already.'''
+        self.pushes.append((ident, offset))
+        self.__kick__()
+    def __start_push__(self, ident, offset):
+        if not self.man.fs.has_data(ident):
+            # kept on other nodes, see Manager replicas
+            log.debug("no data for %s", ident)
+            if self.remote!=None and 'placement' in self.remote['caps']:
+                self.sendJson(COMMAND_MISSING, [ident])
+            return
         fn = self.man.fs.localPathOf(ident)
         idx = fn.rfind('/')
         epath = fn[idx+1:]
         data = self.man.fs.files[ident[0]][ident[1]]
-        with open(fn, 'rb') as f:
-            # get file size
-            f.seek(0,2)
-            f_size = f.tell()
-            
-            # go back to the beginning
-            f.seek(0)
-
+        manifest = self.man.fs.manifest(ident)
+        if manifest!=None and self.remote!=None and 'chunks' in self.remote['caps']:
+            # the peer will ask for the chunks it doesn't have
+            self.sendJson(COMMAND_PUSH_MANIFEST, [ident, data, epath, manifest])
+            return
+        f, f_size = self.man.fs.open_data(ident)
+        signed = self.man.keypair!=None
+        if signed and not (self.remote!=None and 'signed_streams' in self.remote['caps']):
+            # the signature covers the whole message, so the file can't be streamed
+            with f:
+                packet_content = json.dumps([ident, data, epath])
+                self.sendMessage(bytes([COMMAND_PUSH_FS_CHANGE])+len(packet_content).to_bytes(2, 'little')+packet_content.encode()+f_size.to_bytes(4, 'little')+f.read(f_size))
+        elif self.remote!=None and 'mux' in self.remote['caps']:
+            sid = self.next_sid
+            self.next_sid+=1
+            digest = self.man.fs.known_digest(ident, f_size)
+            if offset>0 and offset<=f_size and self.resumes():
+                if digest==None:
+                    # the part the peer has won't be read, so the hash has to be worked out first
+                    digest = self.man.fs.digest(ident)
+                f.seek(offset)
+            else:
+                offset = 0
+            header = [sid, ident, data, epath, f_size]
+            if signed:
+                # the signature covers the sha256 of the file instead of the file
+                if digest==None:
+                    digest = self.man.fs.digest(ident)
+                header+=[offset, digest]
+            elif offset>0:
+                header.append(offset)
+            self.sendJson(COMMAND_DATA_OPEN, header)
+            t = Transfer(f, f_size-offset, sid, ident=ident, digest=digest)
+            if t.left==0:
+                f.close()
+                self.__end_stream__(t)
+            else:
+                self.transfers[sid] = t
+        else:
             # generate JSON header
             packet_content = json.dumps([ident, data, epath])
-
-            # send command and header data
-            self.sok.sendall(bytes([COMMAND_PUSH_FS_CHANGE])+len(packet_content).to_bytes(2, 'little')+packet_content.encode())
-
-            # send file data in 2048 byte chunks to avoid wasting memory
-            self.sok.sendall(f_size.to_bytes(4, 'little'))
-            for i in range(math.ceil(f_size/2048)):
-                self.sok.sendall(f.read(2048))
+            header = bytes([COMMAND_PUSH_FS_CHANGE])+len(packet_content).to_bytes(2, 'little')+packet_content.encode()+f_size.to_bytes(4, 'little')
+            self.outq.append(Transfer(f, f_size, header=header))
+    def pushFsChanges(self, idents):
+        '''pushes several entries, small ones are framed back to back and go out in one write.'''
+        self.corked = True
+        try:
+            for ident in idents:
+                self.pushFsChange(ident)
+        finally:
+            self.corked = False
+        self.__kick__()
     def sendFsJson(self):
-        # send command
-        self.sok.sendall(bytes([COMMAND_RETURN_FS_JSON]))
         # we want to send only what has been flushed to the disk
-        self.__send_file__(self.man.fs.corepath)
+        if self.man.fs.journal==None and self.man.keypair==None:
+            self.__send_file__(self.man.fs.corepath, bytes([COMMAND_RETURN_FS_JSON]))
+            return
+        if self.man.fs.journal==None:
+            with open(self.man.fs.corepath, 'rb') as f:
+                fs_json = f.read()
+        else:
+            # fsdat.json is only a snapshot in journal mode, the journal holds the newer entries
+            fs_json = compactfiles.dumps(self.man.fs.snapshot()).encode()
+        self.sendMessage(bytes([COMMAND_RETURN_FS_JSON])+len(fs_json).to_bytes(4, 'little')+fs_json)
     def requestFileFromIdent(self, ident):
+        have = None
+        if self.resumes() and not tuple(ident) in self.man.receiving:
+            have = self.man.fs.part_size(ident)
+        if have!=None:
+            # we have the start of the file from an earlier attempt
+            ident = list(ident)+[have]
         packet_content = json.dumps(ident)
-        self.sok.sendall(bytes([COMMAND_GET_FILE])+len(packet_content).to_bytes(2, 'little')+packet_content.encode())
+        self.sendMessage(bytes([COMMAND_GET_FILE])+len(packet_content).to_bytes(2, 'little')+packet_content.encode())
         
-    def update(self):
-        try:
-            tmp = self.sok.recv(8192)
+    def update(self, max_reads=16):
+        # read everything that is waiting (up to max_reads buffers) so a busy peer isn't held back by the polling
+        for i in range(max_reads):
+            try:
+                n = (self.inbuffer if self.rawbuffer==None else self.rawbuffer).recv_into(self.sok)
 
-            # tmp will be empty if the socket was closed by the remote
-            if tmp==b'':
-                raise Exception("Peer Disconnected")
-            self.inbuffer+=tmp
-        except (BlockingIOError, ssl.SSLError):
-            return # if there's no new data then just leave the function
+                # n will be zero if the socket was closed by the remote
+                if n==0:
+                    raise ConnectionError("Peer Disconnected")
+            except (BlockingIOError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                break # if there's no new data then stop reading
+            self.__count_received__(n)
+            self.feed()
+    def feed(self, data=None):
+        '''runs the protocol state machine on data received from the peer.
+data is only needed if it was not received straight into inbuffer.'''
+        if data!=None:
+            (self.inbuffer if self.rawbuffer==None else self.rawbuffer).extend(data)
+            self.__count_received__(len(data))
+        if self.rawbuffer!=None:
+            self.__unframe__()
 
         if not self.isSynced:
             self.sync()
-        
+        self.__parse__()
+    def __count_received__(self, n):
+        self.received+=n
+        self.man.metrics.count('bytes_in', n)
+    def __unframe__(self):
+        # moves the payload of every complete frame from rawbuffer to inbuffer
+        raw = self.rawbuffer
+        stats = self.man.compress_stats
+        while True:
+            if self.raw_left>0:
+                n = min(len(raw), self.raw_left)
+                with raw.view(n) as data:
+                    self.inbuffer.extend(data)
+                raw.consume(n)
+                self.raw_left-=n
+                if self.raw_left>0:
+                    break
+            if len(raw)<compression.FRAME.size:
+                break
+            with raw.view(compression.FRAME.size) as header:
+                codec, size, n = compression.FRAME.unpack(header)
+            if codec==compression.CODEC_RAW:
+                if size!=n:
+                    raise ConnectionError("Malformed frame from peer")
+                raw.consume(compression.FRAME.size)
+                self.raw_left = n
+                continue
+            if size>compression.MAX_FRAME or n>compression.MAX_FRAME:
+                raise ConnectionError("Frame from peer is too large")
+            if len(raw)<compression.FRAME.size+n:
+                break
+            raw.consume(compression.FRAME.size)
+            start = time.thread_time()
+            data = compression.decompress(codec, raw.read(n), size)
+            stats['decompress_cpu']+=time.thread_time()-start
+            stats['received']+=n
+            stats['inflated']+=size
+            self.inbuffer.extend(data)
+    def runVerified(self):
+        '''runs the signed messages whose signatures have been checked, in the order they arrived.'''
+        while len(self.verifying)>0 and self.verifying[0][2]!=None:
+            vk, data, ok = self.verifying.popleft()
+            if not ok:
+                raise ConnectionError("Bad signature from peer")
+            # the message is parsed on its own, with the state of the outer stream put aside
+            saved = self.inbuffer, self.state, self.state_val, self.current_command, self.cmd_time
+            self.inbuffer = RecvBuffer(len(data))
+            self.inbuffer.extend(data)
+            self.state = 0
+            self.current_command = -1
+            self.cmd_time = None
+            self.signer = vk
+            try:
+                self.__parse__()
+                if self.state!=0 or len(self.inbuffer)>0:
+                    raise ConnectionError("Malformed signed command")
+            finally:
+                self.inbuffer, self.state, self.state_val, self.current_command, self.cmd_time = saved
+                self.signer = None
+        if len(self.verifying)==0:
+            # unsigned messages were held back until the signed ones before them had run
+            self.__parse__()
+    def __verify__(self, vk, sig, data):
+        if self.man.trusted_keys!=None and not vk in self.man.trusted_keys:
+            # no point checking the signature of a key we don't accept
+            raise ConnectionError("Message signed by an untrusted key")
+        entry = [vk, data, None]
+        self.verifying.append(entry)
+        self.man.verifier.submit(self, entry, sig, self.man.trusted_keys!=None)
+    def __parse__(self):
+        buf = self.inbuffer
         cmd = self.current_command
+        # time spent waiting for the rest of a command isn't counted, only the time in here
+        mark = time.perf_counter()
         # breaks when it needs more data to parse
         while True:
             #print('{   '+repr(self)+' '+str(self.state)+' '+cmd_strs[cmd]+'\n')
             if self.state==0:
-                if len(self.inbuffer)==0:
+                if self.cmd_time!=None:
+                    now = time.perf_counter()
+                    self.__command_done__(cmd, now-mark)
+                    mark = now
+                if len(buf)==0:
                     self.state = 0
                     break
+                signed = buf.peek() & COMMAND_SIGNED_FLAG
+                if self.signer==None and not signed:
+                    if len(self.verifying)>0:
+                        # keep the order of the messages, this one runs after the signed ones before it
+                        break
+                    if self.man.require_signed and not buf.peek() in UNSIGNED_COMMANDS:
+                        raise ConnectionError("Unsigned command from peer")
+                elif self.signer!=None and signed:
+                    raise ConnectionError("Malformed signed command")
                 # reading new command byte
-                # for now I will not support authentication
-                self.current_command = cmd = self.inbuffer[0] & 255
+                self.current_command = cmd = buf.read_int(1) & 255
+                self.cmd_time = 0.0
 
                 self.state = 1
-                self.inbuffer = self.inbuffer[1:]
+            elif self.state==1 and cmd & COMMAND_SIGNED_FLAG:
+                # public key, signature and the length of the signed message
+                if len(buf)<132:
+                    break
+                self.state_val = [buf.read(64), buf.read(64), buf.read_int(4)]
+                self.state = 2
+            elif self.state==2 and cmd & COMMAND_SIGNED_FLAG:
+                vk, sig, n = self.state_val
+                if len(buf)<n:
+                    break
+                data = buf.read(n)
+                if n==0 or data[0] & COMMAND_SIGNED_FLAG:
+                    raise ConnectionError("Malformed signed command")
+                self.state = 0
+                self.__verify__(vk, sig, data)
             elif self.state==1:
                 self.state = 2
                 if cmd==COMMAND_PUSH_FS_CHANGE or cmd==COMMAND_GET_FILE:
-                    if len(self.inbuffer)<2:
+                    if len(buf)<2:
                         self.state = 1
                         break
                     # store size of packet content in state_val
-                    self.state_val = int.from_bytes(self.inbuffer[:2], 'little')
-                    self.inbuffer=self.inbuffer[2:]
+                    self.state_val = buf.read_int(2)
+                elif cmd==COMMAND_FRAMED:
+                    if self.signer!=None or self.rawbuffer!=None:
+                        raise ConnectionError("Unexpected COMMAND_FRAMED from peer")
+                    # everything after it is framed, including what is already in the buffer
+                    self.rawbuffer = RecvBuffer()
+                    with buf.view(len(buf)) as rest:
+                        self.rawbuffer.extend(rest)
+                    buf.consume(len(buf))
+                    self.__unframe__()
+
+                    # now return to state zero
+                    self.state = 0
                 elif cmd==COMMAND_GET_FS_JSON:
+                    if self.remote==None and not self.legacy:
+                        # only peers without delta sync ask for the JSON without a hello
+                        self.legacy = True
+                        if self.isSynced:
+                            self.sync()
                     self.sendFsJson()
 
                     # now return to state zero
                     self.state = 0
+                elif cmd==COMMAND_DATA or cmd==COMMAND_WINDOW:
+                    # stream id and a byte count
+                    if len(buf)<8:
+                        self.state = 1
+                        break
+                    self.state_val = [buf.read_int(4), buf.read_int(4)]
+                    if cmd==COMMAND_WINDOW:
+                        self.onWindow(*self.state_val)
+
+                        # now return to state zero
+                        self.state = 0
+                elif cmd==COMMAND_DATA_END:
+                    # stream id and sha256
+                    if len(buf)<36:
+                        self.state = 1
+                        break
+                    self.onDataEnd(buf.read_int(4), buf.read(32))
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd==COMMAND_GET_CHANGES:
+                    if len(buf)<8:
+                        self.state = 1
+                        break
+                    self.sendChanges(buf.read_int(8))
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd==COMMAND_RETURN_CHANGES or cmd==COMMAND_PUSH_CHUNK or cmd in JSON_COMMANDS:
+                    if len(buf)<4:
+                        self.state = 1
+                        break
+                    self.state_val = buf.read_int(4)
                 elif cmd==COMMAND_RETURN_FS_JSON:
                     # got the new JSON, need to read 4-byte file length
-                    if len(self.inbuffer)<4:
+                    if len(buf)<4:
                         self.state = 1
                         break
-                    self.state_val = int.from_bytes(self.inbuffer[:4], 'little')
-                    self.inbuffer=self.inbuffer[4:]
-                    
-                    # INSERT HONEYPOT FOR MEMORY ATTACK HERE
-                    #     Essentially, someone could claim their JSON is 4GB in size, and send 4GB of data.
-                    #     Doing this would waste 4GB of RAM, which is not trivial.  A honeypot could be created
-                    #     here to protect the machine running this software and attack the attacker.
+                    # the JSON is parsed as it arrives, so a peer claiming a 4GB JSON can't make us buffer
+                    # it.  Only one name at a time is kept, up to json_limit bytes.
+                    self.state_val = [buf.read_int(4), FsJsonStream(self.onRemoteName, self.man.json_limit)]
                     
                     # INSERT HONEYPOT FOR CPU USAGE ATTACK HERE
                     #     An attacker could send large, valid JSON filesystems in quick succession.  These need
@@ -246,52 +2102,80 @@ class Peer:
                 self.state = 3
                 if cmd==COMMAND_PUSH_FS_CHANGE:
                     # make sure more can be loaded
-                    if len(self.inbuffer)<self.state_val:
+                    if len(buf)<self.state_val:
                         self.state = 2
                         break
-                    ident, data, epath = json.loads(self.inbuffer[:self.state_val])
-                    self.inbuffer = self.inbuffer[self.state_val:]
-                    self.man.fs.try_create_entry(ident, data)
-                    q=None
-                    loc = os.path.join(self.man.fs.loc, epath)
-                    if not os.path.isfile(loc):
-                        q = open(loc, 'wb')
-                    self.state_val = [q, -1]
+                    ident, data, epath = json.loads(buf.read(self.state_val))
+                    # the entry is created once the file is complete, an interrupted transfer is retried
+                    self.state_val = [ident, data]
                 elif cmd==COMMAND_GET_FILE:
-                    ident = json.loads(self.inbuffer[:self.state_val])
-                    self.inbuffer = self.inbuffer[self.state_val:]
+                    if len(buf)<self.state_val:
+                        self.state = 2
+                        break
+                    ident = json.loads(buf.read(self.state_val))
 
-                    print("Sending", ident, 'to peer as requested')
+                    log.debug("sending %s to peer as requested", ident)
                     # this will send the peer all the data it needs
-                    self.pushFsChange(ident)
+                    self.pushFsChange(ident[:2], ident[2] if len(ident)>2 else 0)
 
                     # now return to state zero
                     self.state = 0
                 elif cmd==COMMAND_RETURN_FS_JSON:
-                    # load the entire JSON in the buffer first
-                    if len(self.inbuffer)<self.state_val:
+                    # every name is compared as soon as it is in, files are requested before the rest arrives
+                    left, stream = self.state_val
+                    n = min(len(buf), left)
+                    if n>0:
+                        with buf.view(n) as data:
+                            stream.feed(data)
+                        buf.consume(n)
+                        self.state_val[0] = left-n
+                    if left>n:
+                        self.state = 2
+                        break
+                    stream.finish()
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd==COMMAND_DATA:
+                    # file data goes straight from the receive buffer to the file
+                    sid, left = self.state_val
+                    n = min(len(buf), left)
+                    if n>0:
+                        with buf.view(n) as data:
+                            self.onData(sid, data)
+                        buf.consume(n)
+                        self.state_val[1] = left-n
+                    if left>n:
                         self.state = 2
                         break
-                    fs_data = json.loads(self.inbuffer[:self.state_val])
-                    self.inbuffer = self.inbuffer[self.state_val:]
-
-                    # now we have the FS data, time to compare.
-                    for k, v in fs_data.items():
-                        print("[sync] checking ",k)
-                        if k in self.man.fs.files.keys():
-                            # the key is there; are there new file versions though?
-                            for val in v.keys():
-                                if not val in self.man.fs.files[i].keys():
-                                    # a new entry
-                                    ident = [k, val]
-                                    self.requestFileFromIdent(ident)
-                                    print('[sync] requesting',ident)
-                        else:
-                            # a new key entirely!
-                            for val in v.keys():
-                                ident = [k, val]
-                                self.requestFileFromIdent(ident)
-                                print('[sync] requesting',ident)
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd==COMMAND_RETURN_CHANGES:
+                    if len(buf)<self.state_val:
+                        self.state = 2
+                        break
+                    delta = json.loads(buf.read(self.state_val))
+                    self.onRemoteEntries(delta['changes'])
+                    self.pending_seq = [delta['node'], delta['seq']]
+                    self.__check_synced__()
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd in JSON_COMMANDS:
+                    if len(buf)<self.state_val:
+                        self.state = 2
+                        break
+                    self.__handle_json__(cmd, json.loads(buf.read(self.state_val)))
+
+                    # now return to state zero
+                    self.state = 0
+                elif cmd==COMMAND_PUSH_CHUNK:
+                    if len(buf)<self.state_val:
+                        self.state = 2
+                        break
+                    # the chunk is stored under the hash of what arrived, a corrupt chunk can't satisfy a manifest
+                    self.onChunk(self.man.fs.chunkstore.put(buf.read(self.state_val)))
 
                     # now return to state zero
                     self.state = 0
@@ -299,32 +2183,38 @@ class Peer:
                 self.state = 4
                 if cmd==COMMAND_PUSH_FS_CHANGE:
                     # 4 bytes to encode length of file
-                    if len(self.inbuffer)<4:
+                    if len(buf)<4:
                         self.state = 3
                         break
-                    self.state_val[1] = int.from_bytes(self.inbuffer[:4], 'little')
-                    self.inbuffer = self.inbuffer[4:]
+                    ident, data = self.state_val
+                    self.state_val = [IncomingFile(self.man, ident, data, buf.read_int(4))]
             elif self.state==4:
                 if cmd==COMMAND_PUSH_FS_CHANGE:
-                    f = self.state_val[0]
-                    if len(self.inbuffer)>self.state_val[1]:
-                        next_data = self.inbuffer[:self.state_val[1]]
-                        self.inbuffer = self.inbuffer[self.state_val[1]:]
-                    else:
-                        next_data = self.inbuffer
-                        self.inbuffer = b''
-                    if f!=None:
-                        f.write(next_data)
-                    if len(next_data)==self.state_val[1]:
+                    incoming = self.state_val[0]
+                    n = min(len(buf), incoming.left)
+
+                    # file data goes straight from the receive buffer to the file
+                    if n>0:
+                        with buf.view(n) as next_data:
+                            incoming.write(next_data)
+                    buf.consume(n)
+                    if incoming.left==0:
                         self.state = 0  # all data is read, more may be in buffer.
-                        f.close()
-                        self.man.fs.flush()
+                        self.__received__(incoming)
                     else:
                         self.state = 4  # more to read; break & wait for more data to be available
-                        self.state_val[1]-=len(next_data)
-                        self.state = 4
                         break
             #print(repr(self)+' '+str(self.state)+' '+cmd_strs[cmd]+'  }\n')
+        if self.cmd_time!=None:
+            if self.state==0:
+                self.__command_done__(cmd, time.perf_counter()-mark)
+            else:
+                self.cmd_time+=time.perf_counter()-mark
+    def __command_done__(self, cmd, seconds):
+        # signed commands are counted once for the signature and again when they run
+        name = 'COMMAND_SIGNED' if cmd & COMMAND_SIGNED_FLAG else cmd_strs.get(cmd, str(cmd))
+        self.man.metrics.observe('cmd.'+name, self.cmd_time+seconds)
+        self.cmd_time = None
 
 if __name__=='__main__':                      
     fs = pyonefs.PyOneFS('./fs')
@@ -1,66 +1,802 @@
-import os, json, random
+import os, io, json, random, _thread, threading, hashlib, bisect, heapq, time, functools, logging
+import concurrent.futures
+from . import chunkstore, compactfiles, metaimage, metrics
+log = logging.getLogger(__name__)
+
+# smaller files are hashed again when needed, keeping a .sha256 for them costs more than that
+DIGEST_MIN = 1<<20
+
+# version ids are the time in ms shifted left by STAMP_BITS plus random bits, in hex, so the versions of a name
+# sort the same on every node.  Ids below STAMPED were made before and carry no time.
+STAMP_BITS = 20
+STAMPED = 1<<40
+
+def version_key(vec):
+    '''sort key of a version id: ids without a time sort first (and keep their order), then by time.'''
+    try:
+        n = int(vec, 16)
+    except ValueError:
+        return 0
+    return n if n>=STAMPED else 0
+
+# when flush makes changes durable: before it returns (fsync), at the next group commit (fsync once for every
+# writer in the batch), or whenever the OS writes them out
+DURABILITY = ['immediate', 'batched', 'buffered']
+
+def done_future():
+    f = concurrent.futures.Future()
+    f.set_result(None)
+    return f
 
 class PyOneFile:
-    def __init__(self, fs, ident, loc, mode, ext):
+    def __init__(self, fs, ident, loc, mode, ext, f=None):
         self.fs = fs
         self.id = ident
         self.loc = loc
-        self.f = open(loc, mode)
+        if f==None:
+            f = open(loc, mode)
+        self.f = f
         self.ext = ext
         self.mode = mode
+        # Future of the last flush, done once the entry is durable
+        self.commit = None
     def write(self, data):
         self.f.write(data)
     def read(self, n=-1):
         return self.f.read(n)
     def flush(self):
+        '''returns a concurrent.futures.Future that is done once the data and the entry are durable.'''
         if not self.mode[0] in ['w', 'a']:
             raise Exception("Not opened for writing!")
         self.f.flush()
+        # the data has to be on the disk before the entry pointing to it
+        self.fs.wrote_data(self.loc, self.f)
         if self.fs.files[self.id[0]][self.id[1]]==None:
-            self.fs.files[self.id[0]][self.id[1]] = self.ext
+            self.fs.set_entry(self.id, self.ext)
             for i in self.fs.listeners:
                 i.onEntryCreate(self.fs, self.id, self.ext)
-        self.fs.flush()
+        self.commit = self.fs.flush()
+        return self.commit
     def close(self):
+        '''returns the id of the entry.  Wait on commit to know it is durable.'''
         if self.mode[0] in ['w', 'a']:
             self.flush()
+            self.f.close()
+            if self.fs.chunkstore!=None:
+                self.fs.store_chunks(self.id)
             for i in self.fs.listeners:
                 i.onFileWritten(self.fs, self.id, self.loc)
-        self.f.close()
+        else:
+            self.f.close()
         return self.id
 
+# levels below the root of the HashTree of a filesystem
+TREE_DEPTH = 16
+
+def tree_hash(name, vec, depth=TREE_DEPTH):
+    '''returns (hash, bucket) of an entry in a HashTree of the given depth.'''
+    digest = hashlib.sha1((name+':'+vec).encode()).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:12], 'little')>>(32-depth)
+
+class HashTree:
+    '''Bucketed hash summary of the complete entries of a filesystem.  Each entry is hashed into one of
+2**depth buckets and every node of the tree holds the XOR of the entry hashes below it, so adding an
+entry touches one node per level.  Two nodes find their differences by comparing the trees top-down.'''
+    def __init__(self, depth=TREE_DEPTH, newlist=list, base=None):
+        '''newlist makes the list holding the [name, id] of the entries in a bucket.
+base is a metaimage.MetaImage holding the tree of the entries that are already in the image.'''
+        self.depth = depth
+        self.newlist = newlist
+        self.rebase(base)
+        if base==None:
+            self.levels = [[0]*(1<<i) for i in range(depth+1)]
+        else:
+            self.levels = base.tree_levels()
+    def rebase(self, base, entries=()):
+        '''switches to another image, entries are the [name, id] that are not in it.  The hashes don't change.'''
+        self.base = base
+        self.buckets = {}
+        for name, vec in entries:
+            self.__bucket_add__(self.hashOf(name, vec)[1], name, vec)
+    def hashOf(self, name, vec):
+        '''returns (hash, bucket) of an entry.'''
+        return tree_hash(name, vec, self.depth)
+    def add(self, name, vec):
+        h, bucket = self.hashOf(name, vec)
+        for level in range(self.depth+1):
+            self.levels[level][bucket>>(self.depth-level)] ^= h
+        self.__bucket_add__(bucket, name, vec)
+    def __bucket_add__(self, bucket, name, vec):
+        if not bucket in self.buckets.keys():
+            self.buckets[bucket] = self.newlist()
+        self.buckets[bucket].append([name, vec])
+    def nodes(self, level, indices):
+        '''returns the hashes of the nodes at the given indices of a level.  Level 0 is the root.'''
+        return [self.levels[level][i] for i in indices]
+    def bucket(self, i):
+        if self.base!=None:
+            return self.base.bucket(i)+list(self.buckets.get(i, []))
+        return self.buckets.get(i, [])
+
+class SortedKeys:
+    '''Sorted set of names kept as a list of sorted blocks, so adding a name to millions of them only copies
+the names of one block.  Lookups bisect the last name of every block and then the block, so a range of
+k names is found in O(log N + k).
+Names are added by one thread at a time and read by any number without locking: add never changes a
+block, it swaps in new lists as one (blocks, maxes, length) tuple, so a reader keeps the version it
+started with.'''
+    def __init__(self, keys=(), block=1000):
+        self.block = block
+        keys = sorted(keys)
+        blocks = [keys[i:i+block] for i in range(0, len(keys), block)]
+        self.state = (blocks, [i[-1] for i in blocks], len(keys))
+    def __len__(self):
+        return self.state[2]
+    def __contains__(self, key):
+        blocks, maxes, length = self.state
+        i = bisect.bisect_left(maxes, key)
+        if i==len(maxes):
+            return False
+        b = blocks[i]
+        j = bisect.bisect_left(b, key)
+        return j<len(b) and b[j]==key
+    def add(self, key):
+        blocks, maxes, length = self.state
+        if len(blocks)==0:
+            self.state = ([[key]], [key], 1)
+            return
+        i = min(bisect.bisect_left(maxes, key), len(maxes)-1)
+        b = blocks[i]
+        j = bisect.bisect_left(b, key)
+        if j<len(b) and b[j]==key:
+            return
+        b = b[:j]+[key]+b[j:]
+        blocks = list(blocks)
+        maxes = list(maxes)
+        if len(b)>2*self.block:
+            # split the block so inserting stays cheap
+            blocks[i:i+1] = [b[:self.block], b[self.block:]]
+            maxes[i:i+1] = [b[self.block-1], b[-1]]
+        else:
+            blocks[i] = b
+            maxes[i] = b[-1]
+        self.state = (blocks, maxes, length+1)
+    def irange(self, start, stop=None):
+        '''yields the names from start up to but not including stop, in order.'''
+        blocks, maxes, length = self.state
+        i = bisect.bisect_left(maxes, start)
+        if i==len(blocks):
+            return
+        j = bisect.bisect_left(blocks[i], start)
+        while i<len(blocks):
+            b = blocks[i]
+            while j<len(b):
+                if stop!=None and b[j]>=stop:
+                    return
+                yield b[j]
+                j+=1
+            i+=1
+            j = 0
+    def prefixed(self, prefix):
+        '''yields the names starting with prefix, in order.'''
+        for k in self.irange(prefix):
+            if not k.startswith(prefix):
+                return
+            yield k
+
+def extOf(name):
+    '''returns the extension of a name including the dot, or '' if it doesn't have one.'''
+    i = name.rfind('.')
+    if i==-1 or '/' in name[i:]:
+        return ''
+    return name[i:]
+
 class PyOneFS:
-    def __init__(self, location, create_if_not_exist=True):
+    def __init__(self, location, create_if_not_exist=True, journal=False, compact_after=10000, chunks=False, compact=False, lazy=False,
+                 durability='buffered', commit_interval=.01, commit_size=1000):
+        '''If journal is True then metadata changes are appended to fsdat.journal instead of rewriting
+fsdat.json on every flush.  Once compact_after records are in the journal it is folded into fsdat.json
+by a background thread.
+If chunks is True then file data is kept in a content-addressed chunk store, see chunkstore.ChunkStore.
+If compact is True then the metadata is kept in a compactfiles.CompactFiles instead of dicts, for
+filesystems with millions of entries.
+If lazy is True then the metadata is memory-mapped from fsdat.img (see metaimage) and read when it is
+used, so opening takes about the same time whatever the size of the filesystem.  Implies journal.
+The image is rewritten with fsdat.json when the journal is compacted.
+durability says when flush makes the changes durable, see DURABILITY.  'immediate' writes and fsyncs them
+before it returns.  'batched' hands them to a thread that commits everything flushed within
+commit_interval seconds (or commit_size changes) with one fsync, flush only returns the Future of that
+commit.  'buffered' writes them without fsync.
+
+Any number of threads may use a PyOneFS at once (the application and the networking threads of a
+Manager do).  Changes to the metadata are made one at a time holding lock, which is only held while
+the metadata in memory is updated, never while file data is read or written or anything is synced.  Reads
+don't lock: names (ls, lsprefix, lsdir...) come from SortedKeys that are replaced rather than changed,
+the versions of a name are a dict that is replaced when a version is added (or rows that are complete
+before they are linked, with compact), and snapshot() shares those dicts, so listings and the
+filesystem JSON sent to peers see the filesystem as it was when they started.  Listeners are called
+on the thread that made the change.'''
+        if not durability in DURABILITY:
+            raise ValueError("Unknown durability: "+str(durability))
         self.loc = location
         self.corepath = os.path.join(location, 'fsdat.json')
+        self.imagepath = os.path.join(location, 'fsdat.img')
+        self.journalpath = os.path.join(location, 'fsdat.journal')
+        self.changespath = os.path.join(location, 'fschanges.log')
+        self.peerspath = os.path.join(location, 'fspeers.json')
         self.listeners = []
-        if not os.path.isfile(self.corepath):
+        self.lock = _thread.allocate_lock()
+        # one commit at a time, the metadata can change while fsdat.json is written
+        self.commit_lock = _thread.allocate_lock()
+        # the Manager of this filesystem adds its counters to the same Metrics
+        self.metrics = metrics.Metrics()
+        self.durability = durability
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        # data files (path: duplicate of the descriptor they were written with, or None) and changes written
+        # since the last commit, and the Futures waiting for it
+        self.unsynced = {}
+        self.uncommitted = 0
+        self.waiters = []
+        self.committer = None
+        self.journal = None
+        self.journal_len = 0
+        # journal records wait here for the commit that syncs their data, see __commit__
+        self.journal_lines = []
+        # latest time in a version id made or seen here, new ids go after it even if the clock is behind
+        self.last_stamp = 0
+        self.compact_after = compact_after
+        self.compacting = False
+        self.chunkstore = None
+        self.compact_files = compact
+        self.image = None
+        if lazy:
+            journal = True
+            if not self.__image_current__():
+                # first lazy start, or fsdat.json changed without the image: load everything once to write it
+                fs = PyOneFS(location, create_if_not_exist, journal=True, compact_after=compact_after, compact=compact)
+                with fs.lock:
+                    fs.changes.flush()
+                    changes = metaimage.ChangeLogFile(fs.changespath)
+                    changes.scan()
+                    fs.__write_image__(fs.files, changes)
+                fs.close()
+            self.image = metaimage.MetaImage(self.imagepath)
+            self.files = metaimage.LazyFiles(self.image)
+        elif not os.path.isfile(self.corepath):
             if create_if_not_exist:
                 os.makedirs(location, exist_ok=True)
                 self.files = {}
-                self.flush()
+                self.__write_snapshot__(self.files)
             else:
                 raise Exception("Filesystem not found.")
         else:
             with open(self.corepath) as f:
                 self.files = json.load(f)
+        if compact and self.image==None:
+            self.files = compactfiles.CompactFiles(self.files)
+        if journal:
+            self.__replay__()
+            self.journal = open(self.journalpath, 'a')
+        self.__load_changes__()
+        if chunks or os.path.isdir(os.path.join(location, 'chunks')):
+            # once files are in the chunk store it has to stay enabled to read them
+            self.chunkstore = chunkstore.ChunkStore(os.path.join(location, 'chunks'), sync=durability!='buffered')
+        if durability=='batched':
+            self.commit_cond = threading.Condition()
+            self.closing = False
+            # held until the committer is done, close() waits for it
+            self.committer = _thread.allocate_lock()
+            self.committer.acquire()
+            _thread.start_new_thread(self.__committer__, ())
+    def __replay__(self):
+        # a leftover .old journal means we crashed while compacting, so it has to be applied first
+        oldpath = self.journalpath+'.old'
+        for path in [oldpath, self.journalpath]:
+            if not os.path.isfile(path):
+                continue
+            # bytes of the journal up to the last complete record
+            good = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    # a torn write at the end of the journal, the record never made it to the disk
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        name, vec, data = json.loads(line)
+                    except ValueError:
+                        break
+                    good+=len(line)
+                    if name in self.files.keys():
+                        self.files[name][vec] = data
+                    else:
+                        self.files[name] = {vec:data}
+                    if path==self.journalpath:
+                        self.journal_len+=1
+            if path==self.journalpath and good<os.path.getsize(path):
+                # the records appended from now on would end up on the line of the torn one
+                os.truncate(path, good)
+        if os.path.isfile(oldpath):
+            self.__write_snapshot__(self.files)
+            os.remove(oldpath)
+    def __image_current__(self):
+        if not os.path.isfile(self.imagepath) or os.path.isfile(self.journalpath+'.old'):
+            return False
+        # the image is written after fsdat.json, a newer fsdat.json was written without it
+        return not os.path.isfile(self.corepath) or os.path.getmtime(self.corepath)<=os.path.getmtime(self.imagepath)
+    def __write_image__(self, files, changes):
+        # changes is the ChangeLogFile as it was when files was taken
+        if type(files)==metaimage.LazyFiles:
+            names = files.sorted_names()
+        else:
+            names = sorted(files.keys())
+        items = ((name, self.__ordered_versions__(files, name)) for name in names)
+        metaimage.write(self.imagepath, items, extOf, functools.partial(tree_hash, depth=self.tree_depth), self.tree_depth, changes)
+    def __ordered_versions__(self, files, name):
+        # [[id, data], ...] with the complete versions oldest first
+        versions = files[name] if type(files)==dict else files.plain(name)
+        out = [[k, v] for k, v in versions.items()]
+        order = list(self.version_order.get(name, []))
+        # ids without a time keep the order they have here
+        rank = {order[i]:i for i in range(len(order))}
+        out.sort(key=lambda i: (version_key(i[0]), rank.get(i[0], len(rank))))
+        return out
+    def __load_changes__(self):
+        # the change log numbers every entry in the order this node got it.  Peers use these sequence
+        # numbers to only ask for the entries they haven't seen yet.
+        if self.image!=None:
+            self.__load_lazy__()
+            return
+        # only the lines are counted, the changes are read from the file when peers ask for them
+        self.changelog = metaimage.ChangeLogFile(self.changespath)
+        self.changelog.count()
+        self.changes = open(self.changespath, 'a')
+        # built the first time a peer compares hash trees with us, see tree
+        self.hash_tree = None
+        self.tree_depth = TREE_DEPTH
+        count = 0
+        complete = set()
+        repeated = set()
+        for name, vec, data in self.__entries__():
+            if data!=None:
+                count+=1
+                if name in complete:
+                    repeated.add(name)
+                complete.add(name)
+        del complete
+        if count!=len(self.changelog):
+            # entries written before the change log existed (or lost in a crash) go at the end of it
+            logged = set(tuple(i) for i in self.changelog)
+            for name, vec, data in self.__entries__():
+                if data!=None and not (name, vec) in logged:
+                    self.__log_change__(name, vec)
+            del logged
+        self.__build_indexes__(repeated)
+        self.__load_peers__()
+    @property
+    def tree(self):
+        '''the HashTree of the complete entries.  Built the first time it is used, which reads every entry,
+then kept up to date.'''
+        if self.hash_tree==None:
+            with self.lock:
+                if self.hash_tree==None:
+                    self.hash_tree = self.__build_tree__()
+        return self.hash_tree
+    def __build_tree__(self):
+        # called holding lock
+        newlist = list
+        if self.compact_files:
+            # every list of entries only holds row numbers of the compact metadata
+            newlist = lambda: compactfiles.EntryList(self.files)
+        tree = HashTree(self.tree_depth, newlist)
+        for name, vec, data in self.__entries__():
+            if data!=None:
+                tree.add(name, vec)
+        return tree
+    def __load_lazy__(self):
+        image = self.image
+        self.changelog = metaimage.ChangeLogFile(self.changespath, image.changes_seq, image.changes_off, image.checkpoints)
+        # only the changes logged after the image was written are read
+        logged = set(tuple(i) for i in self.changelog.scan())
+        self.changes = open(self.changespath, 'a')
+        self.tree_depth = image.depth
+        self.hash_tree = HashTree(image.depth, base=image)
+        for name, vec in self.__overlay_completed__():
+            self.hash_tree.add(name, vec)
+            if not (name, vec) in logged:
+                self.__log_change__(name, vec)
+        del logged
+        self.__index_new_names__()
+        self.version_order = {}
+        self.__load_peers__()
+    def __overlay_completed__(self):
+        # [name, id] of the entries completed since the image was written, they are in the overlay
+        out = []
+        for name, versions in self.files.overlay.items():
+            old = dict(self.files.image_versions(name))
+            for vec, data in versions.items():
+                if data!=None and old.get(vec)==None:
+                    out.append([name, vec])
+        return out
+    def __index_new_names__(self):
+        # the image has its own name and extension indexes, only the names added since need to be indexed
+        self.names = metaimage.LazyNames(self.image, SortedKeys(self.files.new_names()))
+        self.exts = {}
+        for name in self.names.added.irange(''):
+            self.__index_ext__(name)
+    def __rebase__(self, image, snapshot):
+        # switches to a new image that holds everything in snapshot
+        with self.lock:
+            overlay = {}
+            for name, versions in self.files.overlay.items():
+                old = snapshot.overlay.get(name, {})
+                changed = {vec:data for vec, data in versions.items() if not vec in old.keys() or old[vec]!=data}
+                if len(changed)>0:
+                    overlay[name] = changed
+            self.image = image
+            self.files.image = image
+            self.files.overlay = overlay
+            self.hash_tree.rebase(image, self.__overlay_completed__())
+            self.__index_new_names__()
+    def __load_peers__(self):
+        if os.path.isfile(self.peerspath):
+            with open(self.peerspath) as f:
+                peers = json.load(f)
+            self.node_id = peers['node']
+            self.remote_seqs = peers['seqs']
+        else:
+            self.node_id = os.urandom(8).hex()
+            self.remote_seqs = {}
+            self.__write_peers__(self.remote_seqs)
+        self.peers_dirty = False
+    def __build_indexes__(self, repeated):
+        # names sorted for prefix and range listings, names by extension, and the complete versions of
+        # every name oldest first, see version_key.  repeated holds the names with more than one complete
+        # version, only they need their order kept.
+        self.names = SortedKeys(self.files.keys())
+        exts = {}
+        for name in self.files.keys():
+            ext = extOf(name)
+            if ext in exts.keys():
+                exts[ext].append(name)
+            else:
+                exts[ext] = [name]
+        self.exts = {k:SortedKeys(v) for k, v in exts.items()}
+        self.version_order = {}
+        arrival = set()
+        for name in repeated:
+            order = [k for k, v in self.files[name].items() if v!=None]
+            if min(version_key(k) for k in order)==0:
+                arrival.add(name)
+                order = []
+            self.version_order[name] = sorted(order, key=version_key)
+        if len(arrival)>0:
+            # ids without a time keep the order this node got them in
+            for name, vec in self.changelog:
+                if name in arrival and not vec in self.version_order[name]:
+                    self.version_order[name].append(vec)
+            for name in arrival:
+                self.version_order[name].sort(key=version_key)
+    def __entries__(self):
+        # every (name, id, data), without building the inner mappings of compact metadata
+        if self.compact_files:
+            return self.files.entries()
+        return ((name, vec, data) for name, versions in self.files.items() for vec, data in versions.items())
+    def __index_ext__(self, name):
+        ext = extOf(name)
+        if not ext in self.exts.keys():
+            self.exts[ext] = SortedKeys()
+        self.exts[ext].add(name)
+    def __index_version__(self, name, vec):
+        n = version_key(vec)
+        if n>0:
+            self.last_stamp = max(self.last_stamp, n>>STAMP_BITS)
+        if name in self.version_order.keys():
+            if vec in self.version_order[name]:
+                return
+            order = self.version_order[name]+[vec]
+        else:
+            order = [k for k, v in self.files[name].items() if v!=None and k!=vec]
+            if len(order)==0:
+                return
+            order.append(vec)
+        # replaced rather than changed, versions() doesn't lock
+        order.sort(key=version_key)
+        self.version_order[name] = order
+    def __log_change__(self, name, vec):
+        self.changelog.append([name, vec])
+        self.changes.write(json.dumps([name, vec])+'\n')
+    def __write_peers__(self, seqs):
+        tmppath = self.peerspath+'.tmp'
+        with open(tmppath, 'w') as f:
+            json.dump({'node':self.node_id, 'seqs':seqs}, f)
+            self.__sync__(f)
+        os.replace(tmppath, self.peerspath)
+    def __write_snapshot__(self, files):
+        # write to a temporary file and rename it so a crash never leaves a half-written fsdat.json
+        tmppath = self.corepath+'.tmp'
+        with open(tmppath, 'w') as f:
+            compactfiles.dump(files, f)
+            self.__sync__(f)
+        os.replace(tmppath, self.corepath)
+    def __sync__(self, f):
+        # forces what was written to f to the disk, unless the OS is left to do it
+        if self.durability!='buffered':
+            f.flush()
+            os.fsync(f.fileno())
+    def __sync_dir__(self):
+        # makes the renames in the filesystem directory durable
+        fd = os.open(self.loc, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    def wrote_data(self, path, f=None):
+        '''called once the data of an entry is written to path (from the open file f if given), before the
+entry is set.  The data is made durable before the entry is.'''
+        if self.durability=='immediate':
+            if f==None:
+                with open(path, 'rb') as f:
+                    os.fsync(f.fileno())
+            else:
+                os.fsync(f.fileno())
+        elif self.durability=='batched':
+            # a duplicate descriptor saves opening the file again to sync it
+            fd = None if f==None else os.dup(f.fileno())
+            with self.lock:
+                old = self.unsynced.pop(path, None)
+                if old!=None:
+                    os.close(old)
+                self.unsynced[path] = fd
+    def __compact__(self, snapshot, changes):
+        try:
+            self.__write_snapshot__(snapshot)
+            if self.image!=None:
+                self.__write_image__(snapshot, changes)
+                self.__rebase__(metaimage.MetaImage(self.imagepath), snapshot)
+            if self.durability!='buffered':
+                # the new fsdat.json has to be in place before the journal it replaces is gone
+                self.__sync_dir__()
+            os.remove(self.journalpath+'.old')
+        except Exception:
+            # the .old journal is kept, the next compaction folds it in
+            log.exception("compacting the journal failed", extra={'event':'compaction_failed'})
+        finally:
+            self.compacting = False
+    def compact(self):
+        '''Folds the journal into fsdat.json.  The snapshot is written by a background thread.'''
+        # a commit writes the journal without holding lock
+        with self.commit_lock, self.lock:
+            if self.journal==None or self.compacting:
+                return
+            self.compacting = True
+            self.journal.close()
+            oldpath = self.journalpath+'.old'
+            if os.path.isfile(oldpath):
+                # left by a compaction that failed, its records aren't in fsdat.json yet
+                with open(self.journalpath) as f, open(oldpath, 'a') as old:
+                    old.write(f.read())
+                    if self.durability!='buffered':
+                        old.flush()
+                        os.fsync(old.fileno())
+                os.remove(self.journalpath)
+            else:
+                os.replace(self.journalpath, oldpath)
+            self.journal = open(self.journalpath, 'a')
+            self.journal_len = 0
+            snapshot = self.__snapshot__()
+            changes = None
+            if self.image!=None:
+                self.changes.flush()
+                changes = metaimage.ChangeLogFile(self.changespath, self.changelog.length, self.changelog.end, self.changelog.checkpoints)
+        _thread.start_new_thread(self.__compact__, (snapshot, changes))
+    def snapshot(self):
+        '''returns a copy of the metadata that is safe to use while the filesystem is being modified.
+Write it with compactfiles.dump, it is not always a dict.'''
+        if type(self.files)==dict:
+            # the versions are never changed in place, so they can be shared
+            return self.__snapshot__()
+        with self.lock:
+            return self.__snapshot__()
+    def entries(self):
+        '''returns an iterator of (name, id, data) for every entry, over a snapshot.'''
+        files = self.snapshot()
+        if self.compact_files:
+            return files.entries()
+        return ((name, vec, data) for name, versions in files.items() for vec, data in versions.items())
+    def __snapshot__(self):
+        if type(self.files)!=dict:
+            return self.files.copy()
+        files = self.files
+        return {name:files[name] for name in self.names.irange('')}
     def flush(self):
-        with open(self.corepath, 'w') as f:
-            json.dump(self.files, f)
+        '''writes out the metadata changes so far, see durability.  Returns a concurrent.futures.Future that is
+done once they are durable.'''
+        if self.durability!='batched':
+            self.__commit__()
+            return done_future()
+        future = concurrent.futures.Future()
+        with self.commit_cond:
+            self.waiters.append(future)
+            # the committer only needs waking for the first flush of a commit, or a full one
+            if len(self.waiters)==1 or len(self.waiters)>=self.commit_size:
+                self.commit_cond.notify()
+        return future
+    def __commit__(self):
+        start = time.perf_counter()
+        sync = self.durability!='buffered'
+        with self.commit_lock:
+            # what goes into the commit is taken holding lock, it is synced without it so the filesystem can
+            # go on changing meanwhile
+            with self.lock:
+                unsynced = self.unsynced
+                self.unsynced = {}
+                self.uncommitted = 0
+                files = None
+                lines = None
+                if self.journal==None:
+                    files = self.__snapshot__()
+                else:
+                    lines = self.journal_lines
+                    self.journal_lines = []
+                self.changes.flush()
+                seqs = None
+                if self.peers_dirty:
+                    self.peers_dirty = False
+                    seqs = dict(self.remote_seqs)
+            for path, fd in unsynced.items():
+                if fd!=None:
+                    os.fsync(fd)
+                    os.close(fd)
+                    continue
+                try:
+                    with open(path, 'rb') as f:
+                        os.fsync(f.fileno())
+                except FileNotFoundError:
+                    # moved to the chunk store meanwhile
+                    pass
+            # the entries only reach the journal once their data is synced, a change made durable before its
+            # data would point to nothing.  Later changes wait in journal_lines for the next commit.
+            if lines!=None:
+                self.journal.write(''.join(lines))
+                self.journal.flush()
+                if sync:
+                    os.fsync(self.journal.fileno())
+            if sync:
+                os.fsync(self.changes.fileno())
+            if seqs!=None:
+                self.__write_peers__(seqs)
+            if files!=None:
+                self.__write_snapshot__(files)
+            if sync:
+                self.__sync_dir__()
+        if self.journal!=None and self.journal_len>=self.compact_after:
+            self.compact()
+        self.metrics.observe('fs.flush', time.perf_counter()-start)
 
         # tell listeners that the FS metadata was pushed to the disk
         for i in self.listeners:
             i.onFlush(self)
-    def wr_entry(self, name, data):
-        '''returns the UID for the entry, does not flush the filesystem.'''
-        vec = hex(random.randint(0,0x10000000))[2:]
-        ident = [name, vec]
+    def __committer__(self):
+        # group commit: everything flushed while a commit is written or within commit_interval after the
+        # first flush goes into the next commit.  A writer waiting on every commit alone isn't kept waiting.
+        batch = 0
+        try:
+            with self.commit_cond:
+                while True:
+                    while len(self.waiters)==0 and self.uncommitted<self.commit_size and not self.closing:
+                        self.commit_cond.wait()
+                    end = time.time()+(self.commit_interval if batch>1 else 0)
+                    while len(self.waiters)<self.commit_size and self.uncommitted<self.commit_size and not self.closing:
+                        left = end-time.time()
+                        if left<=0:
+                            break
+                        self.commit_cond.wait(left)
+                    waiters = self.waiters
+                    self.waiters = []
+                    batch = len(waiters)
+                    closing = self.closing
+                    self.commit_cond.release()
+                    try:
+                        self.__commit__()
+                        error = None
+                    except Exception as e:
+                        error = e
+                    finally:
+                        self.commit_cond.acquire()
+                    self.metrics.count('fs.commits')
+                    self.metrics.count('fs.committed', len(waiters))
+                    for i in waiters:
+                        if error==None:
+                            i.set_result(None)
+                        else:
+                            i.set_exception(error)
+                    if closing and len(self.waiters)==0:
+                        break
+        finally:
+            self.committer.release()
+    def close(self):
+        if self.committer!=None:
+            # what was flushed is committed first
+            with self.commit_cond:
+                self.closing = True
+                self.commit_cond.notify()
+            self.committer.acquire()
+        with self.commit_lock, self.lock:
+            self.changes.close()
+            if self.journal!=None:
+                # changes that were never flushed are written, but not synced
+                self.journal.write(''.join(self.journal_lines))
+                self.journal_lines = []
+                self.journal.close()
+                self.journal = None
+        if self.peers_dirty:
+            self.__write_peers__(self.remote_seqs)
+    @property
+    def seq(self):
+        '''sequence number of the latest change on this node.'''
+        return len(self.changelog)
+    def changes_since(self, seq):
+        '''returns [name, id, data] for every entry this node got after the change numbered seq.'''
+        with self.lock:
+            # a lazily loaded change log is read back from the file
+            self.changes.flush()
+            return [[name, vec, self.files[name][vec]] for name, vec in self.changelog[seq:]]
+    def tree_entries(self, buckets):
+        '''returns [name, id, data] for every entry in the given buckets of the hash tree.'''
+        tree = self.tree
+        with self.lock:
+            return [[name, vec, self.files[name][vec]] for i in buckets for name, vec in tree.bucket(i)]
+    def set_remote_seq(self, node, seq):
+        '''remembers that every change of the remote node up to seq is present here.  Saved on the next flush.'''
+        with self.lock:
+            self.remote_seqs[node] = seq
+            self.peers_dirty = True
+    def set_entry(self, ident, data):
+        '''Sets the data of an entry, creating it if needed.  Does not notify listeners.  Does not flush the filesystem.'''
+        with self.lock:
+            self.__set_entry__(ident[0], ident[1], data)
+        self.__changed__()
+    def __set_entry__(self, name, vec, data):
+        # called holding lock
         if name in self.files.keys():
-            while vec in self.files[name].keys():
-                vec = hex(random.randint(0,0x10000000))[2:]
-            self.files[name][vec] = data
+            old = self.files[name].get(vec)
+            if type(self.files)==dict:
+                # readers may be going through the old versions, so they are replaced rather than changed
+                versions = dict(self.files[name])
+                versions[vec] = data
+                self.files[name] = versions
+            else:
+                self.files[name][vec] = data
         else:
+            old = None
             self.files[name] = {vec:data}
+            self.names.add(name)
+            self.__index_ext__(name)
+        if data!=None and old==None:
+            self.__log_change__(name, vec)
+            if self.hash_tree!=None:
+                self.hash_tree.add(name, vec)
+            self.__index_version__(name, vec)
+        if self.journal!=None:
+            self.journal_lines.append(json.dumps([name, vec, data])+'\n')
+            self.journal_len+=1
+        self.uncommitted+=1
+    def __changed__(self):
+        if self.uncommitted==self.commit_size and self.committer!=None:
+            # enough for a commit without waiting for a flush
+            with self.commit_cond:
+                self.commit_cond.notify()
+    def wr_entry(self, name, data):
+        '''returns the UID for the entry, does not flush the filesystem.'''
+        with self.lock:
+            vec = self.__new_vec__()
+            if name in self.files.keys():
+                while vec in self.files[name].keys():
+                    vec = self.__new_vec__()
+            ident = [name, vec]
+            self.__set_entry__(name, vec, data)
+        self.__changed__()
 
         # push data to listeners
         if data!=None:
@@ -68,18 +804,21 @@ class PyOneFS:
                 i.onEntryCreate(self, ident, data)
                 
         return ident
+    def __new_vec__(self):
+        # called holding lock
+        stamp = max(int(time.time()*1000), self.last_stamp+1)
+        self.last_stamp = stamp
+        return hex((stamp<<STAMP_BITS)+random.getrandbits(STAMP_BITS))[2:]
     def try_create_entry(self, ident, data):
         '''Creates an entry if possible.  Returns True on success, False otherwise.  Made for P2P networking.
 Does not notify listeners.  Does not flush the filesystem.'''
         vec = ident[1]
         name = ident[0]
-        if name in self.files.keys():
-            if vec in self.files[name].keys():
+        with self.lock:
+            if name in self.files.keys() and vec in self.files[name].keys():
                 return False
-            self.files[name][vec] = data
-        else:
-            self.files[name] = {vec:data}
-                
+            self.__set_entry__(name, vec, data)
+        self.__changed__()
         return True
     def get_entry(self, name):
         if type(name)==list:
@@ -107,6 +846,102 @@ Does not notify listeners.  Does not flush the filesystem.'''
         name = ident[0]
         ext = name[name.rfind('.'):]
         return os.path.join(self.loc, ident[1]+'_'+ident[0][:3].replace('/', '_')+ext)
+    def manifestPathOf(self, ident):
+        return self.localPathOf(ident)+'.chunks'
+    def manifest(self, ident):
+        '''returns the chunk list of a file kept in the chunk store, or None.'''
+        path = self.manifestPathOf(ident)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+    def write_manifest(self, ident, manifest):
+        path = self.manifestPathOf(ident)
+        with open(path+'.tmp', 'w') as f:
+            json.dump(manifest, f)
+            self.__sync__(f)
+        os.replace(path+'.tmp', path)
+    def digestPathOf(self, ident):
+        return self.localPathOf(ident)+'.sha256'
+    def partPathOf(self, ident):
+        # data being received goes here, it is renamed to localPathOf once it is complete
+        return self.localPathOf(ident)+'.part'
+    def part_size(self, ident):
+        '''returns the size of the .part file of an entry, None if there is none.'''
+        try:
+            return os.path.getsize(self.partPathOf(ident))
+        except FileNotFoundError:
+            return None
+    def open_part(self, ident, resume=False):
+        '''opens the .part file of an entry to write the data being received, from the start unless resume is
+True.'''
+        return open(self.partPathOf(ident), 'r+b' if resume else 'wb')
+    def finish_part(self, ident):
+        '''puts the data of an entry in place once its .part file is complete and closed.'''
+        os.replace(self.partPathOf(ident), self.localPathOf(ident))
+        self.wrote_data(self.localPathOf(ident))
+    def drop_part(self, ident):
+        os.remove(self.partPathOf(ident))
+    def known_digest(self, ident, size=None):
+        '''returns the sha256 of the data of an entry as hex if it was computed before, or None.'''
+        if size!=None and size<DIGEST_MIN:
+            return None
+        try:
+            with open(self.digestPathOf(ident)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+    def digest(self, ident):
+        '''returns the sha256 of the data of an entry as hex.  Computed once, then kept next to the data.'''
+        digest = self.known_digest(ident)
+        if digest==None:
+            h = hashlib.sha256()
+            f, size = self.open_data(ident)
+            with f:
+                for block in iter(lambda: f.read(1<<20), b''):
+                    h.update(block)
+            digest = h.hexdigest()
+            self.write_digest(ident, digest, size)
+        return digest
+    def write_digest(self, ident, digest, size=None):
+        if size!=None and size<DIGEST_MIN:
+            return
+        path = self.digestPathOf(ident)
+        with open(path+'.tmp', 'w') as f:
+            f.write(digest)
+        os.replace(path+'.tmp', path)
+    def store_chunks(self, ident):
+        '''moves the data of a file into the chunk store.'''
+        loc = self.localPathOf(ident)
+        self.write_manifest(ident, self.chunkstore.store_file(loc))
+        if self.durability!='buffered':
+            # the chunks and the manifest have to be on the disk before the file they replace is gone
+            self.__sync_dir__()
+        os.remove(loc)
+    def has_data(self, ident):
+        return os.path.isfile(self.localPathOf(ident)) or os.path.isfile(self.manifestPathOf(ident))
+    def drop_data(self, ident):
+        '''removes the data of an entry from this node, the entry stays and its data is fetched from the
+nodes that keep it when it is opened.  Chunks stay in the chunk store.'''
+        for path in [self.localPathOf(ident), self.manifestPathOf(ident), self.digestPathOf(ident)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    def open_data(self, ident):
+        '''returns (binary file, size) for the data of an entry, wherever it is stored.'''
+        manifest = self.manifest(ident)
+        if manifest!=None:
+            return self.chunkstore.open(manifest), sum(i[1] for i in manifest)
+        try:
+            f = open(self.localPathOf(ident), 'rb')
+        except FileNotFoundError:
+            manifest = self.manifest(ident)
+            if manifest==None:
+                raise
+            # moved to the chunk store meanwhile
+            return self.chunkstore.open(manifest), sum(i[1] for i in manifest)
+        return f, os.fstat(f.fileno()).st_size
     def open(self, name, mode = 'r'):
         if mode[0]=='w':
             ident = self.wr_entry(name, None)
@@ -117,9 +952,79 @@ Does not notify listeners.  Does not flush the filesystem.'''
 
         ext = ident[0][ident[0].rfind('.'):]
         
-        return PyOneFile(self, ident, self.localPathOf(ident), mode, ext)
+        f = None
+        if mode[0]=='r':
+            if not self.has_data(ident):
+                # kept on other nodes, a Manager with replicas fetches it
+                for i in self.listeners:
+                    i.onDataWanted(self, ident)
+            manifest = self.manifest(ident)
+            if manifest==None and self.chunkstore!=None:
+                try:
+                    f = open(self.localPathOf(ident), mode)
+                except FileNotFoundError:
+                    # moved to the chunk store meanwhile
+                    manifest = self.manifest(ident)
+                    if manifest==None:
+                        raise
+            if manifest!=None:
+                # reassemble the file from the chunk store
+                f = self.chunkstore.open(manifest)
+                if not 'b' in mode:
+                    f = io.TextIOWrapper(f)
+        return PyOneFile(self, ident, self.localPathOf(ident), mode, ext, f)
     def ls(self):
-        return list(self.files.keys())
+        '''returns every name, sorted.'''
+        return list(self.names.irange(''))
+    def lsprefix(self, prefix):
+        '''returns the names starting with prefix, sorted.'''
+        return list(self.names.prefixed(prefix))
+    def lsrange(self, start, stop=None):
+        '''returns the names from start up to but not including stop, sorted.'''
+        return list(self.names.irange(start, stop))
+    def lsdir(self, path=''):
+        '''lists a directory: the names directly in path, and its subdirectories with a trailing /.'''
+        prefix = path if path=='' or path.endswith('/') else path+'/'
+        out = []
+        start = prefix
+        while True:
+            sub = None
+            for name in self.names.irange(start):
+                if not name.startswith(prefix):
+                    return out
+                i = name.find('/', len(prefix))
+                if i==-1:
+                    out.append(name)
+                else:
+                    sub = name[:i+1]
+                    break
+            if sub==None:
+                return out
+            out.append(sub)
+            # skip everything in the subdirectory, '0' is the character after '/'
+            start = sub[:-1]+'0'
+    def lsext(self, ext):
+        '''returns the names with the extension ext (like '.txt'), sorted.'''
+        out = []
+        if ext in self.exts.keys():
+            out = list(self.exts[ext].irange(''))
+        if self.image!=None:
+            return list(heapq.merge(self.image.ext_names(ext), out))
+        return out
+    def versions(self, name):
+        '''returns the ids of the complete versions of name, oldest first by the time in their ids, so every node
+agrees on it.  Ids made before they carried a time come first, in the order this node got them.'''
+        if name in self.version_order.keys():
+            return list(self.version_order[name])
+        if not name in self.files.keys():
+            return []
+        return [k for k, v in self.files[name].items() if v!=None]
+    def latest(self, name):
+        '''returns the ident of the newest complete version of name.'''
+        versions = self.versions(name)
+        if len(versions)==0:
+            raise Exception("Path not found: no files match the name "+name)
+        return [name, versions[-1]]
     def lsentries(self, name):
         out = []
         if not name in self.files.keys():
@@ -154,7 +1059,7 @@ class VPyOneFile:
         else:
             q = min(len(self.data), self.idx+n)
         dt = self.data[self.idx:q]
-        self.idx+=q
+        self.idx = q
         if self.mode[1:2]!='b':
             dt = dt.decode()
         return dt
@@ -164,27 +1069,100 @@ class VPyOneFile:
         if not self.mode[0] in ['w', 'a']:
             raise Exception("Not opened for writing!")
         self.fs.filedat[self.fn] = self.data
-        self.fs.files[self.id[0]][self.id[1]] = self.ext
-        self.fs.flush()
+        if self.fs.files[self.id[0]][self.id[1]]==None:
+            self.fs.files[self.id[0]][self.id[1]] = self.ext
+            self.fs.__completed__(self.id[0], self.id[1])
+            for i in self.fs.listeners:
+                i.onEntryCreate(self.fs, self.id, self.ext)
+        return self.fs.flush()
     def close(self):
         if self.mode[0] in ['w', 'a']:
             self.flush()
             for i in self.fs.listeners:
-                i.onFileWritten(self.fs, self.fn)
+                i.onFileWritten(self.fs, self.id, self.fn)
         return self.id
 
+class VPyOnePart(io.BytesIO):
+    '''data of an entry being received into a VPyOneFS, kept when it is closed.'''
+    def __init__(self):
+        io.BytesIO.__init__(self)
+        self.data = b''
+    def close(self):
+        if not self.closed:
+            self.data = self.getvalue()
+        io.BytesIO.close(self)
+
 '''For testing purposes'''
 class VPyOneFS:
+    '''Keeps the entries and their data in memory.  It can be synced with peers through a Manager.'''
     def __init__(self):
         self.files = {}
         self.filedat = {}
+        # data being received from peers, see open_part
+        self.parts = {}
         self.listeners = []
+        # what the Manager and its peers use, see PyOneFS
+        self.metrics = metrics.Metrics()
+        self.node_id = os.urandom(8).hex()
+        self.remote_seqs = {}
+        self.changelog = []
+        self.tree_depth = TREE_DEPTH
+        self.tree = HashTree(TREE_DEPTH)
+        self.journal = None
+        self.chunkstore = None
+        self.image = None
+    @property
+    def seq(self):
+        '''sequence number of the latest change on this node.'''
+        return len(self.changelog)
+    def __completed__(self, name, vec):
+        self.changelog.append([name, vec])
+        self.tree.add(name, vec)
+    def changes_since(self, seq):
+        '''returns [name, id, data] for every entry this node got after the change numbered seq.'''
+        return [[name, vec, self.files[name][vec]] for name, vec in self.changelog[seq:]]
+    def tree_entries(self, buckets):
+        '''returns [name, id, data] for every entry in the given buckets of the hash tree.'''
+        return [[name, vec, self.files[name][vec]] for i in buckets for name, vec in self.tree.bucket(i)]
+    def set_remote_seq(self, node, seq):
+        self.remote_seqs[node] = seq
+    def snapshot(self):
+        return {name:dict(versions) for name, versions in self.files.items()}
+    def entries(self):
+        return ((name, vec, data) for name, versions in self.snapshot().items() for vec, data in versions.items())
+    def has_data(self, ident):
+        return self.localPathOf(ident) in self.filedat
+    def open_data(self, ident):
+        data = self.filedat[self.localPathOf(ident)]
+        return io.BytesIO(data), len(data)
+    def manifest(self, ident):
+        return None
+    def known_digest(self, ident, size=None):
+        return None
+    def digest(self, ident):
+        return hashlib.sha256(self.filedat[self.localPathOf(ident)]).hexdigest()
+    def write_digest(self, ident, digest, size=None):
+        # hashed again when needed
+        pass
+    def part_size(self, ident):
+        # what arrives is only kept once it is complete, so there is nothing to resume
+        return None
+    def open_part(self, ident, resume=False):
+        part = VPyOnePart()
+        self.parts[self.localPathOf(ident)] = part
+        return part
+    def finish_part(self, ident):
+        path = self.localPathOf(ident)
+        self.filedat[path] = self.parts.pop(path).data
+    def drop_part(self, ident):
+        self.parts.pop(self.localPathOf(ident), None)
     def flush(self):
         # don't push changes to disk, this is a virtual FS
 
         # tell listeners that the FS metadata was pushed to the disk
         for i in self.listeners:
             i.onFlush(self)
+        return done_future()
     def wr_entry(self, name, data):
         '''returns the UID for the entry, does not flush the filesystem.'''
         vec = hex(random.randint(0,0x10000000))[2:]
@@ -195,6 +1173,8 @@ class VPyOneFS:
             self.files[name][vec] = data
         else:
             self.files[name] = {vec:data}
+        if data!=None:
+            self.__completed__(name, vec)
 
         # push data to listeners
         if data!=None:
@@ -213,6 +1193,8 @@ Does not notify listeners.  Does not flush the filesystem.'''
             self.files[name][vec] = data
         else:
             self.files[name] = {vec:data}
+        if data!=None:
+            self.__completed__(name, vec)
                 
         return True
     def get_entry(self, name):
@@ -272,3 +1254,5 @@ class FsChangeListener:
         pass
     def onFileWritten(self, fs, ident, location):
         pass
+    def onDataWanted(self, fs, ident):
+        pass
@@ -16,6 +16,10 @@ setuptools.setup(
     install_requires=[
           'ecdsa'
       ],
+    extras_require={
+          'zstd':['zstandard'],
+          'lz4':['lz4']
+      },
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
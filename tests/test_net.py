@@ -0,0 +1,535 @@
+import os, json, socket, tempfile, threading, time, unittest, _thread
+from unittest import mock
+from pyone import bench, pyonefs, pyone_net, compression, placement
+
+def wait(done, timeout=20):
+    start = time.time()
+    while not done():
+        if time.time()-start>timeout:
+            return False
+        time.sleep(.01)
+    return True
+
+def write(fs, name, data):
+    f = fs.open(name, 'wb')
+    f.write(data)
+    return f.close()
+
+def read(fs, name):
+    f = fs.open(name, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        with bench.quiet():
+            self.cluster = bench.Cluster(2, self.dir.name)
+    def tearDown(self):
+        with bench.quiet():
+            self.cluster.close()
+        self.dir.cleanup()
+    def raw(self):
+        return socket.create_connection((self.cluster.address(0), self.cluster.port))
+    def test_peer_after_bad_clients(self):
+        # connects and hangs up before the handshake
+        self.raw().close()
+        # sends something that isn't TLS
+        s = self.raw()
+        s.sendall(b'GET / HTTP/1.0\r\n\r\n')
+        s.close()
+        # connects and never says anything, the server keeps accepting meanwhile
+        idle = self.raw()
+        try:
+            with bench.quiet():
+                self.cluster.managers[1].connectPeer(self.cluster.address(0))
+            server = self.cluster.managers[0]
+            self.assertTrue(wait(lambda: any(p.remote!=None for p in list(server.peers))))
+            self.assertTrue(wait(lambda: all(p.remote!=None for p in list(self.cluster.managers[1].peers))))
+        finally:
+            idle.close()
+
+class AsyncTest(unittest.TestCase):
+    def test_files_move_both_ways(self):
+        with tempfile.TemporaryDirectory() as loc, bench.quiet():
+            cluster = bench.Cluster(2, loc, aio=True)
+            try:
+                # found by the sync on connect
+                write(cluster.fss[0], 'before.bin', b'b'*100000)
+                cluster.connect()
+                self.assertTrue(wait(lambda: cluster.has_all(1, 1)))
+                # pushed as they are written
+                write(cluster.fss[0], 'pushed.bin', b'p'*1000)
+                write(cluster.fss[1], 'back.bin', b'k'*1000)
+                self.assertTrue(wait(lambda: cluster.has_all(0, 3) and cluster.has_all(1, 3)))
+                self.assertEqual(read(cluster.fss[1], 'before.bin'), b'b'*100000)
+                self.assertEqual(read(cluster.fss[1], 'pushed.bin'), b'p'*1000)
+                self.assertEqual(read(cluster.fss[0], 'back.bin'), b'k'*1000)
+            finally:
+                cluster.close()
+
+class DeltaTest(unittest.TestCase):
+    def test_reconnect_sends_only_new_changes(self):
+        with tempfile.TemporaryDirectory() as loc, bench.quiet():
+            cluster = bench.Cluster(2, loc)
+            try:
+                for i in range(10):
+                    write(cluster.fss[0], 'a%d.txt'%i, b'a')
+                cluster.connect()
+                self.assertTrue(wait(lambda: cluster.has_all(1, 10)))
+                cluster.managers[1].close()
+                for i in range(5):
+                    write(cluster.fss[0], 'b%d.txt'%i, b'b')
+                # pushed to nobody, so they can only come with the delta
+                self.assertTrue(wait(lambda: len(cluster.managers[0].outbox)==0))
+                # the changes node 0 is asked for, and how many it sends
+                asked = []
+                changes_since = cluster.fss[0].changes_since
+                def spy(seq):
+                    changes = changes_since(seq)
+                    asked.append((seq, len(changes)))
+                    return changes
+                cluster.fss[0].changes_since = spy
+                cluster.managers[1] = pyone_net.Manager(cluster.fss[1], serve=False, adr=cluster.address(1),
+                                                        port=cluster.port, certfile=cluster.certfile,
+                                                        keyfile=cluster.keyfile, cafile=cluster.certfile)
+                cluster.managers[1].connectPeer(cluster.address(0))
+                self.assertTrue(wait(lambda: cluster.has_all(1, 15)))
+                self.assertEqual(asked, [(10, 5)])
+            finally:
+                cluster.close()
+
+class SchedulerTest(unittest.TestCase):
+    class Peer:
+        def __init__(self):
+            self.requested = []
+        def requestFileFromIdent(self, ident):
+            self.requested.append(ident)
+    def test_spread_and_lost_peer(self):
+        scheduler = pyone_net.SyncScheduler(2)
+        a, b = self.Peer(), self.Peer()
+        idents = [['f%d.txt'%i, '%x'%i] for i in range(6)]
+        for ident in idents:
+            scheduler.want(ident, a)
+            scheduler.want(ident, b)
+        # at most a window each, and never the same entry from both
+        self.assertEqual(a.requested, idents[0:2])
+        self.assertEqual(b.requested, idents[2:4])
+        # an answer makes room for the next one
+        scheduler.received(idents[0], 10)
+        self.assertEqual(a.requested, idents[0:2]+idents[4:5])
+        # what was asked of b goes to a, once it has room
+        scheduler.peerLost(b)
+        self.assertEqual(scheduler.stats['retried'], 2)
+        self.assertEqual(len(a.requested), 3)
+        i = 1
+        while i<len(a.requested):
+            scheduler.received(a.requested[i], 10)
+            i+=1
+        self.assertEqual(sorted(a.requested), idents)
+        progress = scheduler.progress()
+        self.assertEqual((progress['received'], progress['requested']), (6, 8))
+        self.assertEqual((progress['pending'], progress['inflight']), (0, 0))
+        self.assertEqual(progress['bytes'], 60)
+
+class GossipTest(unittest.TestCase):
+    def spread(self, aio):
+        # every node connects to the first one, which is the only node the others can learn anything from
+        with tempfile.TemporaryDirectory() as loc, bench.quiet():
+            cluster = bench.Cluster(3, loc, aio=aio, gossip_fanout=1, gossip_interval=.5)
+            try:
+                cluster.connect()
+                for i in range(50):
+                    f = cluster.fss[0].open('g%02d.txt'%i, 'wb')
+                    f.write(b'x'*100)
+                    f.close()
+                self.assertTrue(wait(lambda: all(cluster.has_all(i, 50) for i in range(3))))
+                for fs in cluster.fss[1:]:
+                    self.assertTrue(all(fs.has_data([name, vec]) for name, vec, data in cluster.fss[0].entries()))
+            finally:
+                cluster.close()
+    def test_every_node_gets_every_entry(self):
+        self.spread(False)
+    def test_every_node_gets_every_entry_aio(self):
+        self.spread(True)
+
+class PreforkTest(unittest.TestCase):
+    def test_workers_replicate(self):
+        def seed(fs):
+            for i in range(20):
+                write(fs, 'seed/f%02d.txt'%i, b'seed %d'%i)
+        with tempfile.TemporaryDirectory() as loc, bench.quiet():
+            cluster = bench.Cluster(3, loc, workers=2, seed=seed)
+            try:
+                cluster.connect()
+                # the clients bootstrap from the workers
+                self.assertTrue(wait(lambda: cluster.has_all(1, 20) and cluster.has_all(2, 20)))
+                self.assertEqual(read(cluster.fss[2], 'seed/f07.txt'), b'seed 7')
+                # written by the owner, pushed by every worker to its clients
+                write(cluster.fss[0], 'late.txt', b'late')
+                self.assertTrue(wait(lambda: all('late.txt' in fs.files for fs in cluster.fss[1:])))
+                self.assertEqual(read(cluster.fss[1], 'late.txt'), b'late')
+                # written by a client, it reaches the owner through a worker
+                write(cluster.fss[1], 'client.txt', b'client')
+                self.assertTrue(wait(lambda: 'client.txt' in cluster.fss[0].files))
+                self.assertEqual(read(cluster.fss[0], 'client.txt'), b'client')
+                stats = cluster.managers[0].stats()
+                self.assertEqual(sum(len(w['peers']) for w in stats['workers'] if w), 2)
+            finally:
+                cluster.close()
+
+class MemoryFsTest(unittest.TestCase):
+    def test_sync(self):
+        # a node keeping its filesystem in memory syncs both ways with one on the disk
+        with tempfile.TemporaryDirectory() as loc, bench.quiet():
+            cluster = bench.Cluster(1, loc)
+            fs = pyonefs.VPyOneFS()
+            man = pyone_net.Manager(fs, adr=cluster.address(1), port=cluster.port, certfile=cluster.certfile,
+                                    keyfile=cluster.keyfile, cafile=cluster.certfile)
+            try:
+                write(cluster.fss[0], 'disk.bin', b'd'*1000)
+                write(fs, 'memory.bin', b'm'*1000)
+                man.connectPeer(cluster.address(0))
+                self.assertTrue(wait(lambda: len(fs.files)==2 and cluster.has_all(0, 2)))
+                write(fs, 'later.bin', b'l'*1000)
+                self.assertTrue(wait(lambda: cluster.has_all(0, 3)))
+                self.assertEqual(read(fs, 'disk.bin'), b'd'*1000)
+                for name in ['memory.bin', 'later.bin']:
+                    self.assertEqual(read(cluster.fss[0], name), name[0].encode()*1000)
+            finally:
+                man.close()
+                cluster.close()
+
+class PushTest(unittest.TestCase):
+    '''a Peer pushing a file to another over a socket pair, each with a BenchManager and a filesystem of its own.'''
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fss = []
+    def tearDown(self):
+        for fs in self.fss:
+            fs.close()
+        self.dir.cleanup()
+    def fs(self, **args):
+        fs = pyonefs.PyOneFS(os.path.join(self.dir.name, 'fs%d'%len(self.fss)), **args)
+        self.fss.append(fs)
+        return fs
+    def peers(self, a_fs, b_fs):
+        '''returns the sending and the receiving Peer.'''
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        sender = pyone_net.Peer(a, bench.BenchManager(a_fs))
+        receiver = pyone_net.Peer(b, bench.BenchManager(b_fs))
+        receiver.isSynced = True
+        return sender, receiver
+    def push(self, sender, receiver, ident):
+        '''pushes ident from a thread of its own, the receiver runs until the sender hangs up.'''
+        def send():
+            sender.pushFsChange(ident)
+            sender.flush()
+            sender.sok.close()
+        _thread.start_new_thread(send, ())
+        man = receiver.man
+        with bench.quiet():
+            while True:
+                try:
+                    receiver.update()
+                except ConnectionError:
+                    break
+                finally:
+                    # what Manager.run does after every pass, signed messages wait for it
+                    man.verifier.flush()
+                    man.collectVerified()
+        receiver.sok.close()
+
+class OutboxTest(PushTest):
+    def test_batched_in_completion_order(self):
+        man = bench.BenchManager(self.fs())
+        man.push_interval = 60
+        fs = man.fs
+        b, c, d, e = [['%s.txt'%i, '1'] for i in 'bcde']
+        # the entry and its data come in either order, it is only pushed once it has both
+        man.onEntryCreate(fs, c, 'txt')
+        man.onFileWritten(fs, b, fs.localPathOf(b))
+        self.assertEqual(len(man.outbox), 0)
+        man.onFileWritten(fs, c, fs.localPathOf(c))
+        man.onEntryCreate(fs, b, 'txt')
+        man.onEntryCreate(fs, d, 'txt')
+        self.assertEqual(man.takePushes(), [c, b])
+        self.assertIn(tuple(d), man.fs_changes)
+        self.assertEqual(len(man.new_files), 0)
+        # the next batch waits for the interval
+        man.onEntryCreate(fs, e, 'txt')
+        man.onFileWritten(fs, e, fs.localPathOf(e))
+        self.assertEqual(man.takePushes(), [])
+        man.last_push = 0
+        self.assertEqual(man.takePushes(), [e])
+        self.assertEqual(man.metrics.snapshot()['counters']['pushes'], 3)
+
+class FsJsonTest(PushTest):
+    def test_byte_at_a_time(self):
+        files = {'a.txt':{'1':'txt', '2':'txt'}, 'd/\u00e9t\u00e9.txt':{'3':'txt'}, 'b.bin':{'4':'bin'}}
+        data = json.dumps(files, indent=1, ensure_ascii=False).encode()
+        names = []
+        stream = pyone_net.FsJsonStream(lambda name, versions: names.append((name, versions)))
+        for i in range(len(data)):
+            stream.feed(data[i:i+1])
+            if i==len(data)//2:
+                # the names that are complete are there before the rest arrives
+                self.assertIn(('a.txt', files['a.txt']), names)
+        stream.finish()
+        self.assertEqual(dict(names), files)
+    def test_limit(self):
+        stream = pyone_net.FsJsonStream(lambda name, versions: None, limit=1000)
+        stream.feed(b'{"a.txt":{"1":"txt"},')
+        with self.assertRaises(ConnectionError):
+            stream.feed(('"'+'x'*2000).encode())
+        with self.assertRaises(ConnectionError):
+            pyone_net.FsJsonStream(lambda name, versions: None).finish()
+    def test_requests_before_the_rest(self):
+        sender, receiver = self.peers(self.fs(), self.fs())
+        requested = []
+        receiver.requestFileFromIdent = requested.append
+        data = json.dumps({'a.txt':{'1':'txt'}, 'b.txt':{'2':'txt'}}).encode()
+        half = data.index(b'"b.txt"')
+        receiver.feed(bytes([pyone_net.COMMAND_RETURN_FS_JSON])+len(data).to_bytes(4, 'little')+data[:half])
+        self.assertEqual(requested, [['a.txt', '1']])
+        receiver.feed(data[half:])
+        self.assertEqual(requested, [['a.txt', '1'], ['b.txt', '2']])
+        self.assertEqual(receiver.state, 0)
+        sender.sok.close()
+        receiver.sok.close()
+
+class OldPeer:
+    '''the other end of a socket pair, reading messages the way a node without compression does.'''
+    def __init__(self, sok):
+        self.sok = sok
+        self.sok.settimeout(10)
+        self.raw = b''
+        self.buf = b''
+        self.framed = False
+    def __recv__(self, n):
+        while len(self.raw)<n:
+            self.raw+=self.sok.recv(65536)
+        out, self.raw = self.raw[:n], self.raw[n:]
+        return out
+    def read(self, n):
+        if not self.framed:
+            return self.__recv__(n)
+        while len(self.buf)<n:
+            codec, size, m = compression.FRAME.unpack(self.__recv__(compression.FRAME.size))
+            payload = self.__recv__(m)
+            self.buf+=payload if codec==compression.CODEC_RAW else compression.decompress(codec, payload, size)
+        out, self.buf = self.buf[:n], self.buf[n:]
+        return out
+    def message(self):
+        '''returns the command of the next message and what it holds.'''
+        cmd = self.read(1)[0]
+        if cmd==pyone_net.COMMAND_FRAMED:
+            self.framed = True
+            return cmd, None
+        elif cmd==pyone_net.COMMAND_RETURN_FS_JSON:
+            return cmd, json.loads(self.read(int.from_bytes(self.read(4), 'little')))
+        elif cmd==pyone_net.COMMAND_PUSH_FS_CHANGE:
+            header = json.loads(self.read(int.from_bytes(self.read(2), 'little')))
+            return cmd, (header, self.read(int.from_bytes(self.read(4), 'little')))
+        return cmd, None
+    def send(self, cmd, data=b'', size=None):
+        if size!=None:
+            data = len(data).to_bytes(size, 'little')+data
+        self.sok.sendall(bytes([cmd])+data)
+
+class CompressionTest(PushTest):
+    def node(self):
+        '''returns a Peer of a node asked to compress, the peer at the other end and a compressible file.'''
+        fs = self.fs()
+        self.data = b'compress me, '*5000
+        ident = write(fs, 'doc.txt', self.data)
+        a, b = socket.socketpair()
+        b.setblocking(0)
+        man = bench.BenchManager(fs)
+        man.compress = True
+        self.addCleanup(a.close)
+        self.addCleanup(b.close)
+        return pyone_net.Peer(b, man), OldPeer(a), ident
+    def answer(self, peer, old, n):
+        '''runs peer on what old sent, returns the next n messages it sends back.'''
+        peer.update()
+        peer.flush()
+        return [old.message() for i in range(n)]
+    def test_legacy_peer(self):
+        peer, old, ident = self.node()
+        # nodes from before the hello ask for the JSON straight away, and don't know COMMAND_FRAMED
+        old.send(pyone_net.COMMAND_GET_FS_JSON)
+        hello, request, fs_json = self.answer(peer, old, 3)
+        self.assertTrue(list(hello[1].keys())[0].startswith(pyone_net.HELLO_PREFIX))
+        self.assertEqual(request, (pyone_net.COMMAND_GET_FS_JSON, None))
+        self.assertEqual(fs_json, (pyone_net.COMMAND_RETURN_FS_JSON, {ident[0]:{ident[1]:'.txt'}}))
+        self.assertTrue(peer.legacy)
+        old.send(pyone_net.COMMAND_GET_FILE, json.dumps(ident).encode(), 2)
+        [(cmd, (header, data))] = self.answer(peer, old, 1)
+        self.assertEqual((cmd, header[0], data), (pyone_net.COMMAND_PUSH_FS_CHANGE, ident, self.data))
+        self.assertFalse(old.framed)
+        self.assertEqual(peer.man.compress_stats['frames'], 0)
+    def test_negotiated(self):
+        peer, old, ident = self.node()
+        info = {'node':'old', 'seq':0, 'caps':[], 'stream':0, 'codecs':['zlib']}
+        old.send(pyone_net.COMMAND_RETURN_FS_JSON, json.dumps({pyone_net.HELLO_PREFIX+json.dumps(info):{}}).encode(), 4)
+        hello, framed, request = self.answer(peer, old, 3)
+        self.assertEqual(framed, (pyone_net.COMMAND_FRAMED, None))
+        self.assertEqual(request, (pyone_net.COMMAND_GET_FS_JSON, None))
+        old.send(pyone_net.COMMAND_GET_FILE, json.dumps(ident).encode(), 2)
+        [(cmd, (header, data))] = self.answer(peer, old, 1)
+        self.assertEqual((cmd, header[0], data), (pyone_net.COMMAND_PUSH_FS_CHANGE, ident, self.data))
+        stats = peer.man.compress_stats
+        self.assertGreater(stats['compressed'], 0)
+        self.assertLess(stats['sent'], len(self.data)//10)
+
+class RawFrameTest(PushTest):
+    def test_incompressible_push(self):
+        # a file that doesn't compress goes out as one raw frame to a peer reading frames
+        a_fs, b_fs = self.fs(), self.fs()
+        data = os.urandom(3<<20)
+        ident = write(a_fs, 'random.bin', data)
+        sender, receiver = self.peers(a_fs, b_fs)
+        sender.startFraming(compression.CODEC_ZLIB)
+        self.push(sender, receiver, ident)
+        stats = sender.man.compress_stats
+        self.assertEqual(stats['compressed'], 0)
+        # the header and the file, not a frame for every piece of it
+        self.assertLessEqual(stats['frames'], 2)
+        self.assertEqual(read(b_fs, 'random.bin'), data)
+
+class SendfileTest(PushTest):
+    def transfer(self, use_sendfile):
+        # returns the calls to os.sendfile and the sizes of the other writes, for a file pushed to a peer
+        a_fs, b_fs = self.fs(), self.fs()
+        data = os.urandom(4<<20)
+        ident = write(a_fs, 'big.bin', data)
+        sender, receiver = self.peers(a_fs, b_fs)
+        sender.man.chunk_size = 1<<16
+        if not use_sendfile:
+            sender.__can_sendfile__ = lambda f: False
+        writes = []
+        try_write = sender.__try_write__
+        def counted(data):
+            writes.append(len(data))
+            return try_write(data)
+        sender.__try_write__ = counted
+        with mock.patch.object(os, 'sendfile', wraps=os.sendfile) as sendfile:
+            self.push(sender, receiver, ident)
+        self.assertEqual(read(b_fs, 'big.bin'), data)
+        return sendfile.call_count, writes
+    def test_sendfile(self):
+        calls, writes = self.transfer(True)
+        self.assertGreater(calls, 0)
+        # only the header is written from Python
+        self.assertLess(sum(writes), 1000)
+    def test_buffered(self):
+        calls, writes = self.transfer(False)
+        self.assertEqual(calls, 0)
+        self.assertLessEqual(max(writes), 1<<16)
+
+class ChunkingTest(PushTest):
+    def test_received_file_chunked_off_thread(self):
+        a_fs, b_fs = self.fs(), self.fs(chunks=True)
+        data = os.urandom(1<<20)
+        ident = write(a_fs, 'data.bin', data)
+        threads = []
+        store_chunks = b_fs.store_chunks
+        def record(ident):
+            threads.append(threading.get_ident())
+            store_chunks(ident)
+        b_fs.store_chunks = record
+        sender, receiver = self.peers(a_fs, b_fs)
+        self.push(sender, receiver, ident)
+        receiver.man.chunker.shutdown()
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+        self.assertIsNotNone(b_fs.manifest(ident))
+        self.assertEqual(read(b_fs, 'data.bin'), data)
+
+class SignedStreamTest(PushTest):
+    def signed(self, size, bad_digest=False):
+        # returns whether the receiver kept the file, small enough to fit in the window of the stream
+        a_fs, b_fs = self.fs(), self.fs()
+        data = os.urandom(size)
+        ident = write(a_fs, 'signed.bin', data)
+        if bad_digest:
+            # the sender signs a sha256 the data doesn't match
+            a_fs.digest = lambda ident: '00'*32
+        sender, receiver = self.peers(a_fs, b_fs)
+        sender.man.keypair = pyone_net.KeyPair()
+        sender.remote = {'node':'receiver', 'seq':0, 'caps':pyone_net.CAPABILITIES}
+        receiver.man.trusted_keys = {sender.man.keypair.sk.get_verifying_key().to_string()}
+        receiver.man.require_signed = True
+        self.push(sender, receiver, ident)
+        kept = b_fs.has_data(ident)
+        if kept:
+            self.assertEqual(read(b_fs, 'signed.bin'), data)
+        return kept
+    def test_streamed(self):
+        self.assertTrue(self.signed(1<<19))
+    def test_digest_mismatch(self):
+        self.assertFalse(self.signed(1<<19, bad_digest=True))
+
+class VerifierTest(unittest.TestCase):
+    def check(self, trusted):
+        key = pyone_net.KeyPair()
+        data = bytes([pyone_net.COMMAND_GET_FILE])+b'[]'
+        signed = key.sign(data)
+        entry = [signed[:64], data, None]
+        verifier = pyone_net.SignatureVerifier(0)
+        verifier.submit(None, entry, signed[64:], trusted)
+        verifier.flush()
+        verifier.collect()
+        self.assertTrue(entry[2])
+    def test_only_trusted_keys_cached(self):
+        pyone_net.verifyingKey.cache_clear()
+        self.check(False)
+        self.assertEqual(pyone_net.verifyingKey.cache_info().currsize, 0)
+        self.check(True)
+        self.assertEqual(pyone_net.verifyingKey.cache_info().currsize, 1)
+
+class RebalanceTest(unittest.TestCase):
+    def test_only_moved_entries(self):
+        with tempfile.TemporaryDirectory() as loc:
+            fs = pyonefs.PyOneFS(loc)
+            for i in range(200):
+                f = fs.open('f%d.txt'%i, 'wb')
+                f.write(b'x')
+                f.close()
+            man = bench.BenchManager(fs)
+            man.ring = placement.Ring([fs.node_id], 1)
+            man.balanced = man.ring.copy()
+            stats = []
+            has_data = fs.has_data
+            def counted(ident):
+                stats.append(tuple(ident))
+                return has_data(ident)
+            fs.has_data = counted
+            def rebalance():
+                del stats[:]
+                man.rebalance()
+                man.balancer.submit(lambda: None).result()
+                while len(man.calls)>0:
+                    func, args = man.calls.popleft()
+                    func(*args)
+            with bench.quiet():
+                man.ring.add('other')
+                rebalance()
+                moved = [tuple(i) for i in fs.entries() if not man.ring.owns(fs.node_id, i)]
+                self.assertTrue(0<len(moved)<200)
+                # once each, and only the entries that moved
+                self.assertEqual(sorted(stats), sorted((name, vec) for name, vec, data in moved))
+                self.assertEqual(len(man.handoffs), len(moved))
+                # nothing moved since, only the handoffs that aren't done are looked at again
+                rebalance()
+                self.assertEqual(sorted(stats), sorted(man.handoffs.keys()))
+            self.assertEqual(man.stats()['counters']['rebalances'], 2)
+            man.chunker.shutdown()
+            man.balancer.shutdown()
+            fs.close()
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,335 @@
+import os, json, shutil, tempfile, time, unittest
+from unittest import mock
+from pyone import pyonefs, compactfiles
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.fs = pyonefs.PyOneFS(self.dir.name)
+    def tearDown(self):
+        self.fs.close()
+        self.dir.cleanup()
+    def write(self, name, size):
+        f = self.fs.open(name, 'wb')
+        f.write(os.urandom(size))
+        return f.close()
+    def test_small_files_are_not_kept(self):
+        ident = self.write('small.bin', 1000)
+        digest = self.fs.digest(ident)
+        self.assertEqual(len(digest), 64)
+        self.assertFalse(os.path.exists(self.fs.digestPathOf(ident)))
+        self.assertIsNone(self.fs.known_digest(ident, 1000))
+        # hashed again every time, to the same value
+        self.assertEqual(self.fs.digest(ident), digest)
+    def test_large_files_are_kept(self):
+        ident = self.write('large.bin', pyonefs.DIGEST_MIN)
+        digest = self.fs.digest(ident)
+        self.assertTrue(os.path.isfile(self.fs.digestPathOf(ident)))
+        self.assertEqual(self.fs.known_digest(ident, pyonefs.DIGEST_MIN), digest)
+    def test_size_unknown(self):
+        # without a size the sidecar is always written and read
+        ident = self.write('other.bin', 10)
+        self.fs.write_digest(ident, 'ab'*32)
+        self.assertEqual(self.fs.known_digest(ident), 'ab'*32)
+        self.assertIsNone(self.fs.known_digest(ident, 10))
+
+class ReopenTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+    def tearDown(self):
+        self.dir.cleanup()
+    def fill(self, n):
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        for i in range(n):
+            f = fs.open('f%d.txt'%i, 'wb')
+            f.write(b'x')
+            f.close()
+        changes = fs.changes_since(0)
+        fs.close()
+        return changes
+    def test_change_log(self):
+        changes = self.fill(3000)
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            self.assertEqual(fs.seq, 3000)
+            self.assertEqual(fs.changes_since(0), changes)
+            self.assertEqual(fs.changes_since(2990), changes[2990:])
+        finally:
+            fs.close()
+    def test_lost_change_log(self):
+        changes = self.fill(10)
+        os.remove(os.path.join(self.dir.name, 'fschanges.log'))
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            self.assertEqual(sorted(fs.changes_since(0)), sorted(changes))
+        finally:
+            fs.close()
+    def test_tree(self):
+        self.fill(100)
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            self.assertIsNone(fs.hash_tree)
+            tree = pyonefs.HashTree()
+            for name, vec, data in fs.changes_since(0):
+                tree.add(name, vec)
+            self.assertEqual(fs.tree.nodes(0, [0]), tree.nodes(0, [0]))
+            f = fs.open('new.txt', 'wb')
+            f.write(b'y')
+            f.close()
+            self.assertNotEqual(fs.tree.nodes(0, [0]), tree.nodes(0, [0]))
+        finally:
+            fs.close()
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = os.path.join(self.dir.name, 'fsdat.journal')
+    def tearDown(self):
+        self.dir.cleanup()
+    def journaled(self):
+        with open(self.journal) as f:
+            return f.read()
+    def test_entries_wait_for_commit(self):
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True, durability='batched')
+        try:
+            fs.wr_entry('a.txt', 'txt')
+            # only the commit writes the journal, once the data of the entries is synced
+            self.assertNotIn('a.txt', self.journaled())
+            fs.flush().result()
+            self.assertIn('a.txt', self.journaled())
+        finally:
+            fs.close()
+    def test_close_keeps_unflushed(self):
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True, durability='batched')
+        ident = fs.wr_entry('b.txt', None)
+        fs.set_entry(ident, 'txt')
+        fs.close()
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            self.assertEqual(fs.files['b.txt'][ident[1]], 'txt')
+        finally:
+            fs.close()
+    def test_replay_after_crash(self):
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            idents = [fs.wr_entry('f%d.txt'%i, 'txt') for i in range(5)]
+            fs.flush()
+            with tempfile.TemporaryDirectory() as loc:
+                # what is on the disk if the process dies now, with the last record torn half way through
+                crashed = os.path.join(loc, 'fs')
+                shutil.copytree(self.dir.name, crashed)
+                with open(os.path.join(crashed, 'fsdat.journal'), 'a') as f:
+                    f.write('["torn.txt", "1')
+                with open(os.path.join(crashed, 'fsdat.json')) as f:
+                    self.assertNotIn('f0.txt', f.read())
+                replayed = pyonefs.PyOneFS(crashed, journal=True)
+                try:
+                    for name, vec in idents:
+                        self.assertEqual(replayed.files[name], {vec:'txt'})
+                    self.assertNotIn('torn.txt', replayed.files)
+                    self.assertEqual(replayed.seq, 5)
+                    # written after the torn record, it has to be replayed as well
+                    later = replayed.wr_entry('later.txt', 'txt')
+                    replayed.flush()
+                finally:
+                    replayed.close()
+                replayed = pyonefs.PyOneFS(crashed, journal=True)
+                try:
+                    self.assertEqual(replayed.files['later.txt'], {later[1]:'txt'})
+                    self.assertEqual(replayed.seq, 6)
+                finally:
+                    replayed.close()
+        finally:
+            fs.close()
+    def compacted(self, fs):
+        fs.compact()
+        start = time.time()
+        while fs.compacting and time.time()-start<10:
+            time.sleep(.01)
+        self.assertFalse(fs.compacting)
+    def test_failed_compaction(self):
+        fs = pyonefs.PyOneFS(self.dir.name, journal=True)
+        try:
+            first = fs.wr_entry('a.txt', 'txt')
+            fs.flush()
+            with mock.patch.object(fs, '__write_snapshot__', side_effect=OSError("disk full")), \
+                    self.assertLogs('pyone', 'ERROR'):
+                self.compacted(fs)
+            self.assertTrue(os.path.isfile(self.journal+'.old'))
+            # the records of the failed compaction go into the next one
+            second = fs.wr_entry('b.txt', 'txt')
+            fs.flush()
+            self.compacted(fs)
+            self.assertFalse(os.path.isfile(self.journal+'.old'))
+        finally:
+            fs.close()
+        with open(os.path.join(self.dir.name, 'fsdat.json')) as f:
+            files = json.load(f)
+        self.assertEqual(files['a.txt'], {first[1]:'txt'})
+        self.assertEqual(files['b.txt'], {second[1]:'txt'})
+
+class MetadataTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.loc = os.path.join(self.dir.name, 'fs')
+        self.plain = pyonefs.PyOneFS(os.path.join(self.dir.name, 'plain'))
+        self.idents = []
+        for i in range(50):
+            self.idents.append(self.plain.wr_entry('d%d/f%d.%s'%(i%5, i%20, ['txt', 'bin'][i%2]), ['txt', 'bin'][i%2]))
+        # an entry whose data comes later
+        self.idents.append(self.plain.wr_entry('late.txt', None))
+        self.plain.set_entry(self.idents[-1], 'txt')
+    def tearDown(self):
+        self.plain.close()
+        self.dir.cleanup()
+    def listing(self, fs):
+        return (list(fs.ls()), list(fs.lsext('.bin')), list(fs.lsdir('d1')),
+                {name:(list(fs.lsentries(name)), [fs.get_entry([name, vec]) for vec in fs.versions(name)]) for name in fs.ls()})
+    def fill(self, fs):
+        for ident in self.idents:
+            fs.try_create_entry(ident, None)
+            fs.set_entry(ident, self.plain.files[ident[0]][ident[1]])
+        fs.flush()
+    def test_compact(self):
+        expected = self.listing(self.plain)
+        fs = pyonefs.PyOneFS(self.loc, journal=True, compact=True)
+        try:
+            self.fill(fs)
+            self.assertEqual(self.listing(fs), expected)
+        finally:
+            fs.close()
+        # from the journal, then from fsdat.json once it is compacted
+        for i in range(2):
+            fs = pyonefs.PyOneFS(self.loc, journal=True, compact=True)
+            try:
+                self.assertIsInstance(fs.files, compactfiles.CompactFiles)
+                self.assertEqual(self.listing(fs), expected)
+                fs.compact()
+                while fs.compacting:
+                    time.sleep(.01)
+            finally:
+                fs.close()
+
+    def test_lazy(self):
+        expected = self.listing(self.plain)
+        fs = pyonefs.PyOneFS(self.loc, journal=True)
+        self.fill(fs)
+        f = fs.open('data.bin', 'wb')
+        f.write(b'lazy')
+        data = f.close()
+        fs.flush()
+        fs.close()
+        fs = pyonefs.PyOneFS(self.loc, lazy=True)
+        try:
+            self.assertIsNotNone(fs.image)
+            listing = self.listing(fs)
+            self.assertEqual(listing[3].pop('data.bin'), ([data[0]+':'+data[1]], [data]))
+            listing[0].remove('data.bin')
+            listing[1].remove('data.bin')
+            self.assertEqual(listing, expected)
+            f = fs.open('data.bin', 'rb')
+            self.assertEqual(f.read(), b'lazy')
+            f.close()
+            # goes into the journal, on top of the image
+            ident = fs.wr_entry('new.txt', 'txt')
+            fs.flush()
+        finally:
+            fs.close()
+        fs = pyonefs.PyOneFS(self.loc, lazy=True)
+        try:
+            self.assertEqual(fs.get_entry('new.txt'), ident)
+            self.assertEqual(len(fs.ls()), len(expected[0])+2)
+        finally:
+            fs.close()
+
+class ChunkTest(unittest.TestCase):
+    def store(self, durability):
+        # returns what was synced and removed, in order
+        events = []
+        fsync, remove = os.fsync, os.remove
+        def synced(fd):
+            events.append(('fsync', os.readlink('/proc/self/fd/%d'%fd)))
+            fsync(fd)
+        def removed(path):
+            events.append(('remove', os.path.abspath(path)))
+            remove(path)
+        with tempfile.TemporaryDirectory() as loc:
+            fs = pyonefs.PyOneFS(loc, chunks=True, durability=durability)
+            f = fs.open('data.bin', 'wb')
+            f.write(os.urandom(1<<18))
+            with mock.patch.object(os, 'fsync', synced), mock.patch.object(os, 'remove', removed):
+                ident = f.close()
+            original = os.path.abspath(fs.localPathOf(ident))
+            fs.close()
+            return events, original, os.path.realpath(loc)
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_synced_before_remove(self):
+        events, original, loc = self.store('immediate')
+        done = events.index(('remove', original))
+        synced = [path for op, path in events[:done] if op=='fsync']
+        self.assertTrue(any(os.path.join(loc, 'chunks') in path for path in synced))
+        self.assertTrue(any(path.endswith('.chunks.tmp') or path.endswith('.chunks') for path in synced))
+        self.assertIn(loc, synced)
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_buffered(self):
+        events, original, loc = self.store('buffered')
+        self.assertEqual([op for op, path in events], ['remove'])
+
+class VersionOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = [tempfile.TemporaryDirectory() for i in range(3)]
+        self.fss = [pyonefs.PyOneFS(d.name) for d in self.dirs]
+    def tearDown(self):
+        for fs in self.fss:
+            fs.close()
+        for d in self.dirs:
+            d.cleanup()
+    def test_replicas_agree(self):
+        a, b, c = self.fss
+        idents = [a.wr_entry('doc.txt', '.txt'), b.wr_entry('doc.txt', '.txt')]
+        # the last one is written once a has seen the one of b, versions written in the same millisecond on
+        # nodes that haven't seen each other's can go either way
+        a.try_create_entry(idents[1], '.txt')
+        idents.append(a.wr_entry('doc.txt', '.txt'))
+        # b and c get them in different orders
+        for ident in idents:
+            b.try_create_entry(ident, '.txt')
+        for ident in reversed(idents):
+            c.try_create_entry(ident, '.txt')
+        self.assertEqual(b.versions('doc.txt'), c.versions('doc.txt'))
+        self.assertEqual(b.latest('doc.txt'), c.latest('doc.txt'))
+        self.assertEqual(c.latest('doc.txt'), idents[2])
+    def test_newer_than_seen(self):
+        a, b, c = self.fss
+        # a version written after one arrived goes after it, even if this node's clock is behind
+        ahead = hex(((int(time.time()*1000)+60000)<<pyonefs.STAMP_BITS)+1)[2:]
+        b.try_create_entry(['doc.txt', ahead], '.txt')
+        ident = b.wr_entry('doc.txt', '.txt')
+        self.assertEqual(b.versions('doc.txt'), [ahead, ident[1]])
+    def test_unstamped_first(self):
+        a, b, c = self.fss
+        a.try_create_entry(['doc.txt', 'ff'], '.txt')
+        a.try_create_entry(['doc.txt', '12'], '.txt')
+        ident = a.wr_entry('doc.txt', '.txt')
+        self.assertEqual(a.versions('doc.txt'), ['ff', '12', ident[1]])
+        a.flush()
+        a.close()
+        self.fss[0] = a = pyonefs.PyOneFS(self.dirs[0].name)
+        self.assertEqual(a.versions('doc.txt'), ['ff', '12', ident[1]])
+    def test_lazy(self):
+        a, b, c = self.fss
+        idents = [a.wr_entry('doc.txt', '.txt') for i in range(3)]
+        with tempfile.TemporaryDirectory() as loc:
+            fs = pyonefs.PyOneFS(loc, journal=True)
+            for ident in reversed(idents):
+                fs.try_create_entry(ident, '.txt')
+            fs.flush()
+            fs.close()
+            for i in range(2):
+                # the image is written on the first lazy open and read on the second
+                fs = pyonefs.PyOneFS(loc, lazy=True)
+                self.assertEqual(fs.versions('doc.txt'), a.versions('doc.txt'))
+                fs.close()
+
+if __name__=='__main__':
+    unittest.main()